@@ -4,16 +4,57 @@
 import streamlit as st
 import os
 import torch
-from PIL import Image
-import clip
 import time
+from PIL import Image
+
+from image_index import load_clip_model, load_or_build_index, read_manifest, DEFAULT_CHECKPOINT
+from vector_index import build_vector_index, ExactIndex
+from search_engine import search_images, search_by_image
+from query_cache import TextEmbeddingCache, ResultCache
+from attribute_index import load_or_build_attribute_index
+from latency import StageTimer, peak_rss_mb
+from thumbnails import thumbnail_map, DEFAULT_THUMBNAIL_SIZE
+import search_client
 
 # --- CẤU HÌNH ---
 IMAGE_DIR = "D:/DoAn/images" 
-MODEL_PATH = "checkpoints/clip_best.pt"
+# Ưu tiên trọng số suy luận fp16 do train.py xuất ra (nạp nhanh hơn checkpoint huấn luyện đầy đủ)
+MODEL_PATH = DEFAULT_CHECKPOINT
+INDEX_DIR = "index"
+# True: đồng bộ chỉ mục với thư mục ảnh mỗi lần khởi động (duyệt toàn bộ kho ảnh); mặc định chỉ nạp
+# chỉ mục đã lập, cập nhật ảnh mới bằng image_index.py
+REFRESH_INDEX_ON_START = False
+# Caption dùng để lập chỉ mục thuộc tính (màu, kiểu dáng) cho bộ lọc; hãng xe lấy từ thư mục con
+METADATA_PATH = "metadata.csv"
+# Backend tìm kiếm: "exact" (duyệt toàn bộ) hoặc "ivf"/"hnsw" (xấp xỉ, cần faiss)
+SEARCH_BACKEND = "exact"
+# Tham số ANN, ví dụ {"nprobe": 16} cho ivf hoặc {"M": 32, "ef_search": 128} cho hnsw
+SEARCH_BACKEND_PARAMS = {}
+# Cache embedding câu truy vấn (lưu ra đĩa) và cache kết quả (query, top_k)
+TEXT_CACHE_SIZE = 4096
+TEXT_CACHE_PATH = "index/text_cache.pt"
+TEXT_CACHE_SAVE_INTERVAL = 60  # giây; cache được ghi nền theo chu kỳ và khi thoát
+RESULT_CACHE_SIZE = 1024
+# Nếu đặt (ví dụ "http://localhost:8000"), app chỉ là giao diện và gọi dịch vụ tìm kiếm của server.py
+# thay vì tự nạp model và chỉ mục; đường dẫn ảnh trả về phải đọc được từ máy chạy app.
+SEARCH_SERVICE_URL = os.environ.get("SEARCH_SERVICE_URL", "")
+# Đo thêm thời gian từng bước (encode_text, search, similarity, topk) của mỗi truy vấn; độ trễ tổng
+# luôn được ghi. Trên GPU việc đo từng bước cần đồng bộ nên chậm hơn một chút.
+PROFILE_STAGES = False
+# Lưới kết quả hiển thị thumbnail tạo sẵn khi lập chỉ mục (index/thumbnails), ảnh gốc chỉ tải khi bấm xem
+THUMBNAIL_SIZE = DEFAULT_THUMBNAIL_SIZE
+RESULTS_PER_PAGE = 9
 
 # --- LOGIC BACKEND ---
 
+@st.cache_resource
+def load_latency_timer():
+    """
+    Bộ đếm độ trễ dùng chung cho mọi phiên (xem latency.py).
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    return StageTimer(device if PROFILE_STAGES else None, name="app")
+
 @st.cache_resource(show_spinner="Đang tải model và lập chỉ mục cho kho ảnh...")
 def load_model_and_index_images():
     """
@@ -24,49 +65,55 @@ def load_model_and_index_images():
     device = "cuda" if torch.cuda.is_available() else "cpu"
     
     try:
-        model, preprocess = clip.load('ViT-B/32', device=device, jit=False)
-        checkpoint = torch.load(MODEL_PATH, map_location=device)
-        model.load_state_dict(checkpoint['model_state_dict'])
+        model, preprocess = load_clip_model(MODEL_PATH, device)
         print("Tải thành công trọng số model từ file checkpoint!")
     except Exception as e:
         raise RuntimeError(f"Lỗi khi tải model: {e}. Hãy chắc chắn file checkpoint tồn tại và hợp lệ.") from e
 
-    image_paths = [os.path.join(root, file) for root, _, files in os.walk(IMAGE_DIR) for file in files if file.lower().endswith((".jpg", ".jpeg", ".png"))]
-    
-    if not image_paths:
-        raise FileNotFoundError(f"Không tìm thấy file ảnh nào trong thư mục: {IMAGE_DIR}")
-
-    all_image_features = []
-    valid_paths = []
-    
-    for path in image_paths:
-        try:
-            img = Image.open(path).convert("RGB")
-            preprocessed_img = preprocess(img).unsqueeze(0).to(device)
-            with torch.no_grad():
-                feat = model.encode_image(preprocessed_img)
-                feat /= feat.norm(dim=-1, keepdim=True)
-            all_image_features.append(feat)
-            valid_paths.append(path)
-        except Exception as e:
-            print(f"Bỏ qua ảnh lỗi {path}: {e}")
-            
-    if not all_image_features:
-        raise ValueError("Không thể xử lý bất kỳ ảnh nào. Vui lòng kiểm tra định dạng ảnh.")
-
-    image_features_tensor = torch.cat(all_image_features, dim=0)
+    # Nạp chỉ mục đã lưu trên đĩa (memory-map); chỉ lập mới khi chưa có chỉ mục hoặc checkpoint/tiền xử lý thay đổi.
+    image_features_tensor, valid_paths = load_or_build_index(model, preprocess, device, IMAGE_DIR, INDEX_DIR, MODEL_PATH,
+                                                             refresh=REFRESH_INDEX_ON_START, thumbnail_size=THUMBNAIL_SIZE)
+    manifest = read_manifest(INDEX_DIR)
+    stage_timer = load_latency_timer() if PROFILE_STAGES else None
+    vector_index = build_vector_index(image_features_tensor, SEARCH_BACKEND, index_dir=INDEX_DIR,
+                                      index_tag=manifest['generation'], timer=stage_timer, **SEARCH_BACKEND_PARAMS)
+    index_info = {
+        'checkpoint_id': manifest['checkpoint']['sha1'],
+        'version': f"{manifest['key']}:{manifest['generation']}",
+    }
+    attribute_index = load_or_build_attribute_index(INDEX_DIR, valid_paths, IMAGE_DIR, METADATA_PATH,
+                                                    index_info['version'])
+    # Tìm kiếm có bộ lọc chỉ chấm điểm tập ảnh khớp, cần backend duyệt chính xác
+    filter_index = vector_index if getattr(vector_index, 'supports_candidates', False) \
+        else ExactIndex(image_features_tensor, timer=stage_timer)
     print(f"Đã lập chỉ mục thành công {len(valid_paths)} ảnh!")
     
-    return model, device, image_features_tensor, valid_paths
+    return model, preprocess, device, vector_index, valid_paths, index_info, attribute_index, filter_index
+
+@st.cache_resource
+def load_query_caches(checkpoint_id):
+    """
+    Cache dùng chung cho mọi phiên: embedding câu truy vấn (theo checkpoint) và kết quả tìm kiếm.
+    """
+    text_cache = TextEmbeddingCache(checkpoint_id, maxsize=TEXT_CACHE_SIZE, path=TEXT_CACHE_PATH,
+                                    save_interval=TEXT_CACHE_SAVE_INTERVAL)
+    result_cache = ResultCache(maxsize=RESULT_CACHE_SIZE)
+    return text_cache, result_cache
+
+@st.cache_resource
+def load_thumbnails(index_version):
+    """
+    {ảnh gốc: thumbnail} cho phiên bản chỉ mục hiện tại. Khi dùng SEARCH_SERVICE_URL, thumbnail chỉ
+    dùng được nếu INDEX_DIR trên máy chạy app là cùng chỉ mục với dịch vụ; nếu không thì hiển thị ảnh gốc.
+    """
+    manifest = read_manifest(INDEX_DIR)
+    if manifest is None or f"{manifest['key']}:{manifest['generation']}" != index_version:
+        return {}
+    return thumbnail_map(INDEX_DIR, manifest, THUMBNAIL_SIZE)
 
-def search_images(query, model, device, image_features, image_paths, top_k=5):
-    with torch.no_grad():
-        text_input = clip.tokenize([query]).to(device)
-        text_features = model.encode_text(text_input)
-        text_features /= text_features.norm(dim=-1, keepdim=True)
-        similarity = (100.0 * text_features @ image_features.T).softmax(dim=-1)
-        values, indices = similarity[0].topk(top_k)
-    return [(image_paths[i], float(v)) for v, i in zip(values, indices)]
+def display_path(thumbnails, img_path):
+    thumbnail = thumbnails.get(img_path)
+    return thumbnail if thumbnail and os.path.exists(thumbnail) else img_path
 
 # --- GIAO DIỆN WEB (FRONTEND) ---
 
@@ -76,10 +123,22 @@ if 'first_load_success' not in st.session_state:
     st.session_state.first_load_success = True
 
 try:
-    model, device, image_features, image_paths = load_model_and_index_images()
+    latency_timer = load_latency_timer()
+    if SEARCH_SERVICE_URL:
+        service_health = search_client.healthz(SEARCH_SERVICE_URL)
+        num_images = service_health['num_images']
+        thumbnails = load_thumbnails(service_health['index_version'])
+    else:
+        model, preprocess, device, vector_index, image_paths, index_info, attribute_index, filter_index = \
+            load_model_and_index_images()
+        text_cache, result_cache = load_query_caches(index_info['checkpoint_id'])
+        # Kết quả cũ không còn đúng khi chỉ mục ảnh thay đổi
+        result_cache.set_index_version(index_info['version'])
+        thumbnails = load_thumbnails(index_info['version'])
+        num_images = len(image_paths)
 
     if st.session_state.first_load_success:
-        st.success(f"Đã lập chỉ mục thành công {len(image_paths)} ảnh! Hệ thống đã sẵn sàng.")
+        st.success(f"Đã lập chỉ mục thành công {num_images} ảnh! Hệ thống đã sẵn sàng.")
         time.sleep(2)
         st.session_state.first_load_success = False
         st.rerun()
@@ -99,13 +158,30 @@ try:
         top_k = st.slider(
             "Số lượng kết quả hiển thị", 
             min_value=1, 
-            max_value=20, 
+            max_value=60, 
             value=6, 
             step=1
         )
+        full_softmax = st.checkbox(
+            "Tính độ khớp bằng softmax trên toàn bộ kho ảnh (chậm hơn với kho ảnh lớn)",
+            value=False,
+            help="Mặc định độ khớp chỉ được chuẩn hoá trên các kết quả trả về."
+        )
+        score_mode = "softmax" if full_softmax else "topk"
+
+        if not SEARCH_SERVICE_URL:
+            st.caption("Bộ lọc (cũng có thể viết trong câu truy vấn, ví dụ: xe SUV + màu đỏ + Audi)")
+            filter_cols = st.columns(3)
+            ui_filters = {
+                attribute: filter_cols[i].multiselect(label, attribute_index.values(attribute))
+                for i, (attribute, label) in enumerate([("brand", "Hãng xe"), ("color", "Màu"), ("body", "Kiểu dáng")])
+            }
 
     if 'query' not in st.session_state:
         st.session_state.query = ""
+    # "text" hoặc "image": thao tác gần nhất (gửi câu truy vấn hay tải ảnh mới lên) quyết định cách tìm
+    if 'search_mode' not in st.session_state:
+        st.session_state.search_mode = "text"
 
     with st.form(key='search_form'):
         query_input = st.text_input(
@@ -116,27 +192,118 @@ try:
         )
         submit_button = st.form_submit_button(label='🔍 Tìm kiếm')
 
+    # Tìm bằng ảnh: dùng chính embedding encode_image của chỉ mục (cần model tại chỗ)
+    query_image = None
+    if not SEARCH_SERVICE_URL:
+        uploaded_file = st.file_uploader("Hoặc tải lên ảnh xe để tìm ảnh tương tự", type=["jpg", "jpeg", "png", "webp"])
+        if uploaded_file is not None:
+            query_image = Image.open(uploaded_file)
+            upload_key = (uploaded_file.name, uploaded_file.size, getattr(uploaded_file, 'file_id', None))
+            if st.session_state.get('upload_key') != upload_key:
+                st.session_state.upload_key = upload_key
+                st.session_state.search_mode = "image"
+        else:
+            st.session_state.upload_key = None
+
     if submit_button and query_input:
         st.session_state.query = query_input
+        st.session_state.search_mode = "text"
 
-    if st.session_state.query:
+    results = None
+    search_start = time.perf_counter()
+    if query_image is not None and st.session_state.search_mode == "image":
+        st.write("---")
+        st.subheader("Kết quả tìm kiếm theo ảnh")
+        st.image(query_image, width=240)
+        filters = {attribute: values for attribute, values in ui_filters.items() if values}
+        results = search_by_image([query_image], model, preprocess, device, filter_index if filters else vector_index,
+                                  image_paths, top_k, score_mode=score_mode, filters=filters,
+                                  attribute_index=attribute_index,
+                                  timer=latency_timer if PROFILE_STAGES else None)[0]
+        latency_timer.record("image_query", time.perf_counter() - search_start)
+    elif st.session_state.query:
         st.write("---") 
         st.subheader(f"Kết quả tìm kiếm cho: '{st.session_state.query}'")
         
-        results = search_images(st.session_state.query, model, device, image_features, image_paths, top_k)
-        
+        if SEARCH_SERVICE_URL:
+            results = search_client.search(SEARCH_SERVICE_URL, st.session_state.query, top_k, score_mode)
+        else:
+            query_text, filters = attribute_index.parse_query(st.session_state.query)
+            for attribute, values in ui_filters.items():
+                filters[attribute] = sorted(set(filters.get(attribute, [])) | set(values))
+            filters = {attribute: values for attribute, values in filters.items() if values}
+            if filters:
+                candidates = attribute_index.candidates(filters)
+                st.caption(f"Bộ lọc {filters}: {len(candidates)}/{len(image_paths)} ảnh")
+            results = search_images(query_text, model, device, filter_index if filters else vector_index,
+                                    image_paths, top_k, text_cache=text_cache, result_cache=result_cache,
+                                    score_mode=score_mode, filters=filters, attribute_index=attribute_index,
+                                    timer=latency_timer if PROFILE_STAGES else None)
+        latency_timer.record("text_query", time.perf_counter() - search_start)
+
+    if results is not None:
+        # Kết quả mới thì quay về trang đầu và đóng ảnh gốc đang xem
+        results_key = tuple(results)
+        if st.session_state.get('results_key') != results_key:
+            st.session_state.results_key = results_key
+            st.session_state.page = 0
+            st.session_state.full_image = None
+
         if not results:
             st.warning("Rất tiếc, không tìm thấy hình ảnh nào phù hợp với mô tả của bạn.")
         else:
+            if st.session_state.full_image:
+                st.image(st.session_state.full_image, use_container_width=True,
+                         caption=os.path.basename(st.session_state.full_image))
+                if st.button("✖ Đóng ảnh gốc"):
+                    st.session_state.full_image = None
+                    st.rerun()
+
+            num_pages = (len(results) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
+            page = min(st.session_state.page, num_pages - 1)
+            first = page * RESULTS_PER_PAGE
             num_columns = 3 
             cols = st.columns(num_columns)
-            for i, (img_path, score) in enumerate(results):
+            for i, (img_path, score) in enumerate(results[first:first + RESULTS_PER_PAGE]):
                 with cols[i % num_columns]:
                     st.image(
-                        img_path,
+                        display_path(thumbnails, img_path),
                         use_container_width=True,
                         caption=f"Độ khớp: {score*100:.2f}%"
                     )
+                    if st.button("🔍 Xem ảnh gốc", key=f"full_{first + i}"):
+                        st.session_state.full_image = img_path
+                        st.rerun()
+
+            if num_pages > 1:
+                prev_col, page_col, next_col = st.columns([1, 2, 1])
+                if prev_col.button("◀ Trang trước", disabled=page == 0):
+                    st.session_state.page = page - 1
+                    st.rerun()
+                page_col.markdown(f"<p style='text-align: center;'>Trang {page + 1}/{num_pages}</p>",
+                                  unsafe_allow_html=True)
+                if next_col.button("Trang sau ▶", disabled=page == num_pages - 1):
+                    st.session_state.page = page + 1
+                    st.rerun()
+
+    with st.expander("📈 Thống kê"):
+        if SEARCH_SERVICE_URL:
+            service_stats = search_client.stats(SEARCH_SERVICE_URL)
+            st.json({
+                "Embedding câu truy vấn": service_stats['cache']['text_embeddings'],
+                "Kết quả tìm kiếm": service_stats['cache']['results'],
+                "Độ trễ tại app (ms)": latency_timer.summary(),
+                "Độ trễ tại dịch vụ (ms)": service_stats['latency'],
+                "QPS dịch vụ": service_stats['qps'],
+                "Bộ nhớ đỉnh dịch vụ (MB)": service_stats['peak_rss_mb'],
+            })
+        else:
+            st.json({
+                "Embedding câu truy vấn": text_cache.stats(),
+                "Kết quả tìm kiếm": result_cache.stats(),
+                "Độ trễ (ms)": latency_timer.summary(),
+                "Bộ nhớ đỉnh (MB)": peak_rss_mb(),
+            })
 
 except (RuntimeError, FileNotFoundError, ValueError) as e:
     st.error(f"**Đã xảy ra lỗi nghiêm trọng:**\n\n{e}\n\nVui lòng kiểm tra lại đường dẫn file và cấu hình, sau đó làm mới lại trang.")
\ No newline at end of file
@@ -0,0 +1,221 @@
+# Tên file: attribute_index.py
+# Chỉ mục thuộc tính cho tìm kiếm có bộ lọc. Hãng xe lấy từ thư mục con (giống nhãn của evaluate.py),
+# màu và kiểu dáng lấy từ caption trong metadata.csv ("Xe Audi Q2 màu xám, kiểu SUV, ban ngày").
+# Mỗi giá trị thuộc tính là một bitmap (np.packbits) trên các dòng của chỉ mục embedding, nên bộ lọc
+# "màu đỏ + Toyota" chỉ là vài phép AND/OR trên byte và bước tính tương đồng chỉ chạy trên tập ảnh khớp.
+
+import os
+import re
+import json
+
+import numpy as np
+import torch
+
+from image_index import file_sha1
+from eval_engine import load_caption_pairs
+from query_cache import normalize_query
+
+ATTRIBUTES = ("brand", "color", "body")
+ATTRIBUTE_FILE = "attributes.npz"
+ATTRIBUTE_VERSION = 1
+
+# Màu ghép được tách thành các màu cơ bản ("trắng nóc đen" -> trắng, đen); mọi sắc "xanh ..." đều có
+# thêm giá trị "xanh" để lọc "màu xanh" khớp cả xanh dương lẫn xanh lá.
+COLORS = ("xanh dương", "xanh lá", "xanh rêu", "xanh ngọc", "xanh", "trắng", "đen", "đỏ", "xám", "bạc",
+          "cam", "vàng", "nâu", "hồng", "tím")
+BODY_TYPES = ("suv", "sedan", "sportback", "coupe", "hatchback", "wagon", "cabriolet", "bán tải", "mpv",
+              "crossover", "minivan")
+_PREFIXES = {"màu": "color", "kiểu": "body", "hãng": "brand"}
+
+
+def _phrase_after(caption, word):
+    match = re.search(rf"\b{word}\s+([^,.;]+)", caption)
+    return match.group(1) if match else ""
+
+
+def parse_colors(caption):
+    phrase = _phrase_after(normalize_query(caption), "màu")
+    colors = []
+    for color in COLORS:
+        if re.search(rf"(?<!\w){color}(?!\w)", phrase):
+            if not any(color in found for found in colors):
+                colors.append(color)
+    if any(color.startswith("xanh") for color in colors) and "xanh" not in colors:
+        colors.append("xanh")
+    return colors
+
+
+def parse_body_types(caption):
+    caption = normalize_query(caption)
+    phrase = _phrase_after(caption, "kiểu") or caption
+    return [body for body in BODY_TYPES if re.search(rf"(?<!\w){body}(?!\w)", phrase)]
+
+
+def brand_of(path, images_dir):
+    relpath = os.path.relpath(path, images_dir).replace('\\', '/')
+    return normalize_query(relpath.split('/')[0]) if '/' in relpath else None
+
+
+def _normalize_brand(name):
+    return normalize_query(name.replace('_', ' '))
+
+
+class AttributeIndex:
+    """
+    bitmaps[(thuộc tính, giá trị)] là mảng uint8 đã packbits, bit i ứng với dòng i của chỉ mục ảnh.
+    Bộ lọc là dict {thuộc tính: [giá trị, ...]}: OR giữa các giá trị của cùng thuộc tính,
+    AND giữa các thuộc tính.
+    """
+    def __init__(self, num_images, bitmaps, key=None):
+        self.num_images = num_images
+        self.bitmaps = bitmaps
+        self.key = key
+
+    def values(self, attribute):
+        return sorted(value for attr, value in self.bitmaps if attr == attribute)
+
+    def counts(self, attribute):
+        return {value: int(np.unpackbits(self.bitmaps[(attribute, value)], count=self.num_images).sum())
+                for value in self.values(attribute)}
+
+    def mask(self, filters):
+        """
+        Trả về bitmap (đã packbits) của các ảnh thoả bộ lọc.
+        """
+        result = np.full((self.num_images + 7) // 8, 0xFF, dtype=np.uint8)
+        for attribute, values in filters.items():
+            if attribute not in ATTRIBUTES:
+                raise ValueError(f"Thuộc tính không hợp lệ: {attribute}. Chọn một trong {ATTRIBUTES}")
+            if not values:
+                continue
+            union = np.zeros_like(result)
+            for value in values:
+                bitmap = self.bitmaps.get((attribute, normalize_query(value)))
+                if bitmap is not None:
+                    union |= bitmap
+            result &= union
+        return result
+
+    def candidates(self, filters):
+        """
+        Chỉ số các dòng thoả bộ lọc (LongTensor, tăng dần), hoặc None nếu không có bộ lọc nào.
+        """
+        if not filters or not any(filters.values()):
+            return None
+        rows = np.flatnonzero(np.unpackbits(self.mask(filters), count=self.num_images))
+        return torch.from_numpy(rows.astype(np.int64))
+
+    def match_brand(self, term):
+        term = _normalize_brand(term)
+        return [value for value in self.values("brand")
+                if _normalize_brand(value) == term or _normalize_brand(value).startswith(term + " ")]
+
+    def parse_query(self, query):
+        """
+        Tách câu truy vấn dạng "xe SUV + màu đỏ + Toyota" thành (câu văn bản, bộ lọc). Mỗi vế ngăn
+        bởi "+" khớp một giá trị thuộc tính ("màu ...", "kiểu ...", "hãng ..." hoặc đúng tên giá trị)
+        trở thành bộ lọc; các vế còn lại ghép thành câu văn bản. Nếu mọi vế đều là bộ lọc thì toàn bộ
+        câu vẫn được dùng làm văn bản truy vấn.
+        """
+        if "+" not in query:
+            return query, {}
+        filters, text_terms = {}, []
+        for term in (t.strip() for t in query.split("+")):
+            if not term:
+                continue
+            attribute, values = self._match_term(term)
+            if values:
+                filters.setdefault(attribute, [])
+                filters[attribute].extend(v for v in values if v not in filters[attribute])
+            else:
+                text_terms.append(term)
+        text = " ".join(text_terms) or " ".join(t.strip() for t in query.split("+"))
+        return text, filters
+
+    def _match_term(self, term):
+        term = normalize_query(term)
+        first, _, rest = term.partition(" ")
+        if first in _PREFIXES and rest:
+            attribute, term = _PREFIXES[first], rest
+            if attribute == "brand":
+                return attribute, self.match_brand(term)
+            return attribute, [term] if (attribute, term) in self.bitmaps else []
+        brands = self.match_brand(term)
+        if brands:
+            return "brand", brands
+        for attribute in ("body", "color"):
+            if (attribute, term) in self.bitmaps:
+                return attribute, [term]
+        return None, []
+
+    def save(self, path):
+        arrays = {f"{attr}={value}": bitmap for (attr, value), bitmap in self.bitmaps.items()}
+        meta = json.dumps({'version': ATTRIBUTE_VERSION, 'num_images': self.num_images, 'key': self.key})
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, __meta__=np.array(meta), **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data['__meta__']))
+            if meta.get('version') != ATTRIBUTE_VERSION:
+                return None
+            bitmaps = {tuple(name.split("=", 1)): data[name] for name in data.files if name != '__meta__'}
+        return cls(meta['num_images'], bitmaps, meta.get('key'))
+
+
+def build_attribute_index(image_paths, images_dir, metadata_csv=None, key=None):
+    """
+    Lập bitmap thuộc tính cho `image_paths` (theo đúng thứ tự dòng của chỉ mục embedding).
+    Ảnh có nhiều caption nhận hợp các thuộc tính; ảnh không có trong metadata chỉ có hãng.
+    """
+    columns = {}
+
+    def tag(attribute, value, row):
+        columns.setdefault((attribute, value), []).append(row)
+
+    row_of = {}
+    for row, path in enumerate(image_paths):
+        relpath = os.path.relpath(path, images_dir).replace('\\', '/')
+        row_of[relpath] = row
+        brand = brand_of(path, images_dir)
+        if brand:
+            tag("brand", brand, row)
+
+    if metadata_csv and os.path.exists(metadata_csv):
+        for filename, caption in load_caption_pairs(metadata_csv):
+            row = row_of.get(filename)
+            if row is None:
+                continue
+            for color in parse_colors(caption):
+                tag("color", color, row)
+            for body in parse_body_types(caption):
+                tag("body", body, row)
+
+    bitmaps = {}
+    for (attribute, value), rows in columns.items():
+        bits = np.zeros(len(image_paths), dtype=bool)
+        bits[rows] = True
+        bitmaps[(attribute, value)] = np.packbits(bits)
+    return AttributeIndex(len(image_paths), bitmaps, key)
+
+
+def load_or_build_attribute_index(index_dir, image_paths, images_dir, metadata_csv, index_version):
+    """
+    Dùng lại index_dir/attributes.npz nếu phiên bản chỉ mục ảnh và nội dung metadata.csv không đổi.
+    """
+    key = {'index_version': index_version,
+           'metadata_sha1': file_sha1(metadata_csv) if metadata_csv and os.path.exists(metadata_csv) else None}
+    path = os.path.join(index_dir, ATTRIBUTE_FILE)
+    if os.path.exists(path):
+        try:
+            attribute_index = AttributeIndex.load(path)
+        except (OSError, ValueError, KeyError):
+            attribute_index = None
+        if attribute_index is not None and attribute_index.key == key:
+            return attribute_index
+    attribute_index = build_attribute_index(image_paths, images_dir, metadata_csv, key)
+    os.makedirs(index_dir, exist_ok=True)
+    attribute_index.save(path)
+    return attribute_index
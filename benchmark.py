@@ -0,0 +1,267 @@
+# Tên file: benchmark.py
+# Bộ benchmark hiệu năng cho đường nóng lập chỉ mục và tìm kiếm:
+# - search: kho embedding ngẫu nhiên tổng hợp (10k..1M ảnh), đo thời gian dựng chỉ mục, độ trễ
+#           p50/p95/p99 của từng truy vấn, QPS khi nhiều luồng cùng truy vấn và bộ nhớ đỉnh. Mỗi cặp
+#           (kích thước, backend) chạy trong một tiến trình riêng để bộ nhớ đỉnh so sánh được giữa các dòng.
+# - index:  mã hoá một tập ảnh thật, đo số ảnh/giây và thời gian từng bước (decode, preprocess, encode).
+# - query:  truy vấn văn bản đầu-cuối trên chỉ mục thật (encode_text + search), hoặc qua server.py (--url).
+#
+#   python benchmark.py search --sizes 10000 100000 1000000 --backends exact int8 --concurrency 1 4
+#   python benchmark.py index --images_dir ./images --limit 500
+#   python benchmark.py query --images_dir ./images --metadata metadata.csv --concurrency 1 8
+
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+from image_index import (load_clip_model, load_or_build_index, list_image_paths, encode_images,
+                         DEFAULT_BATCH_SIZE, DEFAULT_NUM_WORKERS, DEFAULT_CHECKPOINT)
+from vector_index import build_vector_index, BACKENDS, SCORE_MODES, DEFAULT_SCORE_MODE
+from search_engine import search_images
+from latency import StageTimer, latency_summary, peak_rss_mb, current_rss_mb
+import search_client
+
+DEFAULT_SIZES = (10000, 100000)
+
+
+def synthetic_gallery(num_images, dim=512, seed=0, chunk_size=65536):
+    """
+    Kho embedding ngẫu nhiên đã chuẩn hoá (float32), sinh theo khối để không cần bộ nhớ tạm gấp đôi.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    features = torch.empty((num_images, dim))
+    for start in range(0, num_images, chunk_size):
+        chunk = torch.randn((min(chunk_size, num_images - start), dim), generator=generator)
+        features[start:start + len(chunk)] = chunk / chunk.norm(dim=-1, keepdim=True)
+    return features
+
+
+def synthetic_queries(gallery, num_queries, noise=0.5, seed=1):
+    """
+    Truy vấn là ảnh trong kho cộng nhiễu, để ANN có láng giềng thật sự gần như với câu truy vấn thật.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    rows = torch.randint(len(gallery), (num_queries,), generator=generator)
+    queries = gallery[rows] + noise * torch.randn((num_queries, gallery.shape[1]), generator=generator) \
+        / gallery.shape[1] ** 0.5
+    return queries / queries.norm(dim=-1, keepdim=True)
+
+
+def measure_latency(fn, inputs):
+    """
+    Gọi fn(x) tuần tự cho từng phần tử; trả về tóm tắt độ trễ (latency.latency_summary).
+    """
+    seconds = []
+    for x in inputs:
+        start = time.perf_counter()
+        fn(x)
+        seconds.append(time.perf_counter() - start)
+    return latency_summary(seconds)
+
+
+def measure_throughput(fn, inputs, concurrency, duration):
+    """
+    `concurrency` luồng liên tục gọi fn trên các phần tử của `inputs` (xoay vòng) trong `duration`
+    giây. Trả về QPS và độ trễ khi có tải.
+    """
+    deadline = time.perf_counter() + duration
+
+    def worker(offset):
+        seconds = []
+        i = offset
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            fn(inputs[i % len(inputs)])
+            seconds.append(time.perf_counter() - start)
+            i += concurrency
+        return seconds
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        seconds = [s for part in executor.map(worker, range(concurrency)) for s in part]
+    elapsed = time.perf_counter() - start
+    return dict(concurrency=concurrency, qps=len(seconds) / elapsed, **latency_summary(seconds))
+
+
+def format_row(name, summary):
+    return (f"{name:<28} n={summary['count']:<6} mean={summary['mean_ms']:8.2f}ms  p50={summary['p50_ms']:8.2f}ms  "
+            f"p95={summary['p95_ms']:8.2f}ms  p99={summary['p99_ms']:8.2f}ms"
+            + (f"  qps={summary['qps']:.1f}" if 'qps' in summary else ""))
+
+
+def _format_mb(value):
+    return "không rõ" if value is None else f"{value:.0f} MB"
+
+
+def _rss_delta(before, after):
+    return None if before is None or after is None else after - before
+
+
+def run_search_row(args, size, backend):
+    """
+    Một dòng của benchmark search: sinh kho ảnh, dựng chỉ mục `backend` và đo truy vấn. Chạy trong
+    tiến trình riêng (xem main_search) nên peak_rss_mb chỉ tính bộ nhớ của dòng này; index_rss_mb
+    là phần RSS tăng thêm khi dựng chỉ mục (ngoài ma trận embedding).
+    """
+    gallery = synthetic_gallery(size, args.dim, seed=args.seed)
+    queries = synthetic_queries(gallery, args.num_queries, seed=args.seed + 1)
+    if args.dtype == "float16":
+        gallery, queries = gallery.half(), queries.half()
+    timer = StageTimer(name=f"{backend}/{size}")
+    rss_before = current_rss_mb()
+    start = time.perf_counter()
+    index = build_vector_index(gallery, backend, timer=timer)
+    build_seconds = time.perf_counter() - start
+    index_rss_mb = _rss_delta(rss_before, current_rss_mb())
+    batches = [queries[i:i + args.batch_size] for i in range(0, len(queries), args.batch_size)]
+
+    def search(batch):
+        return index.search(batch, args.top_k, score_mode=args.score_mode)
+
+    search(batches[0])
+    timer.clear()
+    return {'backend': backend, 'num_images': size, 'dim': args.dim, 'dtype': args.dtype,
+            'batch_size': args.batch_size, 'build_seconds': build_seconds,
+            'latency': measure_latency(search, batches), 'stages': timer.summary(),
+            'throughput': [measure_throughput(search, batches, c, args.duration) for c in args.concurrency],
+            'index_rss_mb': index_rss_mb, 'peak_rss_mb': peak_rss_mb()}
+
+
+def main_search(args):
+    report = []
+    context = multiprocessing.get_context("spawn")
+    for size in args.sizes:
+        for backend in args.backends:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                row = executor.submit(run_search_row, args, size, backend).result()
+            print(f"\n{backend} / {size} ảnh: dựng chỉ mục {row['build_seconds']:.2f}s, "
+                  f"chỉ mục chiếm {_format_mb(row['index_rss_mb'])}, bộ nhớ đỉnh {_format_mb(row['peak_rss_mb'])}")
+            print(format_row("truy vấn tuần tự", row['latency']))
+            for name, summary in row['stages'].items():
+                print(format_row(f"  {name}", summary))
+            for summary in row['throughput']:
+                print(format_row(f"{summary['concurrency']} luồng", summary))
+            report.append(row)
+    return report
+
+
+def main_index(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model, preprocess = load_clip_model(args.checkpoint, device, args.model)
+    image_paths = list_image_paths(args.images_dir)[:args.limit]
+    # Chạy một batch trước để khởi động model (cấp phát bộ nhớ, chọn kernel) ngoài phép đo
+    encode_images(model, preprocess, image_paths[:args.batch_size], device, batch_size=args.batch_size, num_workers=0)
+
+    timer = StageTimer(device, name="index")
+    start = time.perf_counter()
+    _, valid_paths = encode_images(model, preprocess, image_paths, device, batch_size=args.batch_size,
+                                   num_workers=args.num_workers, timer=timer)
+    seconds = time.perf_counter() - start
+    report = {'num_images': len(valid_paths), 'seconds': seconds, 'images_per_sec': len(valid_paths) / seconds,
+              'batch_size': args.batch_size, 'num_workers': args.num_workers, 'device': device,
+              'stages': timer.summary(), 'peak_rss_mb': peak_rss_mb()}
+    print(f"Mã hoá {len(valid_paths)} ảnh trong {seconds:.2f}s: {report['images_per_sec']:.1f} ảnh/giây "
+          f"(batch {args.batch_size}, {args.num_workers} worker, {device}), bộ nhớ đỉnh {_format_mb(report['peak_rss_mb'])}")
+    for name, summary in report['stages'].items():
+        print(format_row(f"  {name} (mỗi batch)", summary))
+    return report
+
+
+def _load_queries(args):
+    if args.queries:
+        return args.queries
+    from eval_engine import load_caption_pairs
+    captions = sorted({caption for _, caption in load_caption_pairs(args.metadata)})
+    rng = np.random.default_rng(args.seed)
+    return [captions[i] for i in rng.permutation(len(captions))[:args.num_queries]]
+
+
+def main_query(args):
+    queries = _load_queries(args)
+    if args.url:
+        def search(query):
+            return search_client.search(args.url, query, args.top_k, args.score_mode)
+        timer = None
+    else:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model, preprocess = load_clip_model(args.checkpoint, device, args.model)
+        image_features, image_paths = load_or_build_index(model, preprocess, device, args.images_dir,
+                                                          args.index_dir, args.checkpoint, args.model)
+        timer = StageTimer(device, name="query")
+        index = build_vector_index(image_features, args.backend, timer=timer)
+
+        # Không dùng cache để mỗi truy vấn thực sự chạy encode_text và search
+        def search(query):
+            return search_images(query, model, device, index, image_paths, args.top_k,
+                                 score_mode=args.score_mode, timer=timer)
+        search(queries[0])
+        timer.clear()
+
+    report = {'num_queries': len(queries), 'url': args.url, 'backend': None if args.url else args.backend,
+              'latency': measure_latency(search, queries)}
+    report['stages'] = timer.summary() if timer is not None else {}
+    report['throughput'] = [measure_throughput(search, queries, c, args.duration) for c in args.concurrency]
+    report['peak_rss_mb'] = peak_rss_mb()
+    print(format_row("truy vấn tuần tự", report['latency']))
+    for name, summary in report['stages'].items():
+        print(format_row(f"  {name}", summary))
+    for summary in report['throughput']:
+        print(format_row(f"{summary['concurrency']} luồng", summary))
+    if args.url:
+        report['service'] = search_client.stats(args.url)
+    else:
+        print(f"Bộ nhớ đỉnh {_format_mb(report['peak_rss_mb'])}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark hiệu năng lập chỉ mục và tìm kiếm")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('search', help="Tìm kiếm trên kho embedding tổng hợp")
+    p.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES))
+    p.add_argument('--dim', type=int, default=512)
+    p.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'])
+    p.add_argument('--backends', type=str, nargs='+', default=['exact'], choices=BACKENDS)
+    p.add_argument('--num_queries', type=int, default=200)
+    p.add_argument('--batch_size', type=int, default=1, help="Số câu truy vấn mỗi lần gọi search")
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=main_search)
+
+    p = subparsers.add_parser('index', help="Mã hoá một tập ảnh thật")
+    p.add_argument('--images_dir', type=str, default='./images')
+    p.add_argument('--limit', type=int, default=500, help="Số ảnh tối đa dùng để đo")
+    p.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE)
+    p.add_argument('--num_workers', type=int, default=DEFAULT_NUM_WORKERS)
+    p.set_defaults(func=main_index)
+
+    p = subparsers.add_parser('query', help="Truy vấn văn bản đầu-cuối trên chỉ mục thật hoặc qua server.py")
+    p.add_argument('queries', nargs='*', help="Mặc định lấy ngẫu nhiên caption trong --metadata")
+    p.add_argument('--images_dir', type=str, default='./images')
+    p.add_argument('--index_dir', type=str, default='./index')
+    p.add_argument('--metadata', type=str, default='metadata.csv')
+    p.add_argument('--num_queries', type=int, default=200)
+    p.add_argument('--backend', type=str, default='exact', choices=BACKENDS)
+    p.add_argument('--url', type=str, default=None, help="Đo qua dịch vụ server.py thay vì gọi trực tiếp")
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=main_query)
+
+    for p in subparsers.choices.values():
+        p.add_argument('--checkpoint', type=str, default=DEFAULT_CHECKPOINT)
+        p.add_argument('--model', type=str, default='ViT-B/32')
+        p.add_argument('--top_k', type=int, default=10)
+        p.add_argument('--score_mode', type=str, default=DEFAULT_SCORE_MODE, choices=SCORE_MODES)
+        p.add_argument('--concurrency', type=int, nargs='+', default=[1, 4], help="Số luồng khi đo QPS")
+        p.add_argument('--duration', type=float, default=5.0, help="Số giây đo QPS cho mỗi mức concurrency")
+        p.add_argument('--output', type=str, default=None, help="Ghi kết quả ra file JSON")
+
+    args = parser.parse_args()
+    report = args.func(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'command': args.command, 'results': report}, f, ensure_ascii=False, indent=2)
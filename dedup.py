@@ -0,0 +1,196 @@
+# Tên file: dedup.py
+# Phát hiện ảnh gần trùng lặp trong kho ảnh dựa trên embedding của chỉ mục (image_index.py).
+# Mọi cặp ảnh có cosine >= ngưỡng được tìm bằng nhân ma trận theo khối trên nửa tam giác trên
+# (backend "exact"), hoặc bằng top-k của chỉ mục ANN/nén (ivf, hnsw, fp16, int8, pq) với kho ảnh lớn.
+# Các cặp được gom thành cụm; mỗi cụm giữ lại một ảnh. Có thể kiểm tra ảnh mới trước khi nhập kho.
+#
+#   python dedup.py --images_dir ./images --threshold 0.95 --output duplicates.json
+#   python dedup.py --images_dir ./images --check ./incoming          (ảnh mới trùng với kho)
+#   python dedup.py --images_dir ./images --move_to ./duplicates      (chuyển ảnh trùng ra khỏi kho)
+
+import os
+import json
+import time
+import shutil
+import argparse
+
+import numpy as np
+import torch
+
+from image_index import (load_clip_model, load_or_build_index, read_manifest, list_image_paths, encode_images,
+                         DEFAULT_BATCH_SIZE, DEFAULT_NUM_WORKERS, DEFAULT_CHECKPOINT)
+from vector_index import build_vector_index, BACKENDS
+
+DEFAULT_THRESHOLD = 0.95
+DEFAULT_BLOCK_SIZE = 4096
+
+
+def find_near_duplicates(features, threshold=DEFAULT_THRESHOLD, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Mọi cặp (i, j), i < j, có cosine >= threshold. features: tensor (N, D) đã chuẩn hoá.
+    Chỉ tính các khối (i, j) với khối j >= khối i, mỗi khối một phép nhân ma trận; bộ nhớ đỉnh là
+    block_size x block_size. Trả về (rows_i, rows_j, similarities) dạng numpy.
+    """
+    features = features.float()
+    num_images = features.shape[0]
+    found_i, found_j, found_sim = [], [], []
+    with torch.no_grad():
+        for start_i in range(0, num_images, block_size):
+            block_i = features[start_i:start_i + block_size]
+            for start_j in range(start_i, num_images, block_size):
+                similarity = block_i @ features[start_j:start_j + block_size].T
+                mask = similarity >= threshold
+                if start_i == start_j:
+                    mask = mask.triu(diagonal=1)
+                rows, cols = mask.nonzero(as_tuple=True)
+                if len(rows):
+                    found_i.append(rows + start_i)
+                    found_j.append(cols + start_j)
+                    found_sim.append(similarity[rows, cols])
+    if not found_i:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    return (torch.cat(found_i).cpu().numpy(), torch.cat(found_j).cpu().numpy(), torch.cat(found_sim).cpu().numpy())
+
+
+def find_near_duplicates_ann(vector_index, features, threshold=DEFAULT_THRESHOLD, k=10, batch_size=1024):
+    """
+    Như find_near_duplicates nhưng chỉ xét k láng giềng gần nhất của mỗi ảnh trong `vector_index`
+    (xấp xỉ: một ảnh có hơn k-1 bản trùng có thể sót cặp, nhưng cụm vẫn nối được qua các ảnh khác).
+    """
+    found_i, found_j, found_sim = [], [], []
+    for start in range(0, features.shape[0], batch_size):
+        similarity, indices = vector_index.search(features[start:start + batch_size], k + 1, score_mode="cosine")
+        rows = torch.arange(start, start + similarity.shape[0])[:, None].expand_as(indices)
+        mask = (similarity >= threshold) & (indices > rows)
+        found_i.append(rows[mask])
+        found_j.append(indices[mask])
+        found_sim.append(similarity[mask])
+    return (torch.cat(found_i).numpy(), torch.cat(found_j).numpy(), torch.cat(found_sim).float().numpy())
+
+
+def group_duplicates(num_images, rows_i, rows_j):
+    """
+    Gom các cặp trùng thành cụm (union-find). Trả về list cụm (list chỉ số tăng dần, >= 2 phần tử).
+    """
+    parent = np.arange(num_images)
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i, j in zip(rows_i.tolist(), rows_j.tolist()):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    clusters = {}
+    for row in sorted(set(rows_i.tolist()) | set(rows_j.tolist())):
+        clusters.setdefault(find(row), []).append(row)
+    return [rows for rows in clusters.values() if len(rows) > 1]
+
+
+def check_new_images(model, preprocess, device, new_paths, vector_index, image_paths, threshold=DEFAULT_THRESHOLD,
+                     **encode_kwargs):
+    """
+    Kiểm tra ảnh sắp nhập kho: ảnh trùng với kho hiện có (top-1 của vector_index) hoặc trùng với
+    một ảnh mới đứng trước nó. Trả về list (ảnh mới, ảnh đã có, cosine).
+    """
+    embeddings, valid_paths = encode_images(model, preprocess, new_paths, device, **encode_kwargs)
+    if not valid_paths:
+        return []
+    features = torch.from_numpy(embeddings)
+    similarity, indices = vector_index.search(features.to(device=device, dtype=model.dtype), 1, score_mode="cosine")
+    duplicates = {}
+    for path, value, j in zip(valid_paths, similarity[:, 0].tolist(), indices[:, 0].tolist()):
+        if j >= 0 and value >= threshold:
+            duplicates[path] = (image_paths[j], value)
+    rows_i, rows_j, sims = find_near_duplicates(features, threshold)
+    for i, j, value in zip(rows_i.tolist(), rows_j.tolist(), sims.tolist()):
+        if valid_paths[j] not in duplicates:
+            duplicates[valid_paths[j]] = (valid_paths[i], value)
+    return [(path, original, value) for path, (original, value) in duplicates.items()]
+
+
+def move_duplicates(clusters, image_paths, images_dir, target_dir):
+    """
+    Giữ ảnh đầu tiên (theo thứ tự chỉ mục) của mỗi cụm, chuyển các ảnh còn lại sang target_dir
+    (giữ cấu trúc thư mục). Lần refresh_index kế tiếp sẽ loại chúng khỏi chỉ mục.
+    """
+    moved = []
+    for rows in clusters:
+        for row in rows[1:]:
+            source = image_paths[row]
+            target = os.path.join(target_dir, os.path.relpath(source, images_dir))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.move(source, target)
+            moved.append(source)
+    return moved
+
+
+def main(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model, preprocess = load_clip_model(args.checkpoint, device, args.model)
+    image_features, image_paths = load_or_build_index(model, preprocess, device, args.images_dir,
+                                                      args.index_dir, args.checkpoint, args.model)
+    manifest = read_manifest(args.index_dir)
+    vector_index = build_vector_index(image_features, args.backend, index_dir=args.index_dir,
+                                      index_tag=manifest['generation'])
+
+    if args.check:
+        new_paths = list_image_paths(args.check)
+        duplicates = check_new_images(model, preprocess, device, new_paths, vector_index, image_paths,
+                                      args.threshold, batch_size=args.batch_size, num_workers=args.num_workers)
+        print(f"{len(duplicates)}/{len(new_paths)} ảnh mới trùng với ảnh đã có (cosine >= {args.threshold})")
+        for path, original, value in duplicates:
+            print(f"  {value:.4f}  {path}  ~  {original}")
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump([{'path': p, 'duplicate_of': o, 'cosine': v} for p, o, v in duplicates], f,
+                          ensure_ascii=False, indent=2)
+        return
+
+    start = time.time()
+    if args.backend == "exact":
+        rows_i, rows_j, sims = find_near_duplicates(image_features, args.threshold, args.block_size)
+    else:
+        rows_i, rows_j, sims = find_near_duplicates_ann(vector_index, image_features, args.threshold, args.k)
+    clusters = group_duplicates(len(image_paths), rows_i, rows_j)
+    removable = sum(len(rows) - 1 for rows in clusters)
+    print(f"{len(rows_i)} cặp gần trùng, {len(clusters)} cụm, có thể bỏ {removable}/{len(image_paths)} ảnh "
+          f"({time.time() - start:.1f}s)")
+
+    if args.output:
+        report = {
+            'threshold': args.threshold,
+            'pairs': [{'a': image_paths[i], 'b': image_paths[j], 'cosine': float(v)}
+                      for i, j, v in zip(rows_i.tolist(), rows_j.tolist(), sims.tolist())],
+            'clusters': [[image_paths[row] for row in rows] for rows in clusters],
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.move_to:
+        moved = move_duplicates(clusters, image_paths, args.images_dir, args.move_to)
+        print(f"Đã chuyển {len(moved)} ảnh trùng sang {args.move_to}; chạy lại image_index.py để thu gọn chỉ mục")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Phát hiện ảnh gần trùng lặp trong kho ảnh")
+    parser.add_argument('--images_dir', type=str, default='./images')
+    parser.add_argument('--checkpoint', type=str, default=DEFAULT_CHECKPOINT)
+    parser.add_argument('--model', type=str, default='ViT-B/32')
+    parser.add_argument('--index_dir', type=str, default='./index')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--backend', type=str, default='exact', choices=BACKENDS,
+                        help="exact: nhân ma trận theo khối (chính xác); backend khác: k láng giềng của chỉ mục")
+    parser.add_argument('--block_size', type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument('--k', type=int, default=10, help="Số láng giềng xét cho mỗi ảnh với backend ANN")
+    parser.add_argument('--check', type=str, default=None, help="Thư mục ảnh mới cần kiểm tra trước khi nhập kho")
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--num_workers', type=int, default=DEFAULT_NUM_WORKERS)
+    parser.add_argument('--output', type=str, default=None, help="Ghi danh sách cặp/cụm ra file JSON")
+    parser.add_argument('--move_to', type=str, default=None, help="Chuyển ảnh trùng (trừ một ảnh mỗi cụm) sang thư mục này")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,155 @@
+# Tên file: eval_engine.py
+# Đánh giá không cần giao diện: dùng các caption trong metadata.csv làm câu truy vấn, tính toàn bộ
+# ma trận tương đồng (truy vấn x kho) theo từng khối và báo cáo recall@k, mAP, median rank theo cả
+# hai chiều văn bản -> ảnh và ảnh -> văn bản. Kết quả in ra màn hình và có thể ghi ra JSON để
+# theo dõi hồi quy giữa các checkpoint.
+#
+#   python eval_engine.py --images_dir ./images --metadata metadata.csv --output eval.json
+
+import os
+import json
+import time
+import argparse
+
+import pandas as pd
+import torch
+
+from image_index import load_clip_model, load_or_build_index, DEFAULT_CHECKPOINT
+from search_engine import encode_texts
+from query_cache import normalize_query
+
+DEFAULT_KS = (1, 5, 10)
+
+
+def load_caption_pairs(metadata_csv, filename_col='filename', caption_col='caption'):
+    """
+    Đọc metadata.csv giống train.py; trả về list (filename, caption) với filename dạng "Audi/1.jpg".
+    """
+    df = pd.read_csv(metadata_csv, engine='python', on_bad_lines='warn')
+    df.columns = df.columns.str.strip().str.replace('\ufeff', '', regex=True)
+    if filename_col not in df.columns or caption_col not in df.columns:
+        raise ValueError(f"metadata.csv must contain columns '{filename_col}' and '{caption_col}'")
+    return [(str(f).replace('\\', '/'), str(c)) for f, c in df[[filename_col, caption_col]].dropna().values.tolist()]
+
+
+def build_ground_truth(image_paths, images_dir, pairs):
+    """
+    Ghép caption với ảnh trong chỉ mục. Các caption trùng nội dung được gộp thành một truy vấn;
+    ảnh liên quan của một caption là mọi ảnh mang caption đó.
+    Trả về (captions, text_to_image, image_to_text) với text_to_image[i] là list chỉ số ảnh của
+    caption i và image_to_text[j] là list chỉ số caption của ảnh j.
+    """
+    row_of = {os.path.relpath(p, images_dir).replace('\\', '/'): i for i, p in enumerate(image_paths)}
+    captions, caption_id = [], {}
+    text_to_image = []
+    image_to_text = [[] for _ in image_paths]
+    for filename, caption in pairs:
+        row = row_of.get(filename)
+        if row is None:
+            continue
+        key = normalize_query(caption)
+        if key not in caption_id:
+            caption_id[key] = len(captions)
+            captions.append(caption)
+            text_to_image.append([])
+        c = caption_id[key]
+        if row not in text_to_image[c]:
+            text_to_image[c].append(row)
+            image_to_text[row].append(c)
+    return captions, text_to_image, image_to_text
+
+
+def retrieval_metrics(query_features, gallery_features, relevant, ks=DEFAULT_KS, chunk_size=1024):
+    """
+    query_features (Q, D), gallery_features (N, D) đã chuẩn hoá; relevant[q] là list chỉ số trong
+    kho liên quan tới truy vấn q (truy vấn không có phần tử liên quan bị bỏ qua).
+    Mỗi khối `chunk_size` truy vấn được xử lý bằng một phép nhân ma trận và một lần sắp xếp.
+    """
+    query_ids = [q for q, rel in enumerate(relevant) if rel]
+    gallery_features = gallery_features.float()
+    num_gallery = gallery_features.shape[0]
+    first_ranks, average_precisions = [], []
+
+    with torch.no_grad():
+        for start in range(0, len(query_ids), chunk_size):
+            chunk = query_ids[start:start + chunk_size]
+            similarity = query_features[chunk].float() @ gallery_features.T
+
+            mask = torch.zeros((len(chunk), num_gallery), dtype=torch.bool)
+            rows = torch.tensor([r for r, q in enumerate(chunk) for _ in relevant[q]], dtype=torch.long)
+            cols = torch.tensor([g for q in chunk for g in relevant[q]], dtype=torch.long)
+            mask[rows, cols] = True
+
+            order = similarity.argsort(dim=-1, descending=True)
+            hits = mask.gather(-1, order).float()
+            positions = torch.arange(1, num_gallery + 1, dtype=torch.float32)
+            first_ranks.append(hits.argmax(dim=-1) + 1)
+            precision = hits.cumsum(dim=-1) / positions
+            average_precisions.append((precision * hits).sum(dim=-1) / hits.sum(dim=-1))
+
+    first_ranks = torch.cat(first_ranks).float()
+    metrics = {f"recall@{k}": float((first_ranks <= k).float().mean()) for k in ks}
+    metrics['mAP'] = float(torch.cat(average_precisions).mean())
+    metrics['median_rank'] = float(first_ranks.median())
+    metrics['num_queries'] = len(query_ids)
+    return metrics
+
+
+def evaluate_captions(model, device, image_features, image_paths, images_dir, metadata_csv,
+                      ks=DEFAULT_KS, chunk_size=1024, filename_col='filename', caption_col='caption'):
+    start = time.time()
+    pairs = load_caption_pairs(metadata_csv, filename_col, caption_col)
+    captions, text_to_image, image_to_text = build_ground_truth(image_paths, images_dir, pairs)
+    if not captions:
+        raise ValueError("Không caption nào trong metadata khớp với ảnh trong chỉ mục")
+
+    text_features = encode_texts(model, device, captions).float().cpu()
+    image_features = image_features.float().cpu()
+    return {
+        'num_images': len(image_paths),
+        'num_captions': len(captions),
+        'text_to_image': retrieval_metrics(text_features, image_features, text_to_image, ks, chunk_size),
+        'image_to_text': retrieval_metrics(image_features, text_features, image_to_text, ks, chunk_size),
+        'seconds': time.time() - start,
+    }
+
+
+def format_report(report):
+    lines = [f"{report['num_captions']} caption / {report['num_images']} ảnh ({report['seconds']:.1f}s)"]
+    for direction in ('text_to_image', 'image_to_text'):
+        metrics = report[direction]
+        lines.append(f"{direction:<14} " + "  ".join(
+            f"{k}={v:.4f}" if isinstance(v, float) else f"{k}={v}" for k, v in metrics.items()))
+    return "\n".join(lines)
+
+
+def main(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model, preprocess = load_clip_model(args.checkpoint, device, args.model)
+    image_features, image_paths = load_or_build_index(model, preprocess, device, args.images_dir,
+                                                      args.index_dir, args.checkpoint, args.model)
+    report = evaluate_captions(model, device, image_features, image_paths, args.images_dir, args.metadata,
+                               ks=args.k, chunk_size=args.chunk_size,
+                               filename_col=args.filename_col, caption_col=args.caption_col)
+    report['checkpoint'] = args.checkpoint
+    print(format_report(report))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Đánh giá truy xuất văn bản <-> ảnh trên metadata.csv")
+    parser.add_argument('--images_dir', type=str, default='./images')
+    parser.add_argument('--metadata', type=str, default='metadata.csv')
+    parser.add_argument('--filename_col', type=str, default='filename')
+    parser.add_argument('--caption_col', type=str, default='caption')
+    parser.add_argument('--checkpoint', type=str, default=DEFAULT_CHECKPOINT)
+    parser.add_argument('--model', type=str, default='ViT-B/32')
+    parser.add_argument('--index_dir', type=str, default='./index')
+    parser.add_argument('--k', type=int, nargs='+', default=list(DEFAULT_KS))
+    parser.add_argument('--chunk_size', type=int, default=1024)
+    parser.add_argument('--output', type=str, default=None, help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    main(args)
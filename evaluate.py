@@ -1,56 +1,41 @@
 # Tên file: evaluate.py
 import streamlit as st
-import os
 import torch
-from PIL import Image
-import clip
 import pandas as pd
 from pathlib import Path
 
+from image_index import load_clip_model, load_or_build_index, DEFAULT_CHECKPOINT
+from vector_index import ExactIndex
+from search_engine import search_many
+from eval_engine import evaluate_captions
+
 # --- CẤU HÌNH (Giống hệt file app.py) ---
 IMAGE_DIR = "D:/DoAn/images" 
-MODEL_PATH = "checkpoints/clip_best.pt"
+MODEL_PATH = DEFAULT_CHECKPOINT
+INDEX_DIR = "index"
+METADATA_PATH = "metadata.csv"
 
 # --- TẢI MODEL VÀ DỮ LIỆU (Tương tự file app.py) ---
 @st.cache_resource
 def load_model_and_index_images():
-    # ... (Sao chép y hệt hàm load_model_and_index_images từ file app.py của bạn) ...
     st.info("Bắt đầu tải model và lập chỉ mục cho kho ảnh...")
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    model, preprocess = clip.load('ViT-B/32', device=device, jit=False)
     try:
-        checkpoint = torch.load(MODEL_PATH, map_location=device)
-        model.load_state_dict(checkpoint['model_state_dict'])
+        model, preprocess = load_clip_model(MODEL_PATH, device)
     except Exception as e:
         st.error(f"Lỗi khi đọc file checkpoint: {e}")
         return None, None, None, None, None
-    image_paths = []
-    ground_truths = {}
-    for root, _, files in os.walk(IMAGE_DIR):
-        for file in files:
-            if file.lower().endswith((".jpg", ".jpeg", ".png")):
-                path = os.path.join(root, file)
-                image_paths.append(path)
-                # Lấy tên thư mục cha làm nhãn (ground truth)
-                ground_truths[path] = Path(path).parent.name
-    
-    if not image_paths:
-        st.error(f"Không tìm thấy file ảnh nào trong thư mục: {IMAGE_DIR}")
+
+    # Dùng chung chỉ mục trên đĩa với app.py thay vì mã hoá lại toàn bộ kho ảnh.
+    try:
+        image_features_tensor, image_paths = load_or_build_index(model, preprocess, device, IMAGE_DIR, INDEX_DIR, MODEL_PATH)
+    except (FileNotFoundError, ValueError) as e:
+        st.error(str(e))
         return None, None, None, None, None
 
-    all_image_features = []
-    # ... (Phần xử lý ảnh giữ nguyên như trong app.py) ...
-    for path in image_paths:
-        try:
-            img = Image.open(path).convert("RGB")
-            preprocessed_img = preprocess(img).unsqueeze(0).to(device)
-            with torch.no_grad():
-                feat = model.encode_image(preprocessed_img)
-                feat /= feat.norm(dim=-1, keepdim=True)
-            all_image_features.append(feat)
-        except Exception:
-            continue
-    image_features_tensor = torch.cat(all_image_features, dim=0)
+    # Lấy tên thư mục cha làm nhãn (ground truth); chỉ mục chỉ chứa ảnh đọc được
+    # nên nhãn luôn khớp từng dòng của image_features_tensor.
+    ground_truths = {path: Path(path).parent.name for path in image_paths}
     st.success(f"Đã tải model và lập chỉ mục thành công {len(image_paths)} ảnh!")
     return model, device, image_features_tensor, image_paths, ground_truths
 
@@ -59,25 +44,18 @@ def calculate_top_k_accuracy(model, device, image_features, image_paths, ground_
     # Lấy danh sách các nhãn duy nhất từ tên thư mục
     unique_labels = sorted(list(set(ground_truths.values())))
     
+    # Tạo câu truy vấn từ nhãn
+    queries = [f"a photo of a {label.replace('_', ' ')}" for label in unique_labels]
+
+    # Tìm kiếm tất cả câu truy vấn trong một batch
+    all_results = search_many(queries, model, device, ExactIndex(image_features), image_paths, k_value)
+
     hits = 0
     results_data = []
 
-    progress_bar = st.progress(0, text=f"Đang đánh giá {len(unique_labels)} nhãn...")
-
-    for i, label in enumerate(unique_labels):
-        # Tạo câu truy vấn từ nhãn
-        query = f"a photo of a {label.replace('_', ' ')}"
-        
-        # Tìm kiếm
-        with torch.no_grad():
-            text_input = clip.tokenize([query]).to(device)
-            text_features = model.encode_text(text_input)
-            text_features /= text_features.norm(dim=-1, keepdim=True)
-            similarity = (100.0 * text_features @ image_features.T).softmax(dim=-1)
-            _, indices = similarity[0].topk(k_value)
-        
+    for label, query, results in zip(unique_labels, queries, all_results):
         # Lấy K kết quả hàng đầu
-        top_k_paths = [image_paths[idx] for idx in indices]
+        top_k_paths = [path for path, _ in results]
         
         # Kiểm tra xem có "hit" hay không
         is_hit = False
@@ -93,10 +71,7 @@ def calculate_top_k_accuracy(model, device, image_features, image_paths, ground_
             "Dự đoán đúng?": "✅ Đúng" if is_hit else "❌ Sai",
             "Top K kết quả trả về": [Path(p).name for p in top_k_paths]
         })
-        
-        progress_bar.progress((i + 1) / len(unique_labels), text=f"Đang đánh giá nhãn: {label}")
     
-    progress_bar.empty()
     accuracy = (hits / len(unique_labels)) * 100
     return accuracy, pd.DataFrame(results_data)
 
@@ -129,4 +104,16 @@ if model:
         st.info(f"Trong tổng số {len(results_df)} nhãn, mô hình đã dự đoán đúng {int(accuracy/100*len(results_df))} nhãn.")
         
         st.header("Chi tiết từng truy vấn")
-        st.dataframe(results_df)
\ No newline at end of file
+        st.dataframe(results_df)
+
+    # Đánh giá đầy đủ trên caption của metadata.csv (cùng engine với lệnh python eval_engine.py)
+    if st.button("📑 Đánh giá truy xuất trên toàn bộ caption (recall@k, mAP)"):
+        with st.spinner("Đang tính toán ma trận tương đồng..."):
+            report = evaluate_captions(model, device, image_features, image_paths, IMAGE_DIR, METADATA_PATH)
+
+        st.header("Kết quả đánh giá theo caption")
+        st.caption(f"{report['num_captions']} caption, {report['num_images']} ảnh, {report['seconds']:.1f}s")
+        st.dataframe(pd.DataFrame({
+            "Văn bản → Ảnh": report['text_to_image'],
+            "Ảnh → Văn bản": report['image_to_text'],
+        }))
\ No newline at end of file
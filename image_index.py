@@ -0,0 +1,470 @@
+# Tên file: image_index.py
+# Lập chỉ mục embedding ảnh một lần và lưu ra đĩa (embeddings-<n>.npy + manifest.json)
+# để app.py, search.py và evaluate.py nạp lại bằng memory-map thay vì mã hoá lại cả kho ảnh.
+
+import os
+import json
+import time
+import hashlib
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from PIL import Image
+import clip
+
+from inference_model import is_inference_artifact, model_from_artifact
+from latency import StageTimer, maybe_stage
+from thumbnails import refresh_thumbnails, DEFAULT_THUMBNAIL_SIZE
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 2
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_NUM_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def default_checkpoint(checkpoint_dir="checkpoints"):
+    """
+    Trọng số mặc định của các chương trình tìm kiếm: ưu tiên file suy luận fp16 do train.py xuất ra
+    (nạp nhanh hơn checkpoint huấn luyện đầy đủ), nếu chưa có thì dùng clip_best.pt. Hai file cho
+    cùng một khoá chỉ mục (xem checkpoint_fingerprint) nên dùng lẫn không phải lập lại chỉ mục.
+    """
+    path = os.path.join(checkpoint_dir, "clip_best_fp16.pt")
+    return path if os.path.exists(path) else os.path.join(checkpoint_dir, "clip_best.pt")
+
+
+DEFAULT_CHECKPOINT = default_checkpoint()
+
+
+def load_clip_model(checkpoint_path, device, base_model='ViT-B/32'):
+    """
+    Tải kiến trúc CLIP gốc rồi nạp trọng số đã fine-tune từ checkpoint của train.py (checkpoint
+    huấn luyện đầy đủ hoặc file trọng số suy luận fp16 clip_best_fp16.pt). File xuất bằng
+    inference_model.py được nạp thẳng (memory-map), không qua clip.load.
+    """
+    checkpoint = torch.load(checkpoint_path, map_location="cpu", mmap=True)
+    if is_inference_artifact(checkpoint):
+        return model_from_artifact(checkpoint, device)
+    model, preprocess = clip.load(checkpoint.get('base_model', base_model), device=device, jit=False)
+    state_dict = checkpoint.get('model_state_dict', checkpoint)
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model, preprocess
+
+
+def list_image_paths(image_dir):
+    image_paths = [os.path.join(root, file) for root, _, files in os.walk(image_dir)
+                   for file in files if file.lower().endswith(IMAGE_EXTENSIONS)]
+    return sorted(image_paths)
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def describe_preprocess(preprocess):
+    """
+    Mô tả ổn định (không chứa địa chỉ bộ nhớ) của pipeline tiền xử lý, dùng làm một phần khoá chỉ mục.
+    """
+    steps = getattr(preprocess, 'transforms', [preprocess])
+    return [getattr(t, '__name__', None) or repr(t) for t in steps]
+
+
+def checkpoint_fingerprint(checkpoint_path, previous=None):
+    """
+    Trả về thông tin nhận dạng checkpoint. Nếu vẫn là file cũ (cùng đường dẫn, kích thước và mtime)
+    thì dùng lại sha1 đã lưu để không phải băm lại file trọng số vài trăm MB mỗi lần khởi động.
+    File suy luận có ghi checkpoint nguồn (clip_best_fp16.pt, inference_model.py) mang sha1 của
+    checkpoint nguồn, nên chỉ mục lập bằng file này hay bằng clip_best.pt là một.
+    """
+    st = os.stat(checkpoint_path)
+    info = {'path': os.path.abspath(checkpoint_path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if previous and all(previous.get(k) == info[k] for k in ('path', 'size', 'mtime_ns')) and previous.get('sha1'):
+        info['sha1'] = previous['sha1']
+        return info
+    source = _artifact_source(checkpoint_path)
+    info['sha1'] = source.get('sha1') or file_sha1(checkpoint_path)
+    return info
+
+
+def _artifact_source(checkpoint_path):
+    # torch.load với mmap chỉ đọc phần pickle nhỏ, không đọc trọng số
+    try:
+        checkpoint = torch.load(checkpoint_path, map_location="cpu", mmap=True)
+    except Exception:
+        return {}
+    return (checkpoint.get('source') or {}) if is_inference_artifact(checkpoint) else {}
+
+
+def make_index_key(checkpoint_sha1, base_model, preprocess_desc):
+    payload = json.dumps({'checkpoint': checkpoint_sha1, 'base_model': base_model,
+                          'preprocess': preprocess_desc}, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class ImagePathDataset(Dataset):
+    """
+    Đọc và tiền xử lý ảnh theo đường dẫn (chạy trong worker của DataLoader).
+    Ảnh lỗi trả về None để chỉ ảnh đó bị bỏ qua, không làm hỏng cả batch.
+    Mỗi phần tử kèm thời gian (decode, preprocess) tính bằng giây để đo từng bước.
+    """
+    def __init__(self, image_paths, preprocess):
+        self.image_paths = image_paths
+        self.preprocess = preprocess
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        path = self.image_paths[idx]
+        start = time.perf_counter()
+        try:
+            image = Image.open(path).convert("RGB")
+            decoded = time.perf_counter()
+            return idx, self.preprocess(image), (decoded - start, time.perf_counter() - decoded)
+        except Exception as e:
+            print(f"Bỏ qua ảnh lỗi {path}: {e}")
+            return idx, None, (time.perf_counter() - start, 0.0)
+
+
+def collate_valid_images(batch):
+    """
+    Gộp batch, bỏ ảnh lỗi. Trả về (indices, images, (tổng giây decode, tổng giây preprocess)).
+    """
+    seconds = tuple(map(sum, zip(*(timing for _, _, timing in batch))))
+    batch = [(idx, img) for idx, img, _ in batch if img is not None]
+    if not batch:
+        return [], None, seconds
+    indices, images = zip(*batch)
+    return list(indices), torch.stack(images, dim=0), seconds
+
+
+def encode_images(model, preprocess, image_paths, device, batch_size=DEFAULT_BATCH_SIZE,
+                  num_workers=DEFAULT_NUM_WORKERS, prefetch_factor=2, timer=None):
+    """
+    Mã hoá danh sách ảnh thành ma trận embedding đã chuẩn hoá (float32, trên CPU).
+    Giải mã/resize chạy song song trong `num_workers` tiến trình, tối đa
+    `num_workers * prefetch_factor` batch được nạp trước; model chạy theo batch `batch_size`.
+    Ảnh lỗi bị bỏ qua; trả về (embeddings, valid_paths).
+    Với `timer` (latency.StageTimer), mỗi batch ghi các bước "decode", "preprocess" (tổng thời gian
+    trong worker), "load" (thời gian chờ DataLoader) và "encode".
+    """
+    if not image_paths:
+        return np.zeros((0, 0), dtype=np.float32), []
+
+    num_workers = min(num_workers, len(image_paths))
+    loader_kwargs = {'prefetch_factor': prefetch_factor} if num_workers > 0 else {}
+    dataloader = DataLoader(ImagePathDataset(image_paths, preprocess),
+                            batch_size=batch_size,
+                            shuffle=False,
+                            num_workers=num_workers,
+                            collate_fn=collate_valid_images,
+                            pin_memory=str(device).startswith("cuda"),
+                            **loader_kwargs)
+
+    all_image_features = []
+    valid_paths = []
+    with torch.no_grad():
+        batches = iter(dataloader)
+        while True:
+            with maybe_stage(timer, "load"):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            indices, images, (decode_seconds, preprocess_seconds) = batch
+            if timer is not None:
+                timer.record("decode", decode_seconds)
+                timer.record("preprocess", preprocess_seconds)
+            if images is None:
+                continue
+            with maybe_stage(timer, "encode"):
+                feat = model.encode_image(images.to(device, non_blocking=True))
+                feat /= feat.norm(dim=-1, keepdim=True)
+                all_image_features.append(feat.float().cpu())
+            valid_paths.extend(image_paths[i] for i in indices)
+
+    if not all_image_features:
+        return np.zeros((0, 0), dtype=np.float32), valid_paths
+    return torch.cat(all_image_features, dim=0).numpy(), valid_paths
+
+
+def _atomic_write_json(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _atomic_save_npy(path, array):
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, np.ascontiguousarray(array, dtype=np.float32))
+    os.replace(tmp_path, path)
+
+
+def read_manifest(index_dir):
+    manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_index(index_dir, embeddings, image_paths, manifest):
+    os.makedirs(index_dir, exist_ok=True)
+    # Mỗi lần ghi dùng một file ma trận mới (theo generation) rồi mới đổi manifest, để tiến trình
+    # khác đang memory-map ma trận cũ không bị ảnh hưởng (và không bị khoá file trên Windows).
+    previous = read_manifest(index_dir)
+    generation = previous.get('generation', 0) + 1 if previous else 1
+    embeddings_file = f"embeddings-{generation}.npy"
+    _atomic_save_npy(os.path.join(index_dir, embeddings_file), embeddings)
+    manifest = dict(manifest, version=MANIFEST_VERSION, generation=generation, embeddings_file=embeddings_file,
+                    paths=list(image_paths), count=int(embeddings.shape[0]),
+                    dim=int(embeddings.shape[1]) if embeddings.ndim == 2 else 0)
+    _atomic_write_json(os.path.join(index_dir, MANIFEST_FILE), manifest)
+
+    if previous and previous.get('embeddings_file') not in (None, embeddings_file):
+        try:
+            os.remove(os.path.join(index_dir, previous['embeddings_file']))
+        except OSError:
+            pass
+    return manifest
+
+
+def load_index(index_dir, manifest=None):
+    """
+    Nạp chỉ mục đã lưu dưới dạng memory-map (copy-on-write) nên gần như tức thời.
+    Trả về (embeddings, paths, manifest) hoặc None nếu chưa có chỉ mục hợp lệ.
+    """
+    manifest = manifest or read_manifest(index_dir)
+    if manifest is None:
+        return None
+    embeddings_path = os.path.join(index_dir, manifest.get('embeddings_file', ''))
+    if not os.path.isfile(embeddings_path):
+        return None
+    embeddings = np.load(embeddings_path, mmap_mode='c')
+    if embeddings.shape[0] != len(manifest['paths']):
+        return None
+    return embeddings, manifest['paths'], manifest
+
+
+def file_state(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def _same_stat(a, b):
+    return a['size'] == b.get('size') and a['mtime_ns'] == b.get('mtime_ns')
+
+
+def refresh_index(model, preprocess, device, image_dir, index_dir, checkpoint_path, base_model='ViT-B/32',
+                  full=False, batch_size=DEFAULT_BATCH_SIZE, num_workers=DEFAULT_NUM_WORKERS, path_filter=None,
+                  timer=None, thumbnail_size=DEFAULT_THUMBNAIL_SIZE):
+    """
+    Đồng bộ chỉ mục với thư mục ảnh: chỉ mã hoá ảnh mới hoặc đã thay đổi, bỏ ảnh đã xoá và
+    nén lại ma trận embedding. Ảnh được coi là không đổi nếu kích thước + mtime giữ nguyên, hoặc
+    nếu chúng đổi nhưng sha1 nội dung vẫn như cũ. Khi khoá chỉ mục khác (đổi checkpoint/tiền xử lý)
+    hoặc `full=True` thì toàn bộ kho ảnh được mã hoá lại. `path_filter(path)` (tuỳ chọn) chỉ giữ
+    một phần ảnh của thư mục, dùng cho chỉ mục theo shard (sharded_search.py). `timer` xem encode_images.
+    Cache thumbnail cho app.py (thumbnails.py) được cập nhật cùng lúc; thumbnail_size=None để tắt.
+    Trả về (embeddings, paths, manifest, report).
+    """
+    start = time.time()
+    image_paths = list_image_paths(image_dir)
+    if path_filter is not None:
+        image_paths = [path for path in image_paths if path_filter(path)]
+    if not image_paths:
+        raise FileNotFoundError(f"Không tìm thấy file ảnh nào trong thư mục: {image_dir}")
+
+    previous = read_manifest(index_dir)
+    checkpoint = checkpoint_fingerprint(checkpoint_path, previous.get('checkpoint') if previous else None)
+    preprocess_desc = describe_preprocess(preprocess)
+    key = make_index_key(checkpoint['sha1'], base_model, preprocess_desc)
+
+    loaded = None
+    if not full and previous is not None and previous.get('key') == key \
+            and previous.get('image_dir') == os.path.abspath(image_dir):
+        loaded = load_index(index_dir, previous)
+    if loaded is not None:
+        old_embeddings, old_paths, _ = loaded
+        prev_files, prev_failed = previous.get('files', {}), previous.get('failed', {})
+    else:
+        old_embeddings, old_paths = None, []
+        prev_files, prev_failed = {}, {}
+    row_of = {path: i for i, path in enumerate(old_paths)}
+
+    files, failed = {}, {}
+    keep_rows, keep_paths = [], []
+    added, modified, to_encode = [], [], []
+    for path in image_paths:
+        state = file_state(path)
+        prev = prev_files.get(path) or prev_failed.get(path)
+        if prev is not None and not _same_stat(state, prev):
+            state['sha1'] = file_sha1(path)
+        elif prev is not None:
+            state['sha1'] = prev.get('sha1')
+
+        if prev is None:
+            added.append(path)
+            to_encode.append((path, state))
+        elif state['sha1'] != prev.get('sha1'):
+            modified.append(path)
+            to_encode.append((path, state))
+        elif path in prev_files:
+            keep_rows.append(row_of[path])
+            keep_paths.append(path)
+            files[path] = state
+        else:
+            # Ảnh lỗi từ lần trước và chưa thay đổi: không thử lại.
+            failed[path] = state
+
+    current = set(image_paths)
+    removed = [path for path in list(prev_files) + list(prev_failed) if path not in current]
+
+    report = {
+        'added': added, 'modified': modified, 'removed': removed, 'failed': [],
+        'unchanged': len(keep_paths), 'full_rebuild': loaded is None,
+    }
+    if loaded is not None and not to_encode and not removed:
+        if thumbnail_size:
+            report['thumbnails'] = refresh_thumbnails(index_dir, prev_files, thumbnail_size, changed=[],
+                                                      num_workers=num_workers)
+        report['seconds'] = time.time() - start
+        print(f"Chỉ mục {index_dir} đã cập nhật ({len(old_paths)} ảnh), không có thay đổi.")
+        return old_embeddings, old_paths, previous, report
+
+    encode_start = time.time()
+    new_embeddings, new_paths = encode_images(model, preprocess, [path for path, _ in to_encode], device,
+                                              batch_size=batch_size, num_workers=num_workers, timer=timer)
+    report['encode_seconds'] = time.time() - encode_start
+    encoded = set(new_paths)
+    for path, state in to_encode:
+        if state.get('sha1') is None:
+            state['sha1'] = file_sha1(path)
+        if path in encoded:
+            files[path] = state
+        else:
+            failed[path] = state
+            report['failed'].append(path)
+
+    parts = []
+    if keep_rows:
+        parts.append(np.asarray(old_embeddings[keep_rows], dtype=np.float32))
+    if new_paths:
+        parts.append(new_embeddings)
+    if not parts:
+        raise ValueError("Không thể xử lý bất kỳ ảnh nào. Vui lòng kiểm tra định dạng ảnh.")
+    embeddings = np.concatenate(parts, axis=0)
+    paths = keep_paths + new_paths
+    del old_embeddings, loaded
+
+    manifest = save_index(index_dir, embeddings, paths, {
+        'key': key,
+        'checkpoint': checkpoint,
+        'base_model': base_model,
+        'preprocess': preprocess_desc,
+        'image_dir': os.path.abspath(image_dir),
+        'created_at': time.time(),
+        'files': files,
+        'failed': failed,
+    })
+    if thumbnail_size:
+        stale = [prev_files[path]['sha1'] for path in removed + modified
+                 if prev_files.get(path, {}).get('sha1')]
+        report['thumbnails'] = refresh_thumbnails(
+            index_dir, files, thumbnail_size, changed=None if report['full_rebuild'] else added + modified,
+            stale=stale, num_workers=num_workers)
+    report['seconds'] = time.time() - start
+    print(format_refresh_report(report, len(paths), index_dir))
+    return embeddings, paths, manifest, report
+
+
+def format_refresh_report(report, total, index_dir):
+    kind = "Lập chỉ mục mới" if report['full_rebuild'] else "Cập nhật chỉ mục"
+    line = (f"{kind} {index_dir}: {total} ảnh (thêm {len(report['added'])}, sửa {len(report['modified'])}, "
+            f"xoá {len(report['removed'])}, lỗi {len(report['failed'])}, giữ nguyên {report['unchanged']}) "
+            f"trong {report['seconds']:.1f}s{_throughput(report)}")
+    thumbnails = report.get('thumbnails')
+    if thumbnails and (thumbnails['created'] or thumbnails['removed']):
+        line += f"; thumbnail: tạo {thumbnails['created']}, xoá {thumbnails['removed']}"
+    return line
+
+
+def _throughput(report):
+    encoded = len(report['added']) + len(report['modified']) - len(report['failed'])
+    if not encoded or not report.get('encode_seconds'):
+        return ""
+    return f", mã hoá {encoded / report['encode_seconds']:.1f} ảnh/giây"
+
+
+def build_index(model, preprocess, device, image_dir, index_dir, checkpoint_path, base_model='ViT-B/32',
+                **encode_kwargs):
+    embeddings, paths, manifest, _ = refresh_index(model, preprocess, device, image_dir, index_dir,
+                                                   checkpoint_path, base_model, full=True, **encode_kwargs)
+    return embeddings, paths, manifest
+
+
+def load_or_build_index(model, preprocess, device, image_dir, index_dir, checkpoint_path, base_model='ViT-B/32',
+                        refresh=False, **encode_kwargs):
+    """
+    Nạp thẳng chỉ mục trên đĩa nếu khoá (checkpoint + model gốc + tiền xử lý) và thư mục ảnh khớp,
+    không duyệt lại thư mục ảnh; việc đồng bộ ảnh mới/sửa/xoá dành cho image_index.py hoặc khi
+    `refresh=True`. Chưa có chỉ mục hợp lệ thì lập mới bằng refresh_index. Trả về
+    (image_features, image_paths) với image_features là tensor trên `device` cùng dtype với model.
+    """
+    loaded = None
+    previous = read_manifest(index_dir)
+    if not refresh and not encode_kwargs.get('full') and previous is not None \
+            and previous.get('image_dir') == os.path.abspath(image_dir):
+        checkpoint = checkpoint_fingerprint(checkpoint_path, previous.get('checkpoint'))
+        key = make_index_key(checkpoint['sha1'], base_model, describe_preprocess(preprocess))
+        if previous.get('key') == key:
+            loaded = load_index(index_dir, previous)
+    if loaded is not None:
+        embeddings, image_paths, _ = loaded
+        print(f"Đã nạp chỉ mục {index_dir} ({len(image_paths)} ảnh); chạy image_index.py để cập nhật ảnh mới.")
+    else:
+        embeddings, image_paths, _, _ = refresh_index(model, preprocess, device, image_dir, index_dir,
+                                                      checkpoint_path, base_model, **encode_kwargs)
+    image_features = torch.from_numpy(embeddings).to(device=device, dtype=model.dtype)
+    return image_features, image_paths
+
+
+def main(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model, preprocess = load_clip_model(args.checkpoint, device, args.model)
+    timer = StageTimer(device, name="index") if args.profile else None
+    refresh_index(model, preprocess, device, args.images_dir, args.index_dir, args.checkpoint, args.model,
+                  full=args.full, batch_size=args.batch_size, num_workers=args.num_workers, timer=timer,
+                  thumbnail_size=args.thumbnail_size or None)
+    if timer is not None:
+        print(timer.format())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lập chỉ mục embedding cho kho ảnh")
+    parser.add_argument('--images_dir', type=str, default='./images')
+    parser.add_argument('--checkpoint', type=str, default=DEFAULT_CHECKPOINT)
+    parser.add_argument('--model', type=str, default='ViT-B/32')
+    parser.add_argument('--index_dir', type=str, default='./index')
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--num_workers', type=int, default=DEFAULT_NUM_WORKERS)
+    parser.add_argument('--full', action='store_true', help="Mã hoá lại toàn bộ kho ảnh thay vì chỉ phần thay đổi")
+    parser.add_argument('--thumbnail_size', type=int, default=DEFAULT_THUMBNAIL_SIZE,
+                        help="Cạnh dài của thumbnail cho app.py (0 để không tạo thumbnail)")
+    parser.add_argument('--profile', action='store_true',
+                        help="In thời gian từng bước (decode, preprocess, load, encode) cho mỗi batch")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,275 @@
+# Tên file: inference_model.py
+# File trọng số suy luận gọn cho CLIP: chỉ gồm cấu hình kiến trúc và trọng số (fp16 mặc định),
+# không có optimizer và không cần nạp lại trọng số OpenAI gốc bằng clip.load. Khi nạp, file được
+# memory-map và trọng số được gán thẳng vào model dựng trên thiết bị "meta", nên worker khởi động
+# rất nhanh. Có thể chỉ nạp tháp văn bản (worker chỉ xử lý câu truy vấn) hoặc chỉ tháp ảnh.
+#
+#   python inference_model.py --checkpoint checkpoints/clip_best.pt --output checkpoints/clip_infer.pt
+#   python inference_model.py ... --torchscript --onnx     (xuất thêm text/visual dạng .ts/.onnx)
+
+import os
+import time
+import argparse
+
+import torch
+from torch import nn
+from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize, InterpolationMode
+from clip.model import Transformer, VisionTransformer, ModifiedResNet, LayerNorm
+
+INFERENCE_FORMAT = "clip-inference"
+INFERENCE_VERSION = 1
+TOWERS = ("text", "visual")
+
+
+def _convert_image_to_rgb(image):
+    return image.convert("RGB")
+
+
+def build_preprocess(n_px):
+    # Giống hệt clip.load (kể cả tên từng bước) để khoá chỉ mục của image_index không đổi
+    return Compose([
+        Resize(n_px, interpolation=InterpolationMode.BICUBIC),
+        CenterCrop(n_px),
+        _convert_image_to_rgb,
+        ToTensor(),
+        Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)),
+    ])
+
+
+def _causal_mask(context_length):
+    return torch.full((context_length, context_length), float("-inf")).triu_(1)
+
+
+def model_config(model):
+    """
+    Cấu hình kiến trúc đọc từ model CLIP đã dựng (không đoán từ state_dict).
+    """
+    visual = model.visual
+    if isinstance(visual, VisionTransformer):
+        vision = {'type': 'vit', 'input_resolution': visual.input_resolution,
+                  'patch_size': visual.conv1.kernel_size[0], 'width': visual.conv1.out_channels,
+                  'layers': visual.transformer.layers, 'heads': visual.transformer.resblocks[0].attn.num_heads,
+                  'output_dim': visual.output_dim}
+    else:
+        vision = {'type': 'resnet', 'input_resolution': visual.input_resolution,
+                  'layers': [len(getattr(visual, f"layer{i}")) for i in range(1, 5)],
+                  'width': visual.conv1.out_channels * 2, 'heads': visual.attnpool.num_heads,
+                  'output_dim': visual.output_dim}
+    text = {'context_length': model.context_length, 'vocab_size': model.vocab_size,
+            'width': model.transformer.width, 'layers': model.transformer.layers,
+            'heads': model.transformer.resblocks[0].attn.num_heads,
+            'embed_dim': model.text_projection.shape[1]}
+    return {'vision': vision, 'text': text}
+
+
+class InferenceCLIP(nn.Module):
+    """
+    CLIP chỉ dùng để suy luận, dựng từ cấu hình của file trọng số suy luận. Tên tham số trùng với
+    clip.model.CLIP nên state_dict dùng chung được. Tháp không được nạp thì bằng None.
+    """
+    def __init__(self, config, towers=TOWERS, attn_mask=None):
+        super().__init__()
+        self.towers = tuple(towers)
+        vision, text = config['vision'], config['text']
+        self.input_resolution = vision['input_resolution']
+        self.context_length = text['context_length']
+        self.vocab_size = text['vocab_size']
+
+        self.visual = None
+        if "visual" in self.towers:
+            if vision['type'] == 'vit':
+                self.visual = VisionTransformer(vision['input_resolution'], vision['patch_size'], vision['width'],
+                                                vision['layers'], vision['heads'], vision['output_dim'])
+            else:
+                self.visual = ModifiedResNet(tuple(vision['layers']), vision['output_dim'], vision['heads'],
+                                             vision['input_resolution'], vision['width'])
+
+        self.transformer = None
+        if "text" in self.towers:
+            if attn_mask is None:
+                attn_mask = _causal_mask(self.context_length)
+            self.transformer = Transformer(text['width'], text['layers'], text['heads'], attn_mask=attn_mask)
+            self.token_embedding = nn.Embedding(text['vocab_size'], text['width'])
+            self.positional_embedding = nn.Parameter(torch.empty(self.context_length, text['width']))
+            self.ln_final = LayerNorm(text['width'])
+            self.text_projection = nn.Parameter(torch.empty(text['width'], text['embed_dim']))
+        self.logit_scale = nn.Parameter(torch.empty([]))
+
+    @property
+    def dtype(self):
+        if self.visual is not None:
+            return self.visual.conv1.weight.dtype
+        return self.token_embedding.weight.dtype
+
+    def encode_image(self, image):
+        if self.visual is None:
+            raise RuntimeError("Model được nạp không có tháp ảnh (towers=%s)" % (self.towers,))
+        return self.visual(image.type(self.dtype))
+
+    def encode_text(self, text):
+        if self.transformer is None:
+            raise RuntimeError("Model được nạp không có tháp văn bản (towers=%s)" % (self.towers,))
+        n_ctx = text.shape[-1]
+        x = self.token_embedding(text).type(self.dtype)
+        x = x + self.positional_embedding[:n_ctx].type(self.dtype)
+        x = x.permute(1, 0, 2)
+        x = self.transformer(x)
+        x = x.permute(1, 0, 2)
+        x = self.ln_final(x).type(self.dtype)
+        return x[torch.arange(x.shape[0]), text.argmax(dim=-1)] @ self.text_projection
+
+
+def _tower_of(key):
+    if key.startswith("visual."):
+        return "visual"
+    if key == "logit_scale":
+        return None
+    return "text"
+
+
+def make_inference_artifact(model, base_model, dtype=torch.float16, source=None):
+    """
+    Nội dung file trọng số suy luận. Vẫn có khoá model_state_dict nên các đoạn mã nạp checkpoint
+    cũ (clip.load + load_state_dict) đọc được.
+    """
+    state_dict = {k: v.detach().to("cpu", dtype=dtype if v.is_floating_point() else v.dtype).contiguous()
+                  for k, v in model.state_dict().items()}
+    return {
+        'format': INFERENCE_FORMAT,
+        'version': INFERENCE_VERSION,
+        'base_model': base_model,
+        'dtype': str(dtype).replace("torch.", ""),
+        'config': model_config(model),
+        'source': source or {},
+        'model_state_dict': state_dict,
+    }
+
+
+def is_inference_artifact(checkpoint):
+    return isinstance(checkpoint, dict) and checkpoint.get('format') == INFERENCE_FORMAT
+
+
+def model_from_artifact(artifact, device, towers=TOWERS):
+    """
+    Dựng InferenceCLIP trên thiết bị "meta" (không cấp phát, không khởi tạo ngẫu nhiên) rồi gán
+    thẳng các tensor của artifact vào. Trên CPU model chạy fp32 giống clip.load; nếu artifact đã là
+    fp32 thì tensor memory-map được dùng trực tiếp, không sao chép.
+    """
+    towers = tuple(towers)
+    attn_mask = _causal_mask(artifact['config']['text']['context_length']) if "text" in towers else None
+    with torch.device("meta"):
+        model = InferenceCLIP(artifact['config'], towers, attn_mask=attn_mask)
+    state_dict = {k: v for k, v in artifact['model_state_dict'].items()
+                  if _tower_of(k) is None or _tower_of(k) in towers}
+    model.load_state_dict(state_dict, assign=True)
+    if str(device) == "cpu":
+        model = model.float()
+    model = model.to(device).eval()
+    return model, build_preprocess(model.input_resolution)
+
+
+def load_inference_model(path, device, towers=TOWERS):
+    """
+    Nạp file trọng số suy luận (memory-map). Trả về (model, preprocess) như image_index.load_clip_model.
+    """
+    artifact = torch.load(path, map_location="cpu", mmap=True)
+    if not is_inference_artifact(artifact):
+        raise ValueError(f"{path} không phải file trọng số suy luận (hãy xuất bằng inference_model.py)")
+    return model_from_artifact(artifact, device, towers)
+
+
+class _TextEncoder(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, text):
+        return self.model.encode_text(text)
+
+
+class _ImageEncoder(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image):
+        return self.model.encode_image(image)
+
+
+def _example_inputs(model):
+    tokens = torch.zeros((2, model.context_length), dtype=torch.long)
+    tokens[:, 0] = 1
+    tokens[:, 1] = 2
+    resolution = model.visual.input_resolution
+    images = torch.zeros((2, 3, resolution, resolution))
+    return {'text': (_TextEncoder(model), tokens), 'visual': (_ImageEncoder(model), images)}
+
+
+def export_torchscript(model, output_prefix):
+    """
+    Trace riêng từng tháp thành <prefix>.text.ts và <prefix>.visual.ts; nạp lại bằng torch.jit.load
+    mà không cần gói clip.
+    """
+    paths = []
+    with torch.no_grad():
+        for tower, (module, example) in _example_inputs(model).items():
+            path = f"{output_prefix}.{tower}.ts"
+            torch.jit.trace(module, example).save(path)
+            paths.append(path)
+    return paths
+
+
+def export_onnx(model, output_prefix):
+    try:
+        import onnx  # noqa: F401
+    except ImportError as e:
+        raise RuntimeError("Xuất ONNX cần cài gói onnx (pip install onnx)") from e
+    paths = []
+    with torch.no_grad():
+        for tower, (module, example) in _example_inputs(model).items():
+            path = f"{output_prefix}.{tower}.onnx"
+            input_name = 'tokens' if tower == "text" else 'images'
+            torch.onnx.export(module, (example,), path, input_names=[input_name], output_names=['features'],
+                              dynamic_axes={input_name: {0: 'batch'}, 'features': {0: 'batch'}})
+            paths.append(path)
+    return paths
+
+
+def main(args):
+    from image_index import load_clip_model, file_sha1
+
+    model, _ = load_clip_model(args.checkpoint, "cpu", args.model)
+    dtype = torch.float16 if args.dtype == "float16" else torch.float32
+    artifact = make_inference_artifact(model, args.model, dtype,
+                                       source={'checkpoint': os.path.abspath(args.checkpoint),
+                                               'sha1': file_sha1(args.checkpoint)})
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    tmp_path = args.output + ".tmp"
+    torch.save(artifact, tmp_path)
+    os.replace(tmp_path, args.output)
+    print(f"Đã xuất {args.output} ({os.path.getsize(args.output) / 2 ** 20:.1f} MB, {args.dtype})")
+
+    start = time.time()
+    load_inference_model(args.output, "cpu", towers=("text",))
+    print(f"Nạp lại tháp văn bản từ file mới: {time.time() - start:.2f}s")
+
+    prefix = os.path.splitext(args.output)[0]
+    model = model.float().eval()
+    if args.torchscript:
+        print("TorchScript:", ", ".join(export_torchscript(model, prefix)))
+    if args.onnx:
+        print("ONNX:", ", ".join(export_onnx(model, prefix)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Xuất file trọng số suy luận gọn cho CLIP")
+    parser.add_argument('--checkpoint', type=str, default='checkpoints/clip_best.pt')
+    parser.add_argument('--model', type=str, default='ViT-B/32')
+    parser.add_argument('--output', type=str, default='checkpoints/clip_infer.pt')
+    parser.add_argument('--dtype', type=str, default='float16', choices=['float16', 'float32'],
+                        help="float32 cho server CPU (memory-map trực tiếp, không phải đổi kiểu khi nạp)")
+    parser.add_argument('--torchscript', action='store_true', help="Xuất thêm text/visual dạng TorchScript")
+    parser.add_argument('--onnx', action='store_true', help="Xuất thêm text/visual dạng ONNX (cần gói onnx)")
+    args = parser.parse_args()
+
+    main(args)
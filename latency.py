@@ -0,0 +1,156 @@
+# Tên file: latency.py
+# Đo độ trễ theo từng bước của đường nóng lập chỉ mục / tìm kiếm (decode, preprocess, encode,
+# similarity, topk, ...): giữ các mẫu gần nhất của mỗi bước, tính p50/p95/p99 và in định kỳ ra log.
+# Dùng chung cho image_index.py, search_engine.py, server.py, app.py và benchmark.py.
+
+import os
+import sys
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+PERCENTILES = (50, 95, 99)
+
+
+def latency_summary(seconds, percentiles=PERCENTILES):
+    """
+    Tóm tắt một dãy thời gian (giây) thành count, mean và các phân vị, đơn vị mili giây.
+    """
+    samples = np.asarray(seconds, dtype=np.float64) * 1000.0
+    if samples.size == 0:
+        return {'count': 0}
+    summary = {'count': int(samples.size), 'mean_ms': float(samples.mean())}
+    for q, value in zip(percentiles, np.percentile(samples, percentiles)):
+        summary[f'p{q}_ms'] = float(value)
+    return summary
+
+
+def current_rss_mb():
+    """
+    Bộ nhớ thường trú hiện tại của tiến trình (MB), hoặc None nếu không đọc được trên hệ điều hành này.
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2 ** 20
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_mb():
+    """
+    Bộ nhớ thường trú lớn nhất từ đầu tiến trình (MB), hoặc None nếu không đọc được trên hệ điều hành
+    này. Giá trị chỉ tăng nên muốn so sánh nhiều phép đo thì mỗi phép đo chạy trong tiến trình riêng.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux trả về KB, macOS trả về byte
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 2 ** 20
+    return None
+
+
+class StageTimer:
+    """
+    Bộ đếm thời gian theo bước, an toàn khi nhiều luồng dùng chung. Mỗi bước giữ tối đa
+    `max_samples` mẫu gần nhất. Với thiết bị cuda, stage() đồng bộ GPU trước và sau khi đo để thời
+    gian thuộc đúng bước (làm chậm đường nóng một chút nên chỉ bật khi cần đo). Nếu có
+    `log_interval` (giây), bảng tóm tắt được in ra sau mỗi khoảng đó.
+    """
+    def __init__(self, device=None, max_samples=10000, log_interval=None, name="latency"):
+        self.sync_cuda = str(device).startswith("cuda")
+        self.max_samples = max_samples
+        self.log_interval = log_interval
+        self.name = name
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._last_log = time.time()
+
+    def _sync(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+
+    def now(self):
+        self._sync()
+        return time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.record(name, self.now() - start)
+
+    def record(self, name, seconds):
+        with self._lock:
+            if name not in self._samples:
+                self._samples[name] = deque(maxlen=self.max_samples)
+            self._samples[name].append(seconds)
+            should_log = self.log_interval is not None and time.time() - self._last_log >= self.log_interval
+            if should_log:
+                self._last_log = time.time()
+        if should_log:
+            print(self.format())
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+    def summary(self):
+        with self._lock:
+            samples = {name: list(values) for name, values in self._samples.items()}
+        return {name: latency_summary(values) for name, values in samples.items()}
+
+    def format(self):
+        lines = [f"[{self.name}] bước             count   mean_ms    p50_ms    p95_ms    p99_ms"]
+        for name, s in self.summary().items():
+            lines.append(f"[{self.name}] {name:<16} {s['count']:>5} {s['mean_ms']:>9.2f} {s['p50_ms']:>9.2f} "
+                         f"{s['p95_ms']:>9.2f} {s['p99_ms']:>9.2f}")
+        return "\n".join(lines)
+
+
+@contextmanager
+def maybe_stage(timer, name):
+    """
+    timer.stage(name) nếu có timer, ngược lại không làm gì (để các hàm nhận `timer=None`).
+    """
+    if timer is None:
+        yield
+    else:
+        with timer.stage(name):
+            yield
+
+
+@contextmanager
+def accumulate_stage(timer, seconds, name):
+    """
+    Cộng thời gian của khối lệnh vào seconds[name] thay vì ghi một mẫu (dùng khi một bước chạy
+    qua nhiều khối dữ liệu); người gọi tự timer.record() tổng sau cùng.
+    """
+    if timer is None:
+        yield
+        return
+    start = timer.now()
+    try:
+        yield
+    finally:
+        seconds[name] += timer.now() - start
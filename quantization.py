@@ -0,0 +1,286 @@
+# Tên file: quantization.py
+# Lưu ma trận embedding của kho ảnh ở dạng nén để giảm bộ nhớ mỗi worker:
+# - "fp16": float16 (1/2 bộ nhớ)
+# - "int8": lượng tử hoá vô hướng int8 với hệ số scale riêng cho từng chiều (1/4 bộ nhớ)
+# - "pq":   product quantization, mỗi ảnh chỉ còn `m` byte mã
+# Ứng viên tìm trên dữ liệu nén được xếp hạng lại (re-rank) bằng vector gốc, vốn được
+# memory-map từ đĩa nên chỉ các dòng ứng viên mới thực sự được đọc vào bộ nhớ.
+#
+# Benchmark bộ nhớ và recall@k (nhãn thư mục như evaluate.py):
+#   python quantization.py --images_dir ./images --checkpoint checkpoints/clip_best.pt --k 1 5 10
+
+import os
+import json
+import argparse
+from pathlib import Path
+
+import torch
+
+from image_index import load_clip_model, load_or_build_index, DEFAULT_CHECKPOINT
+from vector_index import ExactIndex, DEFAULT_SCORE_MODE, DEFAULT_CHUNK_SIZE, _scores_from_similarity
+from search_engine import encode_texts
+
+QUANTIZED_BACKENDS = ("fp16", "int8", "pq")
+
+
+class _QuantizedIndex:
+    """
+    Khung chung: chọn `top_k * rerank_factor` ứng viên bằng điểm xấp xỉ trên dữ liệu nén, sau đó
+    tính lại cosine chính xác trên vector gốc (nếu có) cho các ứng viên này. rerank_factor=0
+    tắt bước re-rank. Điểm ở chế độ "topk"/"softmax" là softmax trên các kết quả trả về.
+    """
+    backend = None
+
+    def __init__(self, exact_features=None, rerank_factor=4, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.exact_features = torch.as_tensor(exact_features) if exact_features is not None else None
+        self.rerank_factor = rerank_factor
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self.num_images
+
+    @classmethod
+    def from_state_dict(cls, state, **kwargs):
+        index = cls.__new__(cls)
+        _QuantizedIndex.__init__(index, **kwargs)
+        index.load_state_dict(state)
+        return index
+
+    def _approximate_scores(self, text_features, start, end):
+        raise NotImplementedError
+
+    def memory_bytes(self):
+        raise NotImplementedError
+
+    def _approximate_topk(self, text_features, top_k):
+        best_values, best_indices = None, None
+        for start in range(0, len(self), self.chunk_size):
+            end = min(start + self.chunk_size, len(self))
+            similarity = self._approximate_scores(text_features, start, end)
+            values, indices = similarity.topk(min(top_k, end - start), dim=-1)
+            indices += start
+            if best_values is not None:
+                values = torch.cat([best_values, values], dim=-1)
+                indices = torch.cat([best_indices, indices], dim=-1)
+                values, order = values.topk(min(top_k, values.shape[-1]), dim=-1)
+                indices = indices.gather(-1, order)
+            best_values, best_indices = values, indices
+        return best_values, best_indices
+
+    def _rerank(self, text_features, candidates, top_k):
+        exact = self.exact_features[candidates.flatten()].float().cpu()
+        exact = exact.view(candidates.shape[0], candidates.shape[1], -1)
+        similarity = torch.einsum('qd,qkd->qk', text_features, exact)
+        values, order = similarity.topk(top_k, dim=-1)
+        return values, candidates.gather(-1, order)
+
+    def search(self, text_features, top_k, score_mode=DEFAULT_SCORE_MODE):
+        top_k = min(top_k, len(self))
+        with torch.no_grad():
+            text_features = text_features.float().cpu()
+            if self.exact_features is not None and self.rerank_factor:
+                num_candidates = min(top_k * self.rerank_factor, len(self))
+                _, candidates = self._approximate_topk(text_features, num_candidates)
+                similarity, indices = self._rerank(text_features, candidates, top_k)
+            else:
+                similarity, indices = self._approximate_topk(text_features, top_k)
+            return _scores_from_similarity(similarity, score_mode), indices
+
+
+class Fp16Index(_QuantizedIndex):
+    backend = "fp16"
+
+    def __init__(self, image_features, **kwargs):
+        super().__init__(**kwargs)
+        self.codes = torch.as_tensor(image_features).detach().cpu().half()
+        self.num_images = self.codes.shape[0]
+
+    def _approximate_scores(self, text_features, start, end):
+        return text_features @ self.codes[start:end].float().T
+
+    def memory_bytes(self):
+        return self.codes.numel() * self.codes.element_size()
+
+    def state_dict(self):
+        return {'codes': self.codes}
+
+    def load_state_dict(self, state):
+        self.codes = state['codes']
+        self.num_images = self.codes.shape[0]
+
+
+class Int8Index(_QuantizedIndex):
+    """
+    x ~ codes * scale với scale[d] = max|x[:, d]| / 127. Vì q . (codes * scale) = (q * scale) . codes
+    nên scale được nhân vào câu truy vấn, không cần giải nén ma trận.
+    """
+    backend = "int8"
+
+    def __init__(self, image_features, **kwargs):
+        super().__init__(**kwargs)
+        features = torch.as_tensor(image_features).detach().cpu().float()
+        self.scale = features.abs().amax(dim=0).clamp(min=1e-8) / 127.0
+        self.codes = torch.round(features / self.scale).clamp(-127, 127).to(torch.int8)
+        self.num_images = self.codes.shape[0]
+
+    def _approximate_scores(self, text_features, start, end):
+        return (text_features * self.scale) @ self.codes[start:end].float().T
+
+    def memory_bytes(self):
+        return self.codes.numel() + self.scale.numel() * self.scale.element_size()
+
+    def state_dict(self):
+        return {'codes': self.codes, 'scale': self.scale}
+
+    def load_state_dict(self, state):
+        self.codes, self.scale = state['codes'], state['scale']
+        self.num_images = self.codes.shape[0]
+
+
+def _kmeans(x, k, n_iter=20, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(x.shape[0], generator=g)[:k]].clone()
+    for _ in range(n_iter):
+        assign = torch.cdist(x, centroids).argmin(dim=1)
+        counts = torch.bincount(assign, minlength=k)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty].unsqueeze(1).float()
+    return centroids
+
+
+class PQIndex(_QuantizedIndex):
+    """
+    Chia vector D chiều thành `m` đoạn con, mỗi đoạn được mã hoá bằng chỉ số của tâm cụm gần nhất
+    trong 256 tâm (k-means). Tìm kiếm dùng bảng tra (ADC): điểm = tổng q_j . centroid_j[code_j].
+    """
+    backend = "pq"
+
+    def __init__(self, image_features, m=32, n_iter=20, max_train=65536, seed=0, **kwargs):
+        super().__init__(**kwargs)
+        features = torch.as_tensor(image_features).detach().cpu().float()
+        num_images, dim = features.shape
+        if dim % m != 0:
+            raise ValueError(f"Số chiều embedding ({dim}) phải chia hết cho m={m}")
+        self.m = m
+        self.num_images = num_images
+        self.sub_dim = dim // m
+        ks = min(256, num_images)
+
+        g = torch.Generator().manual_seed(seed)
+        train = features[torch.randperm(num_images, generator=g)[:max_train]]
+        self.centroids = torch.stack([
+            _kmeans(train[:, j * self.sub_dim:(j + 1) * self.sub_dim], ks, n_iter, seed + j) for j in range(m)
+        ])
+
+        self.codes = torch.empty((num_images, m), dtype=torch.uint8)
+        for start in range(0, num_images, self.chunk_size):
+            chunk = features[start:start + self.chunk_size].view(-1, m, self.sub_dim)
+            for j in range(m):
+                self.codes[start:start + chunk.shape[0], j] = \
+                    torch.cdist(chunk[:, j], self.centroids[j]).argmin(dim=1).to(torch.uint8)
+
+    def _approximate_scores(self, text_features, start, end):
+        # Bảng tra (Q, m, ks): tích vô hướng giữa từng đoạn của câu truy vấn và từng tâm cụm
+        lut = torch.einsum('qmd,mkd->qmk', text_features.view(-1, self.m, self.sub_dim), self.centroids)
+        codes = self.codes[start:end].long()
+        scores = torch.zeros((text_features.shape[0], end - start))
+        for j in range(self.m):
+            scores += lut[:, j, codes[:, j]]
+        return scores
+
+    def memory_bytes(self):
+        return self.codes.numel() + self.centroids.numel() * self.centroids.element_size()
+
+    def state_dict(self):
+        return {'codes': self.codes, 'centroids': self.centroids, 'm': self.m}
+
+    def load_state_dict(self, state):
+        self.codes, self.centroids, self.m = state['codes'], state['centroids'], state['m']
+        self.num_images = self.codes.shape[0]
+        self.sub_dim = self.centroids.shape[-1]
+
+
+_QUANTIZED_CLASSES = {'fp16': Fp16Index, 'int8': Int8Index, 'pq': PQIndex}
+
+
+def build_quantized_index(image_features, backend, index_path=None, rerank=True, **params):
+    """
+    Tạo chỉ mục nén. Nếu có `index_path` thì mã nén được lưu/nạp từ file đó (dùng cho PQ vì huấn
+    luyện k-means tốn thời gian). Với rerank=True, `image_features` (thường là memory-map của
+    embeddings-<n>.npy) được giữ lại để xếp hạng lại ứng viên.
+    """
+    cls = _QUANTIZED_CLASSES[backend]
+    common = {k: params.pop(k) for k in ('rerank_factor', 'chunk_size') if k in params}
+    common['exact_features'] = image_features if rerank else None
+
+    if index_path and os.path.exists(index_path):
+        return cls.from_state_dict(torch.load(index_path), **common)
+
+    index = cls(image_features, **common, **params)
+    if index_path:
+        tmp_path = index_path + ".tmp"
+        torch.save(index.state_dict(), tmp_path)
+        os.replace(tmp_path, index_path)
+    return index
+
+
+def benchmark(image_features, image_paths, text_features, labels, ks=(1, 5, 10), backends=QUANTIZED_BACKENDS):
+    """
+    So sánh bộ nhớ và độ chính xác của các dạng lưu trữ. Với mỗi câu truy vấn theo nhãn (như
+    evaluate.py), "hit@k" là tỉ lệ câu có ít nhất một ảnh đúng nhãn trong top-k; "overlap@k" là
+    tỉ lệ kết quả trùng với top-k của tìm kiếm chính xác float32.
+    """
+    ground_truths = [Path(p).parent.name for p in image_paths]
+    max_k = max(ks)
+    exact = ExactIndex(torch.as_tensor(image_features).float())
+    _, exact_indices = exact.search(text_features, max_k, score_mode="cosine")
+
+    def evaluate(indices):
+        row = {}
+        for k in ks:
+            hits = sum(any(ground_truths[i] == label for i in idx[:k]) for label, idx in zip(labels, indices.tolist()))
+            overlap = sum(len(set(a[:k]) & set(b[:k])) for a, b in zip(indices.tolist(), exact_indices.tolist()))
+            row[f"hit@{k}"] = hits / len(labels)
+            row[f"overlap@{k}"] = overlap / (len(labels) * min(k, len(image_paths)))
+        return row
+
+    report = {'float32': dict(memory_mb=exact.image_features.numel() * 4 / 2**20, **evaluate(exact_indices))}
+    for backend in backends:
+        index = build_quantized_index(image_features, backend)
+        for rerank_factor in (0, index.rerank_factor):
+            index.rerank_factor = rerank_factor
+            _, indices = index.search(text_features, max_k, score_mode="cosine")
+            name = backend + ("+rerank" if rerank_factor else "")
+            report[name] = dict(memory_mb=index.memory_bytes() / 2**20, **evaluate(indices))
+    return report
+
+
+def main(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model, preprocess = load_clip_model(args.checkpoint, device, args.model)
+    image_features, image_paths = load_or_build_index(model, preprocess, device, args.images_dir,
+                                                      args.index_dir, args.checkpoint, args.model)
+    labels = sorted({Path(p).parent.name for p in image_paths})
+    queries = [f"a photo of a {label.replace('_', ' ')}" for label in labels]
+    text_features = encode_texts(model, device, queries).float().cpu()
+
+    report = benchmark(image_features.float().cpu(), image_paths, text_features, labels, ks=args.k)
+    for name, row in report.items():
+        print(f"{name:<14} " + "  ".join(f"{key}={value:.4f}" for key, value in row.items()))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark bộ nhớ / recall của các dạng lưu embedding nén")
+    parser.add_argument('--images_dir', type=str, default='./images')
+    parser.add_argument('--checkpoint', type=str, default=DEFAULT_CHECKPOINT)
+    parser.add_argument('--model', type=str, default='ViT-B/32')
+    parser.add_argument('--index_dir', type=str, default='./index')
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--output', type=str, default=None, help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,162 @@
+# Tên file: query_cache.py
+# Cache LRU cho embedding câu truy vấn và cho kết quả tìm kiếm (query, top_k),
+# kèm bộ đếm hit/miss để theo dõi hiệu quả.
+
+import os
+import atexit
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import torch
+
+
+def normalize_query(query):
+    """
+    Chuẩn hoá câu truy vấn làm khoá cache. Tokenizer của CLIP vốn đã chuẩn hoá unicode,
+    gộp khoảng trắng và chuyển chữ thường nên các biến thể này cho cùng một embedding.
+    """
+    return " ".join(unicodedata.normalize("NFC", query).split()).lower()
+
+
+class LRUCache:
+    """
+    Cache LRU giới hạn số phần tử, an toàn khi nhiều phiên Streamlit dùng chung.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+class TextEmbeddingCache(LRUCache):
+    """
+    Cache embedding văn bản đã chuẩn hoá, khoá theo (checkpoint_id, câu truy vấn đã chuẩn hoá).
+    Nếu có `path`, cache được nạp từ đĩa khi khởi tạo và ghi lại bằng save(); file của
+    checkpoint khác bị bỏ qua. Với `save_interval` (giây), một luồng nền ghi cache (nếu có thay đổi)
+    sau mỗi khoảng đó và một lần cuối khi tiến trình thoát, nên đường tìm kiếm không phải ghi đĩa.
+    """
+    def __init__(self, checkpoint_id, maxsize=4096, path=None, save_interval=None):
+        super().__init__(maxsize)
+        self.checkpoint_id = checkpoint_id
+        self.path = path
+        self._dirty = False
+        self._save_lock = threading.Lock()
+        self._stop = threading.Event()
+        if path and os.path.exists(path):
+            self._load()
+        if path and save_interval:
+            threading.Thread(target=self._autosave, args=(save_interval,), daemon=True).start()
+            atexit.register(self.close)
+
+    def get_embedding(self, query):
+        return self.get((self.checkpoint_id, normalize_query(query)))
+
+    def put_embedding(self, query, text_features):
+        self.put((self.checkpoint_id, normalize_query(query)), text_features.detach().float().cpu())
+        self._dirty = True
+
+    def _load(self):
+        try:
+            state = torch.load(self.path, map_location="cpu")
+        except Exception as e:
+            print(f"Bỏ qua file cache embedding lỗi {self.path}: {e}")
+            return
+        if state.get('checkpoint_id') != self.checkpoint_id:
+            return
+        for query, text_features in state['entries']:
+            self.put((self.checkpoint_id, query), text_features)
+
+    def save(self):
+        # _save_lock giữ suốt lần ghi để hai lần save đồng thời không ghi đè cùng file .tmp;
+        # _lock chỉ giữ lúc chép danh sách nên get/put không phải chờ ghi đĩa
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                entries = [(query, value) for (_, query), value in self._data.items()]
+                self._dirty = False
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                tmp_path = self.path + ".tmp"
+                torch.save({'checkpoint_id': self.checkpoint_id, 'entries': entries}, tmp_path)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                self._dirty = True
+                raise
+
+    def _autosave(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.save()
+            except Exception as e:
+                print(f"Không ghi được cache embedding {self.path}: {e}")
+
+    def close(self):
+        self._stop.set()
+        self.save()
+
+
+class ResultCache(LRUCache):
+    """
+    Cache kết quả tìm kiếm theo (câu truy vấn đã chuẩn hoá, top_k, cách tính điểm, bộ lọc thuộc
+    tính). Toàn bộ cache bị xoá khi phiên bản chỉ mục ảnh thay đổi (xem set_index_version).
+    """
+    def __init__(self, maxsize=1024, index_version=None):
+        super().__init__(maxsize)
+        self.index_version = index_version
+
+    def set_index_version(self, index_version):
+        if index_version != self.index_version:
+            self.clear()
+            self.index_version = index_version
+
+    def get_results(self, query, top_k, score_mode=None, filters=None):
+        return self.get((normalize_query(query), top_k, score_mode, filters_key(filters)))
+
+    def put_results(self, query, top_k, results, score_mode=None, filters=None):
+        self.put((normalize_query(query), top_k, score_mode, filters_key(filters)), list(results))
+
+
+def filters_key(filters):
+    if not filters:
+        return None
+    return tuple(sorted((attribute, tuple(sorted(normalize_query(v) for v in values)))
+                        for attribute, values in filters.items() if values)) or None
@@ -1,54 +1,37 @@
-import os
 import torch
-from PIL import Image
-import clip
+
+from image_index import load_clip_model, load_or_build_index, read_manifest
+from vector_index import build_vector_index
+import search_engine
 
 # Đường dẫn thư mục chứa ảnh (có thể có thư mục con: Toyota, Honda,...)
 IMAGE_DIR = "D:/DoAn/images"
+MODEL_PATH = "clip_best.pt"
+# Thư mục lưu chỉ mục embedding (embeddings-<n>.npy + manifest.json)
+INDEX_DIR = "index"
+# Backend tìm kiếm: "exact" (duyệt toàn bộ) hoặc "ivf"/"hnsw" (xấp xỉ, cần faiss)
+SEARCH_BACKEND = "exact"
+SEARCH_BACKEND_PARAMS = {}
+# Cách tính điểm: "topk" (chuẩn hoá trên k kết quả), "softmax" (trên toàn bộ kho ảnh) hoặc "cosine"
+SCORE_MODE = "topk"
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("clip_best.pt", device=device)
-
-# --- Duyệt tất cả ảnh trong thư mục con ---
-image_paths = []
-for root, dirs, files in os.walk(IMAGE_DIR):
-    for file in files:
-        if file.lower().endswith((".jpg", ".jpeg", ".png")):
-            image_paths.append(os.path.join(root, file))
-
-print(f"🔎 Tìm thấy {len(image_paths)} ảnh trong {IMAGE_DIR}")
-
-# --- Trích xuất đặc trưng ảnh ---
-image_features = []
-valid_image_paths = []
+model, preprocess = load_clip_model(MODEL_PATH, device)
 
-for path in image_paths:
-    try:
-        img = preprocess(Image.open(path).convert("RGB")).unsqueeze(0).to(device)
-        with torch.no_grad():
-            feat = model.encode_image(img)
-            feat /= feat.norm(dim=-1, keepdim=True)
-        image_features.append(feat)
-        valid_image_paths.append(path)
-    except Exception as e:
-        print(f"⚠️ Lỗi khi đọc ảnh {path}: {e}")
+# --- Nạp chỉ mục embedding từ đĩa (chỉ lập chỉ mục lại khi checkpoint/tiền xử lý thay đổi) ---
+image_features, image_paths = load_or_build_index(model, preprocess, device, IMAGE_DIR, INDEX_DIR, MODEL_PATH)
+vector_index = build_vector_index(image_features, SEARCH_BACKEND, index_dir=INDEX_DIR,
+                                  index_tag=read_manifest(INDEX_DIR)['generation'], **SEARCH_BACKEND_PARAMS)
 
-if len(image_features) == 0:
-    raise RuntimeError("❌ Không tìm thấy ảnh hợp lệ trong thư mục IMAGE_DIR")
-
-image_features = torch.cat(image_features, dim=0)
-image_paths = valid_image_paths
+print(f"🔎 Đã sẵn sàng tìm kiếm trên {len(image_paths)} ảnh trong {IMAGE_DIR}")
 
 # --- Hàm tìm kiếm ---
 def search_images(query, top_k=5):
-    with torch.no_grad():
-        text = clip.tokenize([query]).to(device)
-        text_features = model.encode_text(text)
-        text_features /= text_features.norm(dim=-1, keepdim=True)
-
-        similarity = (100.0 * text_features @ image_features.T).softmax(dim=-1)
-        values, indices = similarity[0].topk(top_k)
-
-    # Trả về tuple (đường dẫn ảnh, điểm số)
-    results = [(image_paths[i], float(values[j])) for j, i in enumerate(indices)]
-    return results
+    # Trả về list tuple (đường dẫn ảnh, điểm số)
+    return search_engine.search_images(query, model, device, vector_index, image_paths, top_k,
+                                       score_mode=SCORE_MODE)
+
+def search_many(queries, top_k=5):
+    # Tìm kiếm nhiều câu truy vấn cùng lúc (một batch encode_text + một phép nhân ma trận)
+    return search_engine.search_many(queries, model, device, vector_index, image_paths, top_k,
+                                     score_mode=SCORE_MODE)
@@ -0,0 +1,67 @@
+# Tên file: search_client.py
+# Client tối giản (chỉ dùng thư viện chuẩn) cho dịch vụ tìm kiếm trong server.py.
+
+import json
+import urllib.error
+import urllib.request
+
+
+def _request(base_url, path, payload=None, timeout=30.0):
+    url = base_url.rstrip('/') + path
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return json.loads(resp.read().decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.loads(e.read().decode('utf-8')).get('error', e.reason)
+        except ValueError:
+            message = e.reason
+        raise RuntimeError(f"Dịch vụ tìm kiếm trả về lỗi {e.code}: {message}") from e
+    except (urllib.error.URLError, OSError) as e:
+        raise RuntimeError(f"Không kết nối được dịch vụ tìm kiếm tại {base_url}: {e}") from e
+
+
+def healthz(base_url, timeout=5.0):
+    return _request(base_url, '/healthz', timeout=timeout)
+
+
+def stats(base_url, timeout=5.0):
+    return _request(base_url, '/stats', timeout=timeout)
+
+
+def shard_info(base_url, timeout=30.0):
+    """
+    Thông tin một shard do `python sharded_search.py serve` phục vụ (số ảnh, đường dẫn, phiên bản).
+    """
+    return _request(base_url, '/shard/info', timeout=timeout)
+
+
+def shard_search(base_url, features, top_k, with_lse=False, timeout=30.0):
+    """
+    Top-k của shard cho các vector truy vấn `features` (list các list float, đã chuẩn hoá).
+    """
+    return _request(base_url, '/shard/search', {'features': features, 'top_k': top_k, 'with_lse': with_lse},
+                    timeout)
+
+
+def shard_reload(base_url, timeout=30.0):
+    return _request(base_url, '/shard/reload', {}, timeout)
+
+
+def search(base_url, query, top_k=5, score_mode="topk", filters=None, timeout=30.0):
+    """
+    Trả về list tuple (đường dẫn ảnh, điểm số) giống search_engine.search_images.
+    `filters` ví dụ {"brand": ["audi"], "color": ["đỏ"]} (xem attribute_index.py).
+    """
+    body = _request(base_url, '/search', {'query': query, 'top_k': top_k, 'score_mode': score_mode,
+                                          'filters': filters or {}}, timeout)
+    return [(r['path'], r['score']) for r in body['results']]
+
+
+def search_batch(base_url, queries, top_k=5, score_mode="topk", filters=None, timeout=60.0):
+    body = _request(base_url, '/search/batch',
+                    {'queries': list(queries), 'top_k': top_k, 'score_mode': score_mode,
+                     'filters': filters or {}}, timeout)
+    return [[(r['path'], r['score']) for r in item['results']] for item in body['results']]
@@ -0,0 +1,131 @@
+# Tên file: search_engine.py
+# Hàm tìm kiếm dùng chung cho app.py, search.py và evaluate.py: mã hoá câu truy vấn theo batch
+# rồi tra cứu trên chỉ mục vector (xem vector_index.py). search_by_image tìm ảnh tương tự một ảnh
+# truy vấn bằng chính embedding encode_image dùng khi lập chỉ mục.
+
+import torch
+import clip
+
+from query_cache import normalize_query
+from vector_index import DEFAULT_SCORE_MODE
+from latency import maybe_stage
+
+DEFAULT_QUERY_BATCH_SIZE = 256
+
+
+def _encode_batch(model, device, queries):
+    with torch.no_grad():
+        text_input = clip.tokenize(list(queries), truncate=True).to(device)
+        text_features = model.encode_text(text_input)
+        text_features /= text_features.norm(dim=-1, keepdim=True)
+    return text_features
+
+
+def encode_texts(model, device, queries, batch_size=DEFAULT_QUERY_BATCH_SIZE, text_cache=None):
+    """
+    Tokenize và mã hoá nhiều câu truy vấn một lần; trả về tensor (Q, D) đã chuẩn hoá.
+    Với `text_cache` (TextEmbeddingCache), chỉ các câu chưa có trong cache mới được mã hoá.
+    """
+    if text_cache is None:
+        return torch.cat([_encode_batch(model, device, queries[start:start + batch_size])
+                          for start in range(0, len(queries), batch_size)], dim=0)
+
+    features = {}
+    missing = []
+    for query in queries:
+        key = normalize_query(query)
+        if key in features:
+            continue
+        features[key] = text_cache.get_embedding(query)
+        if features[key] is None:
+            missing.append(query)
+
+    for start in range(0, len(missing), batch_size):
+        chunk = missing[start:start + batch_size]
+        for query, text_features in zip(chunk, _encode_batch(model, device, chunk)):
+            text_cache.put_embedding(query, text_features)
+            features[normalize_query(query)] = text_features
+
+    dtype = model.dtype
+    return torch.stack([features[normalize_query(q)].to(device=device, dtype=dtype) for q in queries], dim=0)
+
+
+def encode_query_images(model, preprocess, device, images):
+    """
+    Mã hoá các ảnh truy vấn (PIL.Image) giống image_index.encode_images; trả về tensor (Q, D) đã chuẩn hoá.
+    """
+    with torch.no_grad():
+        batch = torch.stack([preprocess(image.convert("RGB")) for image in images]).to(device)
+        image_features = model.encode_image(batch)
+        image_features /= image_features.norm(dim=-1, keepdim=True)
+    return image_features
+
+
+def search_by_image(images, model, preprocess, device, vector_index, image_paths, top_k=5,
+                    score_mode=DEFAULT_SCORE_MODE, filters=None, attribute_index=None, timer=None):
+    """
+    Tìm ảnh trong kho giống các ảnh truy vấn (PIL.Image). Trả về list (theo thứ tự images) các list
+    (đường dẫn ảnh, điểm số) như search_many; `filters` và `timer` dùng như trong search_many.
+    """
+    candidates = attribute_index.candidates(filters) if attribute_index is not None and filters else None
+    if candidates is not None and not getattr(vector_index, 'supports_candidates', False):
+        raise ValueError("Bộ lọc thuộc tính chỉ dùng được với backend \"exact\"")
+    with maybe_stage(timer, "encode_image"):
+        image_features = encode_query_images(model, preprocess, device, images)
+    with maybe_stage(timer, "search"):
+        if candidates is None:
+            values, indices = vector_index.search(image_features, top_k, score_mode=score_mode)
+        else:
+            values, indices = vector_index.search(image_features, top_k, score_mode=score_mode,
+                                                  candidates=candidates)
+    return [[(image_paths[j], v) for v, j in zip(row_values, row_indices) if j >= 0]
+            for row_values, row_indices in zip(values.tolist(), indices.tolist())]
+
+
+def search_many(queries, model, device, vector_index, image_paths, top_k=5,
+                batch_size=DEFAULT_QUERY_BATCH_SIZE, text_cache=None, result_cache=None,
+                score_mode=DEFAULT_SCORE_MODE, filters=None, attribute_index=None, timer=None):
+    """
+    Tìm kiếm nhiều câu truy vấn: mỗi batch chỉ cần một lần encode_text, một phép nhân
+    (Q x D) @ (D x N) và một lần topk. Trả về list (theo thứ tự queries) các list (đường dẫn ảnh, điểm số).
+    `text_cache` / `result_cache` (xem query_cache.py) là tuỳ chọn; `score_mode` xem vector_index.py.
+    `filters` ({thuộc tính: [giá trị]}, xem attribute_index.py) chỉ chấm điểm các ảnh thoả bộ lọc
+    và cần vector_index hỗ trợ `candidates` (backend "exact").
+    Với `timer` (latency.StageTimer), mỗi batch ghi thời gian "encode_text" và "search".
+    """
+    candidates = attribute_index.candidates(filters) if attribute_index is not None and filters else None
+    if candidates is not None and not getattr(vector_index, 'supports_candidates', False):
+        raise ValueError("Bộ lọc thuộc tính chỉ dùng được với backend \"exact\"")
+    filters = filters if candidates is not None else None
+
+    results = [None] * len(queries)
+    pending = []
+    for i, query in enumerate(queries):
+        cached = result_cache.get_results(query, top_k, score_mode, filters) if result_cache is not None else None
+        if cached is None:
+            pending.append(i)
+        else:
+            results[i] = cached
+
+    for start in range(0, len(pending), batch_size):
+        chunk = pending[start:start + batch_size]
+        with maybe_stage(timer, "encode_text"):
+            text_features = encode_texts(model, device, [queries[i] for i in chunk], batch_size, text_cache)
+        with maybe_stage(timer, "search"):
+            if candidates is None:
+                values, indices = vector_index.search(text_features, top_k, score_mode=score_mode)
+            else:
+                values, indices = vector_index.search(text_features, top_k, score_mode=score_mode,
+                                                      candidates=candidates)
+        for i, row_values, row_indices in zip(chunk, values.tolist(), indices.tolist()):
+            results[i] = [(image_paths[j], v) for v, j in zip(row_values, row_indices) if j >= 0]
+            if result_cache is not None:
+                result_cache.put_results(queries[i], top_k, results[i], score_mode, filters)
+    return results
+
+
+def search_images(query, model, device, vector_index, image_paths, top_k=5, text_cache=None, result_cache=None,
+                  score_mode=DEFAULT_SCORE_MODE, filters=None, attribute_index=None, timer=None):
+    return search_many([query], model, device, vector_index, image_paths, top_k,
+                       text_cache=text_cache, result_cache=result_cache, score_mode=score_mode,
+                       filters=filters, attribute_index=attribute_index, timer=timer)[0]
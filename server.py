@@ -0,0 +1,448 @@
+# Tên file: server.py
+# Dịch vụ HTTP tìm kiếm ảnh độc lập với Streamlit (aiohttp). Model và chỉ mục được nạp một lần;
+# các câu truy vấn đến đồng thời được gom thành micro-batch trước khi gọi encode_text.
+#
+#   python server.py --images_dir ./images --checkpoint checkpoints/clip_best.pt --port 8000
+#
+#   POST /search        {"query": "xe SUV màu trắng", "top_k": 5, "score_mode": "topk"}
+#   POST /search/batch  {"queries": ["...", "..."], "top_k": 5}
+#   GET  /healthz
+#   GET  /stats         độ trễ p50/p95/p99 theo từng bước, QPS, bộ nhớ đỉnh
+#   POST /admin/reload  (kho ảnh chia shard) đọc lại shards.json và nạp lại mọi shard
+
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import torch
+from aiohttp import web
+
+from image_index import (load_clip_model, load_or_build_index, load_index, read_manifest, checkpoint_fingerprint,
+                         DEFAULT_CHECKPOINT)
+from inference_model import load_inference_model
+from vector_index import build_vector_index, ExactIndex, BACKENDS, SCORE_MODES, DEFAULT_SCORE_MODE
+from search_engine import encode_texts
+from query_cache import TextEmbeddingCache, ResultCache, filters_key
+from sharded_search import open_local_shards, open_remote_shards
+from attribute_index import load_or_build_attribute_index, ATTRIBUTES
+from latency import StageTimer, maybe_stage, peak_rss_mb
+
+MAX_TOP_K = 100
+MAX_BATCH_QUERIES = 1024
+
+
+class TextEncodeBatcher:
+    """
+    Gom các câu truy vấn đến trong vòng `max_wait_ms` (tối đa `max_batch_size` câu) thành một
+    lần encode_text. Model chạy trên một luồng riêng để không chặn event loop.
+    """
+    def __init__(self, model, device, text_cache=None, max_batch_size=32, max_wait_ms=5.0, timer=None):
+        self.model = model
+        self.device = device
+        self.text_cache = text_cache
+        self.timer = timer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self._task = None
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=False)
+
+    async def encode(self, queries):
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in queries]
+        for query, future in zip(queries, futures):
+            self.queue.put_nowait((query, future))
+        return torch.stack(await asyncio.gather(*futures), dim=0)
+
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _encode(self, queries):
+        with maybe_stage(self.timer, "encode_text"):
+            return encode_texts(self.model, self.device, queries, len(queries), self.text_cache)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            queries = [query for query, _ in batch]
+            try:
+                text_features = await loop.run_in_executor(self.executor, self._encode, queries)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), features in zip(batch, text_features):
+                if not future.done():
+                    future.set_result(features)
+
+
+class SearchService:
+    def __init__(self, args):
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.backend = args.backend
+        self.attribute_index = None
+        self.filter_index = None
+        self.sharded = bool(args.shards_dir or args.shard_urls)
+        self.shard_poll_interval = args.shard_poll_interval
+        self._last_shard_poll = time.time()
+        # Độ trễ mỗi request luôn được ghi; các bước bên trong (cần đồng bộ GPU) chỉ khi --profile
+        self.timer = StageTimer(self.device if args.profile else None, log_interval=args.stats_log_interval,
+                                name="server")
+        self.stage_timer = self.timer if args.profile else None
+        self.started_at = time.time()
+        self.num_requests = 0
+        self.num_queries = 0
+        if self.sharded:
+            self._load_sharded(args)
+        else:
+            if args.text_only:
+                self.model, image_features, self.image_paths, manifest = self._load_text_only(args)
+            else:
+                self.model, preprocess = load_clip_model(args.checkpoint, self.device, args.model)
+                image_features, self.image_paths = load_or_build_index(
+                    self.model, preprocess, self.device, args.images_dir, args.index_dir, args.checkpoint,
+                    args.model, refresh=args.refresh_index)
+                manifest = read_manifest(args.index_dir)
+            self.vector_index = build_vector_index(image_features, args.backend, index_dir=args.index_dir,
+                                                   index_tag=manifest['generation'], timer=self.stage_timer)
+            self.index_version = f"{manifest['key']}:{manifest['generation']}"
+            self.checkpoint_id = manifest['checkpoint']['sha1']
+            self.attribute_index = load_or_build_attribute_index(args.index_dir, self.image_paths, args.images_dir,
+                                                                 args.metadata, self.index_version)
+            self.filter_index = self.vector_index if getattr(self.vector_index, 'supports_candidates', False) \
+                else ExactIndex(image_features, timer=self.stage_timer)
+        self.text_cache = TextEmbeddingCache(self.checkpoint_id, maxsize=args.text_cache_size)
+        self.result_cache = ResultCache(maxsize=args.result_cache_size, index_version=self.index_version)
+        self.batcher = TextEncodeBatcher(self.model, self.device, self.text_cache,
+                                         max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                                         timer=self.stage_timer)
+
+    def _load_text_only(self, args):
+        """
+        Worker chỉ phục vụ câu truy vấn: nạp riêng tháp văn bản từ file inference_model.py và dùng
+        chỉ mục đã lập sẵn, không mã hoá ảnh nên không bao giờ nạp tháp ảnh.
+        """
+        model, _ = load_inference_model(args.checkpoint, self.device, towers=("text",))
+        loaded = load_index(args.index_dir)
+        if loaded is None:
+            raise RuntimeError(f"Chưa có chỉ mục trong {args.index_dir}; hãy chạy image_index.py trước")
+        embeddings, image_paths, manifest = loaded
+        # File suy luận mang sha1 của checkpoint nguồn (xem checkpoint_fingerprint)
+        if checkpoint_fingerprint(args.checkpoint, manifest['checkpoint'])['sha1'] != manifest['checkpoint']['sha1']:
+            print(f"Cảnh báo: chỉ mục trong {args.index_dir} được lập bằng checkpoint khác {args.checkpoint}")
+        image_features = torch.from_numpy(embeddings).to(device=self.device, dtype=model.dtype)
+        return model, image_features, image_paths, manifest
+
+    def _load_sharded(self, args):
+        """
+        Kho ảnh chia shard (sharded_search.py): mỗi shard do một tiến trình con (--shards_dir) hoặc
+        một node khác (--shard_urls) phục vụ; service chỉ mã hoá câu truy vấn và trộn kết quả.
+        """
+        if args.text_only:
+            self.model, _ = load_inference_model(args.checkpoint, self.device, towers=("text",))
+        else:
+            self.model, _ = load_clip_model(args.checkpoint, self.device, args.model)
+        if args.shard_urls:
+            self.vector_index = open_remote_shards(args.shard_urls)
+        else:
+            self.vector_index = open_local_shards(args.shards_dir, args.backend)
+        self.backend = f"sharded/{args.backend}"
+        self.image_paths = self.vector_index.image_paths
+        self.index_version = self.vector_index.version
+        self.checkpoint_id = checkpoint_fingerprint(args.checkpoint)['sha1']
+
+    def _split_filters(self, queries, filters):
+        """
+        Tách bộ lọc viết trong câu truy vấn ("xe SUV + màu đỏ + Audi") và gộp với `filters` của request.
+        Trả về list (câu văn bản, bộ lọc) theo từng câu.
+        """
+        if self.attribute_index is None:
+            if filters:
+                raise ValueError("Bộ lọc thuộc tính không dùng được với kho ảnh chia shard")
+            return [(query, {}) for query in queries]
+        parsed = []
+        for query in queries:
+            text, query_filters = self.attribute_index.parse_query(query)
+            for attribute, values in (filters or {}).items():
+                query_filters[attribute] = sorted(set(query_filters.get(attribute, [])) | set(values))
+            parsed.append((text, {a: v for a, v in query_filters.items() if v}))
+        return parsed
+
+    def _sync_index_version(self):
+        # Bố cục shard đổi khi một shard được lập lại (shard tự nạp lại, coordinator thấy qua lần tìm
+        # kiếm hoặc lần dò định kỳ kế tiếp) hoặc sau reload(); kết quả cache theo bố cục cũ bị bỏ
+        if self.sharded:
+            self.image_paths = self.vector_index.image_paths
+            self.index_version = self.vector_index.version
+            self.result_cache.set_index_version(self.index_version)
+
+    def reload(self):
+        """
+        Đọc lại danh sách shard (shards.json với --shards_dir) và yêu cầu mọi shard nạp lại chỉ mục.
+        """
+        if not self.sharded:
+            raise ValueError("Chỉ nạp lại được kho ảnh chia shard (--shards_dir hoặc --shard_urls)")
+        self.vector_index.reload()
+        self._sync_index_version()
+
+    def _search_sharded(self, text_features, top_k, score_mode):
+        with maybe_stage(self.stage_timer, "search"):
+            return self.vector_index.search_snapshot(text_features, top_k, score_mode)
+
+    async def search(self, queries, top_k, score_mode, filters=None):
+        loop = asyncio.get_running_loop()
+        parsed = self._split_filters(queries, filters)
+        if self.sharded and self.shard_poll_interval and \
+                time.time() - self._last_shard_poll >= self.shard_poll_interval:
+            # Dò shard được lập lại kể cả khi mọi câu truy vấn đều trúng cache kết quả
+            self._last_shard_poll = time.time()
+            await loop.run_in_executor(None, self.vector_index.refresh)
+        self._sync_index_version()
+        results = [self.result_cache.get_results(text, top_k, score_mode, f) for text, f in parsed]
+        # Các câu cùng bộ lọc dùng chung một tập ứng viên và một lần tìm kiếm
+        groups = {}
+        for i, r in enumerate(results):
+            if r is None:
+                groups.setdefault(filters_key(parsed[i][1]), []).append(i)
+        for pending in groups.values():
+            query_filters = parsed[pending[0]][1]
+            text_features = await self.batcher.encode([parsed[i][0] for i in pending])
+            image_paths, cacheable = self.image_paths, True
+            if query_filters:
+                candidates = self.attribute_index.candidates(query_filters)
+                values, indices = await loop.run_in_executor(
+                    None, partial(self._search_index, self.filter_index, text_features, top_k, score_mode, candidates))
+            elif self.sharded:
+                # Chỉ số chỉ hợp lệ với bố cục đã dùng để tìm; kết quả của bố cục đã cũ không đưa vào cache
+                values, indices, image_paths, version = await loop.run_in_executor(
+                    None, self._search_sharded, text_features, top_k, score_mode)
+                self._sync_index_version()
+                cacheable = version == self.index_version
+            else:
+                values, indices = await loop.run_in_executor(
+                    None, self._search_index, self.vector_index, text_features, top_k, score_mode)
+            for i, row_values, row_indices in zip(pending, values.tolist(), indices.tolist()):
+                results[i] = [(image_paths[j], v) for v, j in zip(row_values, row_indices) if j >= 0]
+                if cacheable:
+                    self.result_cache.put_results(parsed[i][0], top_k, results[i], score_mode, query_filters)
+        return results
+
+    def _search_index(self, index, text_features, top_k, score_mode, candidates=None):
+        with maybe_stage(self.stage_timer, "search"):
+            if candidates is None:
+                return index.search(text_features, top_k, score_mode)
+            return index.search(text_features, top_k, score_mode, candidates=candidates)
+
+    def record_request(self, num_queries, seconds):
+        self.num_requests += 1
+        self.num_queries += num_queries
+        self.timer.record("request", seconds)
+
+    def stats(self):
+        uptime = time.time() - self.started_at
+        return {
+            'uptime_s': uptime,
+            'requests': self.num_requests,
+            'queries': self.num_queries,
+            'qps': self.num_queries / uptime if uptime else 0.0,
+            'peak_rss_mb': peak_rss_mb(),
+            'latency': self.timer.summary(),
+            'cache': {
+                'text_embeddings': self.text_cache.stats(),
+                'results': self.result_cache.stats(),
+            },
+        }
+
+    def health(self):
+        return {
+            'status': 'ok',
+            'num_images': len(self.image_paths),
+            'backend': self.backend,
+            'device': self.device,
+            'index_version': self.index_version,
+            'cache': {
+                'text_embeddings': self.text_cache.stats(),
+                'results': self.result_cache.stats(),
+            },
+        }
+
+
+def _bad_request(message):
+    return web.json_response({'error': message}, status=400)
+
+
+def _parse_search_params(body):
+    try:
+        top_k = int(body.get('top_k', 5))
+    except (TypeError, ValueError):
+        raise ValueError("top_k phải là số nguyên")
+    if not 1 <= top_k <= MAX_TOP_K:
+        raise ValueError(f"top_k phải nằm trong khoảng 1..{MAX_TOP_K}")
+    score_mode = body.get('score_mode', DEFAULT_SCORE_MODE)
+    if score_mode not in SCORE_MODES:
+        raise ValueError(f"score_mode phải là một trong {SCORE_MODES}")
+    filters = body.get('filters') or {}
+    if not isinstance(filters, dict) or \
+            any(a not in ATTRIBUTES or not isinstance(v, list) for a, v in filters.items()):
+        raise ValueError(f"filters phải là object {{thuộc tính: [giá trị, ...]}} với thuộc tính trong {ATTRIBUTES}")
+    return top_k, score_mode, filters
+
+
+def _format_results(results):
+    return [{'path': path, 'score': score} for path, score in results]
+
+
+async def _read_json(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        raise ValueError("Body phải là JSON hợp lệ")
+    if not isinstance(body, dict):
+        raise ValueError("Body phải là một JSON object")
+    return body
+
+
+async def handle_search(request):
+    start = time.perf_counter()
+    try:
+        body = await _read_json(request)
+        query = body.get('query')
+        if not isinstance(query, str) or not query.strip():
+            raise ValueError("Thiếu trường 'query'")
+        top_k, score_mode, filters = _parse_search_params(body)
+        results = await request.app['service'].search([query], top_k, score_mode, filters)
+    except ValueError as e:
+        return _bad_request(str(e))
+
+    request.app['service'].record_request(1, time.perf_counter() - start)
+    return web.json_response({'query': query, 'results': _format_results(results[0])})
+
+
+async def handle_search_batch(request):
+    start = time.perf_counter()
+    try:
+        body = await _read_json(request)
+        queries = body.get('queries')
+        if not isinstance(queries, list) or not queries or \
+                not all(isinstance(q, str) and q.strip() for q in queries):
+            raise ValueError("'queries' phải là danh sách câu truy vấn không rỗng")
+        if len(queries) > MAX_BATCH_QUERIES:
+            raise ValueError(f"Tối đa {MAX_BATCH_QUERIES} câu truy vấn mỗi lần gọi")
+        top_k, score_mode, filters = _parse_search_params(body)
+        results = await request.app['service'].search(queries, top_k, score_mode, filters)
+    except ValueError as e:
+        return _bad_request(str(e))
+
+    request.app['service'].record_request(len(queries), time.perf_counter() - start)
+    return web.json_response({'results': [{'query': q, 'results': _format_results(r)}
+                                          for q, r in zip(queries, results)]})
+
+
+async def handle_healthz(request):
+    return web.json_response(request.app['service'].health())
+
+
+async def handle_stats(request):
+    return web.json_response(request.app['service'].stats())
+
+
+async def handle_reload(request):
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, request.app['service'].reload)
+    except ValueError as e:
+        return _bad_request(str(e))
+    return web.json_response(request.app['service'].health())
+
+
+def create_app(service):
+    app = web.Application()
+    app['service'] = service
+    app.router.add_post('/search', handle_search)
+    app.router.add_post('/search/batch', handle_search_batch)
+    app.router.add_get('/healthz', handle_healthz)
+    app.router.add_get('/stats', handle_stats)
+    app.router.add_post('/admin/reload', handle_reload)
+
+    async def on_startup(app):
+        await service.batcher.start()
+
+    async def on_cleanup(app):
+        await service.batcher.stop()
+        if hasattr(service.vector_index, 'close'):
+            service.vector_index.close()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def main(args):
+    service = SearchService(args)
+    print(f"Dịch vụ tìm kiếm sẵn sàng trên {len(service.image_paths)} ảnh (backend {args.backend})")
+    web.run_app(create_app(service), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dịch vụ HTTP tìm kiếm ảnh")
+    parser.add_argument('--images_dir', type=str, default='./images')
+    parser.add_argument('--checkpoint', type=str, default=DEFAULT_CHECKPOINT)
+    parser.add_argument('--model', type=str, default='ViT-B/32')
+    parser.add_argument('--index_dir', type=str, default='./index')
+    parser.add_argument('--refresh_index', action='store_true',
+                        help="Đồng bộ chỉ mục với thư mục ảnh khi khởi động (mặc định chỉ nạp chỉ mục đã lập)")
+    parser.add_argument('--text_only', action='store_true',
+                        help="Chỉ nạp tháp văn bản (checkpoint phải là file của inference_model.py, chỉ mục phải có sẵn)")
+    parser.add_argument('--shards_dir', type=str, default=None,
+                        help="Thư mục shard của sharded_search.py; mỗi shard chạy trong một tiến trình con")
+    parser.add_argument('--shard_urls', type=str, nargs='+', default=None,
+                        help="URL các shard chạy `sharded_search.py serve` trên máy khác")
+    parser.add_argument('--shard_poll_interval', type=float, default=5.0,
+                        help="Số giây giữa hai lần dò shard được lập lại (0 = chỉ dò khi tìm kiếm)")
+    parser.add_argument('--metadata', type=str, default='metadata.csv',
+                        help="metadata.csv để lập chỉ mục thuộc tính (màu, kiểu dáng) cho bộ lọc")
+    parser.add_argument('--backend', type=str, default='exact', choices=BACKENDS)
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_wait_ms', type=float, default=5.0)
+    parser.add_argument('--text_cache_size', type=int, default=4096)
+    parser.add_argument('--result_cache_size', type=int, default=1024)
+    parser.add_argument('--profile', action='store_true',
+                        help="Đo thêm từng bước encode_text / search / similarity / topk (đồng bộ GPU, chậm hơn một chút)")
+    parser.add_argument('--stats_log_interval', type=float, default=None,
+                        help="In bảng độ trễ ra log sau mỗi khoảng này (giây)")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,536 @@
+# Tên file: sharded_search.py
+# Tìm kiếm trên kho ảnh chia thành nhiều shard. Mỗi shard là một chỉ mục riêng của image_index.py
+# (index/shards/<tên shard>), được lập lại độc lập với các shard khác và được một tiến trình worker
+# riêng phục vụ: cùng máy (multiprocessing, LocalShard) hoặc máy khác qua HTTP (RemoteShard).
+# ShardedIndex gửi embedding câu truy vấn tới mọi shard, nhận top-k cục bộ rồi trộn bằng k-way
+# heap merge; nó có cùng giao diện search() với các chỉ mục trong vector_index.py.
+#
+#   python sharded_search.py index --images_dir ./images --shards_dir index/shards --shard_by folder
+#   python sharded_search.py serve --index_dir index/shards/Audi --port 8101
+#   python sharded_search.py query --shards_dir index/shards "xe SUV màu trắng"
+
+import os
+import json
+import asyncio
+import zlib
+import heapq
+import argparse
+import threading
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+
+import numpy as np
+import torch
+
+import search_client
+from image_index import (load_clip_model, load_index, refresh_index, list_image_paths,
+                         DEFAULT_BATCH_SIZE, DEFAULT_NUM_WORKERS, DEFAULT_CHECKPOINT, MANIFEST_FILE)
+from vector_index import build_vector_index, _as_float32_numpy, BACKENDS, SCORE_MODES, DEFAULT_SCORE_MODE, \
+    DEFAULT_CHUNK_SIZE
+
+SHARD_BY = ("folder", "hash")
+SHARDS_FILE = "shards.json"
+ROOT_SHARD = "_root"
+
+
+def _in_root_dir(root, path):
+    return os.path.normpath(os.path.dirname(path)) == os.path.normpath(root)
+
+
+def _in_hash_shard(root, shard, num_shards, path):
+    relpath = os.path.relpath(path, root).replace('\\', '/')
+    return zlib.crc32(relpath.encode('utf-8')) % num_shards == shard
+
+
+def shard_specs(images_dir, shard_by="folder", num_shards=4):
+    """
+    Trả về dict tên shard -> (thư mục ảnh, path_filter) cho refresh_index.
+    - "folder": mỗi thư mục con (hãng xe) là một shard; ảnh nằm ngay trong images_dir thuộc "_root".
+    - "hash":   ảnh được chia theo crc32 của đường dẫn tương đối vào `num_shards` shard.
+    """
+    if shard_by == "folder":
+        specs = {name: (os.path.join(images_dir, name), None) for name in sorted(os.listdir(images_dir))
+                 if os.path.isdir(os.path.join(images_dir, name))}
+        if any(_in_root_dir(images_dir, path) for path in list_image_paths(images_dir)):
+            specs[ROOT_SHARD] = (images_dir, partial(_in_root_dir, images_dir))
+        return specs
+    if shard_by == "hash":
+        return {f"shard-{i:03d}": (images_dir, partial(_in_hash_shard, images_dir, i, num_shards))
+                for i in range(num_shards)}
+    raise ValueError(f"shard_by phải là một trong {SHARD_BY}")
+
+
+def read_shard_layout(shards_dir):
+    with open(os.path.join(shards_dir, SHARDS_FILE), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def build_shards(model, preprocess, device, images_dir, shards_dir, checkpoint_path, base_model='ViT-B/32',
+                 shard_by="folder", num_shards=4, only=None, **encode_kwargs):
+    """
+    Lập/cập nhật chỉ mục của từng shard (tăng dần như refresh_index). `only` giới hạn các shard cần
+    lập lại; các shard khác giữ nguyên. Trả về dict tên shard -> report.
+    """
+    specs = shard_specs(images_dir, shard_by, num_shards)
+    reports = {}
+    for name, (image_dir, path_filter) in specs.items():
+        if only and name not in only:
+            continue
+        try:
+            _, _, _, reports[name] = refresh_index(model, preprocess, device, image_dir,
+                                                   os.path.join(shards_dir, name), checkpoint_path, base_model,
+                                                   path_filter=path_filter, **encode_kwargs)
+        except FileNotFoundError as e:
+            print(f"Bỏ qua shard {name}: {e}")
+
+    names = [name for name in specs if os.path.isdir(os.path.join(shards_dir, name))]
+    layout = {'images_dir': os.path.abspath(images_dir), 'shard_by': shard_by, 'num_shards': num_shards,
+              'shards': names}
+    tmp_path = os.path.join(shards_dir, SHARDS_FILE + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(layout, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, os.path.join(shards_dir, SHARDS_FILE))
+    return reports
+
+
+class ShardSearcher:
+    """
+    Phục vụ tìm kiếm trên một shard (chạy trong tiến trình worker). Trả về cosine thô của top-k cục
+    bộ và, khi cần, log-sum-exp của 100 * cosine trên cả shard để coordinator tính được đúng
+    softmax trên toàn bộ kho ảnh. Trước mỗi lần tìm, manifest của shard được stat lại; nếu shard đã
+    được lập lại (`sharded_search.py index --only ...`) thì chỉ mục mới được nạp và version đổi theo.
+    """
+    def __init__(self, index_dir, backend="exact", chunk_size=DEFAULT_CHUNK_SIZE, **backend_params):
+        self.index_dir = index_dir
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self.backend_params = backend_params
+        self.reload()
+
+    def _manifest_stat(self):
+        try:
+            st = os.stat(os.path.join(self.index_dir, MANIFEST_FILE))
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def reload(self):
+        self._loaded_stat = self._manifest_stat()
+        loaded = load_index(self.index_dir)
+        if loaded is None:
+            raise FileNotFoundError(f"Chưa có chỉ mục hợp lệ trong {self.index_dir}")
+        embeddings, self.image_paths, manifest = loaded
+        self.image_features = torch.from_numpy(embeddings)
+        self.vector_index = build_vector_index(self.image_features, self.backend, index_dir=self.index_dir,
+                                               index_tag=manifest['generation'], **self.backend_params)
+        self.version = f"{manifest['key']}:{manifest['generation']}"
+
+    def maybe_reload(self):
+        if self._manifest_stat() != self._loaded_stat:
+            try:
+                self.reload()
+            except Exception as e:
+                # Giữ chỉ mục đang phục vụ; lần lập lại kế tiếp (manifest đổi) sẽ thử nạp lại
+                print(f"Không nạp lại được shard {self.index_dir}: {e}")
+
+    def info(self):
+        return {'index_dir': self.index_dir, 'version': self.version, 'paths': list(self.image_paths)}
+
+    def poll(self):
+        """
+        info() sau khi nạp lại chỉ mục nếu shard đã được lập lại (coordinator dùng để dò version).
+        """
+        self.maybe_reload()
+        return self.info()
+
+    def _logsumexp(self, text_features):
+        parts = [torch.logsumexp(100.0 * text_features @ self.image_features[start:start + self.chunk_size].T,
+                                 dim=-1)
+                 for start in range(0, self.image_features.shape[0], self.chunk_size)]
+        return torch.logsumexp(torch.stack(parts, dim=-1), dim=-1)
+
+    def search(self, text_features, top_k, with_lse=False):
+        """
+        Trả về {'version', 'hits', 'lse'} với hits[q] là list (cosine, chỉ số trong shard) giảm dần.
+        """
+        self.maybe_reload()
+        text_features = torch.as_tensor(np.asarray(text_features, dtype=np.float32))
+        with torch.no_grad():
+            values, indices = self.vector_index.search(text_features, top_k, score_mode="cosine")
+            lse = self._logsumexp(text_features).tolist() if with_lse else None
+        hits = [[(v, j) for v, j in zip(row_values, row_indices) if j >= 0]
+                for row_values, row_indices in zip(values.tolist(), indices.tolist())]
+        return {'version': self.version, 'hits': hits, 'lse': lse}
+
+
+def _shard_worker(conn, index_dir, backend, num_threads, backend_params):
+    torch.set_num_threads(num_threads)
+    try:
+        searcher = ShardSearcher(index_dir, backend, **backend_params)
+    except Exception as e:
+        conn.send(('error', f"{type(e).__name__}: {e}"))
+        return
+    conn.send(('ok', searcher.info()))
+    while True:
+        try:
+            command, payload = conn.recv()
+        except EOFError:
+            break
+        if command == 'close':
+            break
+        try:
+            if command == 'search':
+                conn.send(('ok', searcher.search(*payload)))
+            elif command == 'reload':
+                searcher.reload()
+                conn.send(('ok', searcher.info()))
+            elif command == 'info':
+                conn.send(('ok', searcher.poll()))
+            else:
+                conn.send(('error', f"Lệnh không hợp lệ: {command}"))
+        except Exception as e:
+            conn.send(('error', f"{type(e).__name__}: {e}"))
+
+
+class LocalShard:
+    """
+    Một shard chạy trong tiến trình con trên cùng máy (thay cho một node khi không có cluster).
+    submit() gửi yêu cầu, result() chờ trả lời; mỗi lúc chỉ một yêu cầu cho mỗi shard.
+    """
+    def __init__(self, index_dir, backend="exact", num_threads=1, **backend_params):
+        self.name = os.path.basename(os.path.normpath(index_dir))
+        ctx = mp.get_context("spawn")
+        self._conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_shard_worker, daemon=True,
+                                   args=(child_conn, index_dir, backend, num_threads, backend_params))
+        self.process.start()
+        child_conn.close()
+        self._lock = threading.Lock()
+        self._lock.acquire()
+        self.info = self.result()
+
+    def submit(self, command, payload=None):
+        self._lock.acquire()
+        try:
+            self._conn.send((command, payload))
+        except Exception:
+            self._lock.release()
+            raise
+
+    def result(self):
+        try:
+            status, payload = self._conn.recv()
+        except EOFError:
+            raise RuntimeError(f"Shard {self.name} đã dừng")
+        finally:
+            self._lock.release()
+        if status != 'ok':
+            raise RuntimeError(f"Shard {self.name}: {payload}")
+        return payload
+
+    def close(self):
+        try:
+            self._conn.send(('close', None))
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+
+
+class RemoteShard:
+    """
+    Shard chạy trên máy khác (`python sharded_search.py serve`), gọi qua HTTP với cùng giao diện
+    submit()/result() như LocalShard (kể cả khoá: mỗi lúc chỉ một yêu cầu cho mỗi shard).
+    """
+    def __init__(self, url, timeout=30.0):
+        self.name = url
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future = None
+        self._lock = threading.Lock()
+        self.submit('info')
+        self.info = self.result()
+
+    def _request(self, command, payload):
+        if command == 'search':
+            features, top_k, with_lse = payload
+            return search_client.shard_search(self.url, np.asarray(features, dtype=np.float32).tolist(), top_k,
+                                              with_lse, self.timeout)
+        if command == 'reload':
+            return search_client.shard_reload(self.url, self.timeout)
+        return search_client.shard_info(self.url, self.timeout)
+
+    def submit(self, command, payload=None):
+        self._lock.acquire()
+        try:
+            self._future = self._executor.submit(self._request, command, payload)
+        except Exception:
+            self._lock.release()
+            raise
+
+    def result(self):
+        try:
+            return self._future.result()
+        finally:
+            self._future = None
+            self._lock.release()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+def merge_topk(hit_lists, top_k):
+    """
+    k-way heap merge các list (điểm, chỉ số) đã sắp giảm dần; trả về top_k phần tử lớn nhất.
+    """
+    return list(islice(heapq.merge(*hit_lists, key=lambda hit: -hit[0]), top_k))
+
+
+class ShardedIndex:
+    """
+    Coordinator: có cùng giao diện search()/len() như ExactIndex. Chỉ số trả về trỏ vào
+    `image_paths` (nối danh sách ảnh các shard theo thứ tự). Khi một shard đã được lập lại
+    (version khác), bố cục được đọc lại từ các shard rồi tìm lại một lần. search() và reload()
+    chạy tuần tự (khoá) để không lần nào trộn kết quả theo bố cục đang bị thay. Với `shards_dir` và
+    `open_shard(tên)` (xem open_local_shards), reload() còn đọc lại shards.json để mở shard mới thêm
+    và đóng shard đã bỏ.
+    """
+    backend = "sharded"
+
+    def __init__(self, shards, shards_dir=None, open_shard=None):
+        self.shards = list(shards)
+        if not self.shards:
+            raise ValueError("Cần ít nhất một shard")
+        self.shards_dir = shards_dir
+        self._open_shard = open_shard
+        self._lock = threading.Lock()
+        self._set_layout([shard.info for shard in self.shards])
+
+    def _set_layout(self, infos):
+        paths, self.offsets = [], []
+        for info in infos:
+            self.offsets.append(len(paths))
+            paths.extend(info['paths'])
+        # Gán danh sách mới (không sửa tại chỗ) để bản chụp search_snapshot đã trả ra vẫn đúng
+        self.image_paths = paths
+        self.versions = [info['version'] for info in infos]
+        self.version = "|".join(self.versions)
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def _fan_out(self, command, payload=None):
+        # Luôn đọc trả lời của mọi shard đã gửi (kể cả khi gửi tới shard sau bị lỗi) để không shard
+        # nào còn giữ khoá hay trả lời chưa đọc cho lần tìm kiếm sau.
+        submitted, error = [], None
+        for shard in self.shards:
+            try:
+                shard.submit(command, payload)
+            except Exception as e:
+                error = e
+                break
+            submitted.append(shard)
+        responses = []
+        for shard in submitted:
+            try:
+                responses.append(shard.result())
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return responses
+
+    def reload(self):
+        """
+        Yêu cầu mọi shard nạp lại chỉ mục từ đĩa; với shard cục bộ, danh sách shard cũng được đọc
+        lại từ shards.json (sau khi thêm hoặc bỏ shard).
+        """
+        with self._lock:
+            if self.shards_dir is not None and self._open_shard is not None:
+                self._update_shards(read_shard_layout(self.shards_dir)['shards'])
+            self._set_layout(self._fan_out('reload'))
+
+    def refresh(self):
+        """
+        Hỏi version hiện tại của mọi shard (shard đã được lập lại tự nạp chỉ mục mới) và cập nhật bố
+        cục nếu có shard đổi. Khác search(), không cần một lần tìm kiếm thật nên dùng được để dò định kỳ.
+        """
+        with self._lock:
+            infos = self._fan_out('info')
+            if [info['version'] for info in infos] != self.versions:
+                self._set_layout(infos)
+
+    def _update_shards(self, names):
+        if not names:
+            raise ValueError(f"shards.json trong {self.shards_dir} không có shard nào")
+        current = {shard.name: shard for shard in self.shards}
+        self.shards = [current.pop(name) if name in current else self._open_shard(name) for name in names]
+        for shard in current.values():
+            shard.close()
+
+    def search(self, text_features, top_k, score_mode=DEFAULT_SCORE_MODE):
+        with self._lock:
+            return self._search(text_features, top_k, score_mode)
+
+    def search_snapshot(self, text_features, top_k, score_mode=DEFAULT_SCORE_MODE):
+        """
+        Như search nhưng trả thêm (image_paths, version) của đúng bố cục đã dùng, lấy trong khoá:
+        bố cục có thể đổi ngay sau đó (shard được lập lại) nên chỉ số chỉ tra trong danh sách này.
+        """
+        with self._lock:
+            values, indices = self._search(text_features, top_k, score_mode)
+            return values, indices, self.image_paths, self.version
+
+    def _search(self, text_features, top_k, score_mode):
+        top_k = min(top_k, len(self))
+        features = _as_float32_numpy(text_features)
+        responses = self._fan_out('search', (features, top_k, score_mode == "softmax"))
+        if [r['version'] for r in responses] != self.versions:
+            self._set_layout(self._fan_out('info'))
+            responses = self._fan_out('search', (features, top_k, score_mode == "softmax"))
+
+        values = torch.full((features.shape[0], top_k), float("-inf"))
+        indices = torch.full((features.shape[0], top_k), -1, dtype=torch.long)
+        for q in range(features.shape[0]):
+            hit_lists = [[(v, offset + j) for v, j in response['hits'][q]]
+                         for response, offset in zip(responses, self.offsets)]
+            merged = merge_topk(hit_lists, top_k)
+            if merged:
+                values[q, :len(merged)] = torch.tensor([v for v, _ in merged])
+                indices[q, :len(merged)] = torch.tensor([j for _, j in merged])
+
+        if score_mode == "softmax":
+            lse = torch.logsumexp(torch.tensor([r['lse'] for r in responses]), dim=0)
+            values = (100.0 * values - lse[:, None]).exp()
+        elif score_mode == "topk":
+            values = (100.0 * values).softmax(dim=-1)
+        return values, indices
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+def open_local_shards(shards_dir, backend="exact", num_threads=1, **backend_params):
+    def open_shard(name):
+        return LocalShard(os.path.join(shards_dir, name), backend, num_threads, **backend_params)
+
+    layout = read_shard_layout(shards_dir)
+    return ShardedIndex([open_shard(name) for name in layout['shards']], shards_dir=shards_dir,
+                        open_shard=open_shard)
+
+
+def open_remote_shards(urls, timeout=30.0):
+    return ShardedIndex([RemoteShard(url, timeout) for url in urls])
+
+
+def create_shard_app(searcher):
+    from aiohttp import web
+
+    lock = threading.Lock()
+
+    def _locked(fn, *args):
+        with lock:
+            return fn(*args)
+
+    async def handle_search(request):
+        body = await request.json()
+        features = np.asarray(body['features'], dtype=np.float32)
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, _locked, searcher.search, features, int(body['top_k']),
+                                            bool(body.get('with_lse')))
+        return web.json_response(result)
+
+    async def handle_info(request):
+        loop = asyncio.get_running_loop()
+        return web.json_response(await loop.run_in_executor(None, _locked, searcher.poll))
+
+    async def handle_reload(request):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, _locked, searcher.reload)
+        return web.json_response(searcher.info())
+
+    app = web.Application(client_max_size=64 * 2 ** 20)
+    app.router.add_post('/shard/search', handle_search)
+    app.router.add_get('/shard/info', handle_info)
+    app.router.add_post('/shard/reload', handle_reload)
+    return app
+
+
+def main_index(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model, preprocess = load_clip_model(args.checkpoint, device, args.model)
+    build_shards(model, preprocess, device, args.images_dir, args.shards_dir, args.checkpoint, args.model,
+                 shard_by=args.shard_by, num_shards=args.num_shards, only=args.only,
+                 full=args.full, batch_size=args.batch_size, num_workers=args.num_workers)
+
+
+def main_serve(args):
+    from aiohttp import web
+
+    searcher = ShardSearcher(args.index_dir, args.backend)
+    print(f"Shard {args.index_dir}: {len(searcher.image_paths)} ảnh (backend {args.backend})")
+    web.run_app(create_shard_app(searcher), host=args.host, port=args.port)
+
+
+def main_query(args):
+    from search_engine import search_many
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model, _ = load_clip_model(args.checkpoint, device, args.model)
+    if args.shard_urls:
+        index = open_remote_shards(args.shard_urls)
+    else:
+        index = open_local_shards(args.shards_dir, args.backend)
+    try:
+        print(f"{len(index.shards)} shard, {len(index)} ảnh")
+        results = search_many(args.queries, model, device, index, index.image_paths, top_k=args.top_k,
+                              score_mode=args.score_mode)
+        for query, hits in zip(args.queries, results):
+            print(f"\n{query}")
+            for path, score in hits:
+                print(f"  {score:.4f}  {path}")
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tìm kiếm trên kho ảnh chia shard")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('index', help="Lập/cập nhật chỉ mục các shard")
+    p.add_argument('--images_dir', type=str, default='./images')
+    p.add_argument('--checkpoint', type=str, default=DEFAULT_CHECKPOINT)
+    p.add_argument('--model', type=str, default='ViT-B/32')
+    p.add_argument('--shards_dir', type=str, default='./index/shards')
+    p.add_argument('--shard_by', type=str, default='folder', choices=SHARD_BY)
+    p.add_argument('--num_shards', type=int, default=4, help="Số shard khi --shard_by hash")
+    p.add_argument('--only', type=str, nargs='+', default=None, help="Chỉ lập lại các shard này")
+    p.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE)
+    p.add_argument('--num_workers', type=int, default=DEFAULT_NUM_WORKERS)
+    p.add_argument('--full', action='store_true')
+    p.set_defaults(func=main_index)
+
+    p = subparsers.add_parser('serve', help="Phục vụ một shard qua HTTP (một node)")
+    p.add_argument('--index_dir', type=str, required=True)
+    p.add_argument('--backend', type=str, default='exact', choices=BACKENDS)
+    p.add_argument('--host', type=str, default='0.0.0.0')
+    p.add_argument('--port', type=int, default=8101)
+    p.set_defaults(func=main_serve)
+
+    p = subparsers.add_parser('query', help="Tìm kiếm thử qua coordinator")
+    p.add_argument('queries', nargs='+')
+    p.add_argument('--checkpoint', type=str, default=DEFAULT_CHECKPOINT)
+    p.add_argument('--model', type=str, default='ViT-B/32')
+    p.add_argument('--shards_dir', type=str, default='./index/shards')
+    p.add_argument('--shard_urls', type=str, nargs='+', default=None,
+                   help="URL các shard đang chạy `serve`; mặc định chạy mỗi shard trong một tiến trình con")
+    p.add_argument('--backend', type=str, default='exact', choices=BACKENDS)
+    p.add_argument('--top_k', type=int, default=5)
+    p.add_argument('--score_mode', type=str, default=DEFAULT_SCORE_MODE, choices=SCORE_MODES)
+    p.set_defaults(func=main_query)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,108 @@
+# Tên file: thumbnails.py
+# Cache ảnh thu nhỏ (JPEG, cạnh dài tối đa `size` px) cho lưới kết quả của app.py, lưu cạnh chỉ mục
+# embedding trong index_dir/thumbnails/<size>/. Tên file là sha1 nội dung ảnh gốc (đã có trong
+# manifest của image_index.py), nên ảnh không đổi giữ nguyên thumbnail qua các lần lập chỉ mục và
+# chỉ ảnh mới/sửa mới phải tạo lại.
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+THUMBNAIL_DIR = "thumbnails"
+DEFAULT_THUMBNAIL_SIZE = 320
+THUMBNAIL_QUALITY = 85
+_COMPLETE_FILE = "complete.json"
+
+
+def thumbnail_dir(index_dir, size=DEFAULT_THUMBNAIL_SIZE):
+    return os.path.join(index_dir, THUMBNAIL_DIR, str(size))
+
+
+def thumbnail_file(index_dir, sha1, size=DEFAULT_THUMBNAIL_SIZE):
+    return os.path.join(thumbnail_dir(index_dir, size), sha1[:2], sha1 + ".jpg")
+
+
+def make_thumbnail(image_path, target, size=DEFAULT_THUMBNAIL_SIZE):
+    """
+    Ghi thumbnail của image_path ra target. Với JPEG, draft() giải mã thẳng ở độ phân giải thấp
+    nên nhanh hơn nhiều so với giải mã ảnh gốc rồi mới thu nhỏ.
+    """
+    with Image.open(image_path) as image:
+        image.draft("RGB", (size, size))
+        image = image.convert("RGB")
+    image.thumbnail((size, size), Image.Resampling.LANCZOS)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = target + ".tmp"
+    image.save(tmp_path, format="JPEG", quality=THUMBNAIL_QUALITY)
+    os.replace(tmp_path, target)
+
+
+def _remove_orphans(directory, keep):
+    removed = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.endswith(".jpg") and name[:-4] not in keep:
+                os.remove(os.path.join(root, name))
+                removed += 1
+    return removed
+
+
+def refresh_thumbnails(index_dir, files, size=DEFAULT_THUMBNAIL_SIZE, changed=None, stale=(), num_workers=4):
+    """
+    Đồng bộ cache thumbnail với `files` ({đường dẫn: {'sha1': ...}} trong manifest của chỉ mục).
+    `changed` là các ảnh mới/sửa cần tạo thumbnail; None (hoặc khi cache chưa từng được tạo đầy đủ)
+    nghĩa là duyệt mọi ảnh, tạo thumbnail còn thiếu và xoá thumbnail không còn dùng. `stale` là sha1
+    của các ảnh đã xoá/sửa; thumbnail của chúng bị xoá nếu không còn ảnh nào khác cùng nội dung.
+    Ảnh lỗi bị bỏ qua (app hiển thị ảnh gốc). Trả về {'created', 'removed', 'failed'}.
+    """
+    directory = thumbnail_dir(index_dir, size)
+    complete_path = os.path.join(directory, _COMPLETE_FILE)
+    full = changed is None or not os.path.exists(complete_path)
+    current = {state['sha1'] for state in files.values() if state.get('sha1')}
+
+    todo, seen = {}, set()
+    for path in (files if full else changed):
+        sha1 = files.get(path, {}).get('sha1')
+        if sha1 and sha1 not in seen:
+            seen.add(sha1)
+            if not os.path.exists(thumbnail_file(index_dir, sha1, size)):
+                todo[path] = sha1
+
+    def create(item):
+        path, sha1 = item
+        try:
+            make_thumbnail(path, thumbnail_file(index_dir, sha1, size), size)
+            return True
+        except Exception as e:
+            print(f"Bỏ qua thumbnail lỗi {path}: {e}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        created = sum(executor.map(create, todo.items()))
+
+    removed = 0
+    if full:
+        removed = _remove_orphans(directory, current)
+        os.makedirs(directory, exist_ok=True)
+        with open(complete_path, 'w', encoding='utf-8') as f:
+            json.dump({'size': size, 'count': len(current)}, f)
+    else:
+        for sha1 in set(stale) - current:
+            try:
+                os.remove(thumbnail_file(index_dir, sha1, size))
+                removed += 1
+            except OSError:
+                pass
+    return {'created': created, 'removed': removed, 'failed': len(todo) - created}
+
+
+def thumbnail_map(index_dir, manifest, size=DEFAULT_THUMBNAIL_SIZE):
+    """
+    {đường dẫn ảnh gốc: đường dẫn thumbnail} theo manifest của chỉ mục (file có thể chưa tồn tại).
+    """
+    if not manifest:
+        return {}
+    return {path: thumbnail_file(index_dir, state['sha1'], size)
+            for path, state in manifest.get('files', {}).items() if state.get('sha1')}
@@ -1,15 +1,27 @@
 import os
+import re
+import json
+import time
+import queue
+import random
+import shutil
+import hashlib
 import argparse
+import threading
+from functools import partial
+import numpy as np
 import pandas as pd
 from PIL import Image
 from tqdm import tqdm
 
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from torchvision import transforms
 import clip  
 from torch import nn, optim
 
+from inference_model import make_inference_artifact
+
 class ImageTextDataset(Dataset):
     def __init__(self, images_dir, metadata_csv, transform=None,
                  filename_col='filename', caption_col='caption'):
@@ -52,22 +64,153 @@ class ImageTextDataset(Dataset):
             image = Image.open(path).convert('RGB')
             if self.transform:
                 image = self.transform(image)
-            return image, caption
+            # Caption đã được tokenize sẵn (build_caption_tokens); collate lấy theo chỉ số dòng
+            return image, idx
         except FileNotFoundError:
             print(f"\nLỖI NGHIÊM TRỌNG: Không thể tìm thấy file tại đường dẫn: {path}")
             print("Vui lòng đảm bảo tên file trong metadata.csv và tên file trong thư mục images khớp nhau.")
             raise
 
-def collate_fn(batch, tokenizer, device):
-    images, captions = zip(*batch)
+class _DecodeCropDataset(Dataset):
+    """
+    Chỉ dùng khi tạo cache: giải mã ảnh gốc và resize/center-crop thành mảng uint8 (H, W, 3).
+    """
+    def __init__(self, images_dir, filenames, image_size):
+        self.images_dir = images_dir
+        self.filenames = filenames
+        self.transform = transforms.Compose([
+            transforms.Resize(int(image_size / 0.875)),
+            transforms.CenterCrop(image_size),
+        ])
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, idx):
+        path = os.path.join(self.images_dir, str(self.filenames[idx]))
+        image = self.transform(Image.open(path).convert('RGB'))
+        return idx, torch.from_numpy(np.asarray(image, dtype=np.uint8).copy())
+
+def _file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _image_cache_info(dataset, metadata_csv, image_size):
+    return {
+        'metadata_sha1': _file_sha1(metadata_csv),
+        'images_dir': os.path.abspath(dataset.images_dir),
+        'image_size': image_size,
+        'count': len(dataset),
+    }
+
+def build_image_cache(dataset, metadata_csv, image_size, cache_path, num_workers=0):
+    """
+    Giải mã, resize và center-crop toàn bộ ảnh của dataset một lần rồi ghi vào một file .npy
+    uint8 (N, S, S, 3) có thể memory-map; dòng i ứng với dòng i của metadata.csv (dataset.items).
+    File .json đi kèm lưu thông tin để phát hiện cache cũ khi metadata.csv hoặc kích thước ảnh đổi.
+    """
+    info = _image_cache_info(dataset, metadata_csv, image_size)
+    index_path = cache_path + ".json"
+    if os.path.exists(cache_path) and os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            if json.load(f).get('info') == info:
+                print(f"Dùng lại cache ảnh {cache_path}")
+                return
+
+    filenames = [fname for fname, _ in dataset.items]
+    tmp_path = cache_path + ".tmp.npy"
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                       shape=(len(filenames), image_size, image_size, 3))
+    loader = DataLoader(_DecodeCropDataset(dataset.images_dir, filenames, image_size),
+                        batch_size=64, num_workers=num_workers)
+    for indices, batch in tqdm(loader, desc="Tạo cache ảnh"):
+        images[indices.numpy()] = batch.numpy()
+    images.flush()
+    del images
+    os.replace(tmp_path, cache_path)
+
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump({'info': info, 'filenames': filenames}, f, ensure_ascii=False)
+    print(f"Đã ghi cache {len(filenames)} ảnh {image_size}x{image_size} vào {cache_path}")
+
+class CachedImageTextDataset(ImageTextDataset):
+    """
+    Giống ImageTextDataset nhưng đọc ảnh đã resize/crop sẵn từ cache memory-map (build_image_cache),
+    chỉ còn lật ngẫu nhiên và chuẩn hoá ở mỗi bước.
+    """
+    def __init__(self, images_dir, metadata_csv, cache_path, transform=None,
+                 filename_col='filename', caption_col='caption'):
+        super().__init__(images_dir, metadata_csv, transform=transform,
+                         filename_col=filename_col, caption_col=caption_col)
+        self.cache_path = cache_path
+        self._images = None
+
+    def __getitem__(self, idx):
+        # Mở memory-map trong từng worker (không pickle mảng sang tiến trình con)
+        if self._images is None:
+            self._images = np.load(self.cache_path, mmap_mode='c')
+        image = torch.from_numpy(self._images[idx]).permute(2, 0, 1)
+        if self.transform:
+            image = self.transform(image)
+        return image, idx
+
+def build_caption_tokens(dataset, metadata_csv, tokenizer, cache_path, caption_col='caption'):
+    """
+    Tokenize toàn bộ caption một lần và lưu thành tensor (N, context_length) theo thứ tự dòng của
+    dataset. Cache được tạo lại khi nội dung metadata.csv (sha1) hoặc cột caption thay đổi.
+    """
+    key = {'metadata_sha1': _file_sha1(metadata_csv), 'caption_col': caption_col, 'count': len(dataset)}
+    if os.path.exists(cache_path):
+        state = torch.load(cache_path)
+        if state.get('key') == key:
+            print(f"Dùng lại caption đã tokenize từ {cache_path}")
+            return state['tokens']
+
+    tokens = tokenizer([str(caption) for _, caption in dataset.items], truncate=True)
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    torch.save({'key': key, 'tokens': tokens}, tmp_path)
+    os.replace(tmp_path, cache_path)
+    print(f"Đã tokenize {len(tokens)} caption vào {cache_path}")
+    return tokens
+
+def collate_fn(batch, caption_tokens):
+    # Chạy trong worker của DataLoader: chỉ ghép tensor trên CPU, việc chuyển sang device do vòng lặp huấn luyện làm
+    images, indices = zip(*batch)
     images = torch.stack(images, dim=0)
-    text_tokens = tokenizer(list(captions), truncate=True).to(device)
+    text_tokens = caption_tokens[torch.tensor(indices)]
     return images, text_tokens
 
-def make_collate_fn(tokenizer, device):
-    def _fn(batch):
-        return collate_fn(batch, tokenizer, device)
-    return _fn
+def make_collate_fn(caption_tokens):
+    # partial (thay vì closure) để pickle được khi DataLoader dùng spawn (Windows)
+    return partial(collate_fn, caption_tokens=caption_tokens)
+
+class EpochShuffleSampler(Sampler):
+    """
+    Xáo trộn theo (seed, epoch) nên thứ tự của mỗi epoch tái lập được khi resume; `start` bỏ qua
+    các mẫu đã huấn luyện trong epoch đang dở.
+    """
+    def __init__(self, num_samples, seed):
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(self.num_samples, generator=generator)
+        return iter(order[self.start:].tolist())
+
+    def __len__(self):
+        return self.num_samples - self.start
 
 def build_transforms(image_size):
     return transforms.Compose([
@@ -79,58 +222,275 @@ def build_transforms(image_size):
                              std=(0.26862954, 0.26130258, 0.27577711)),
     ])
 
-def train_epoch(model, dataloader, optimizer, device, epoch):
-    model.train()
+def build_cached_transforms():
+    # Ảnh trong cache đã được resize + center-crop, chỉ còn các bước rẻ trên tensor uint8 (C, H, W)
+    return transforms.Compose([
+        transforms.ConvertImageDtype(torch.float),
+        transforms.RandomHorizontalFlip(p=0.5),
+        transforms.Normalize(mean=(0.48145466, 0.4578275, 0.40821073),
+                             std=(0.26862954, 0.26130258, 0.27577711)),
+    ])
+
+def contrastive_loss(image_features, text_features, logit_scale):
     ce = nn.CrossEntropyLoss()
+    image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+    text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+
+    logits_per_image = logit_scale * image_features @ text_features.t()
+    logits_per_text = logits_per_image.t()
+
+    targets = torch.arange(image_features.shape[0], device=image_features.device)
+    loss_i = ce(logits_per_image, targets)
+    loss_t = ce(logits_per_text, targets)
+    return (loss_i + loss_t) / 2, logits_per_image, targets
+
+def make_autocast(device, precision):
+    # bf16 autocast chạy được cả trên CPU; fp32 giữ nguyên hành vi cũ
+    device_type = "cuda" if str(device).startswith("cuda") else "cpu"
+    return partial(torch.autocast, device_type=device_type, dtype=torch.bfloat16, enabled=(precision == "bf16"))
+
+def _train_step(model, images, text_tokens, autocast):
+    with autocast():
+        image_features = model.encode_image(images)
+        text_features = model.encode_text(text_tokens)
+    loss, logits_per_image, targets = contrastive_loss(image_features.float(), text_features.float(),
+                                                       model.logit_scale.exp())
+    loss.backward()
+    return loss, logits_per_image, targets
+
+def _gradcache_step(model, micro_batches, autocast):
+    """
+    Bước contrastive trên cả nhóm micro-batch (kiểu GradCache): tính embedding của mọi micro-batch
+    không giữ đồ thị, tính loss với toàn bộ negative của nhóm trên embedding đã cache để lấy gradient
+    theo embedding, rồi forward lại từng micro-batch và lan truyền gradient đó vào model. Bộ nhớ
+    activation chỉ cỡ một micro-batch. CLIP không dùng dropout nên forward lần hai cho cùng kết quả.
+    """
+    with torch.no_grad(), autocast():
+        image_reps = torch.cat([model.encode_image(images).float() for images, _ in micro_batches])
+        text_reps = torch.cat([model.encode_text(tokens).float() for _, tokens in micro_batches])
+    image_reps.requires_grad_()
+    text_reps.requires_grad_()
+
+    # Gradient vào logit_scale được tích luỹ trực tiếp ở đây
+    loss, logits_per_image, targets = contrastive_loss(image_reps, text_reps, model.logit_scale.exp())
+    loss.backward()
+
+    offset = 0
+    for images, tokens in micro_batches:
+        n = images.shape[0]
+        with autocast():
+            image_features = model.encode_image(images).float()
+            text_features = model.encode_text(tokens).float()
+        torch.autograd.backward([image_features, text_features],
+                                [image_reps.grad[offset:offset + n], text_reps.grad[offset:offset + n]])
+        offset += n
+    return loss, logits_per_image, targets
+
+def train_epoch(model, dataloader, optimizer, device, epoch, accum_steps=1, precision="fp32",
+                start_batch=0, on_step=None):
+    """
+    Với accum_steps > 1, mỗi bước tối ưu gom `accum_steps` micro-batch và tính loss contrastive trên
+    toàn bộ batch * accum_steps cặp (nhiều negative hơn) bằng _gradcache_step.
+    `start_batch` là số batch đã huấn luyện của epoch này (khi resume); sau mỗi bước tối ưu,
+    on_step(số batch đã xong trong epoch) được gọi để lưu checkpoint giữa epoch.
+    """
+    model.train()
+    autocast = make_autocast(device, precision)
     total_loss = 0.0
     total_correct = 0
     total_samples = 0
+    num_steps = 0
+    start_time = time.time()
 
+    micro_batches = []
     pbar = tqdm(enumerate(dataloader), total=len(dataloader), desc=f"Epoch {epoch}")
     for i, (images, text_tokens) in pbar:
-        images = images.to(device)
-        text_tokens = text_tokens.to(device)
+        images = images.to(device, non_blocking=True)
+        text_tokens = text_tokens.to(device, non_blocking=True)
+        micro_batches.append((images, text_tokens))
+        if len(micro_batches) < accum_steps and i + 1 < len(dataloader):
+            continue
 
         optimizer.zero_grad()
-        image_features = model.encode_image(images)
-        text_features = model.encode_text(text_tokens)
-
-        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-
-        logit_scale = model.logit_scale.exp()
-        logits_per_image = logit_scale * image_features @ text_features.t()
-        logits_per_text = logits_per_image.t()
-
-        targets = torch.arange(images.shape[0], device=device)
-        loss_i = ce(logits_per_image, targets)
-        loss_t = ce(logits_per_text, targets)
-        loss = (loss_i + loss_t) / 2
-
-        loss.backward()
+        if len(micro_batches) == 1:
+            loss, logits_per_image, targets = _train_step(model, images, text_tokens, autocast)
+        else:
+            loss, logits_per_image, targets = _gradcache_step(model, micro_batches, autocast)
         optimizer.step()
+        micro_batches = []
+        if on_step is not None:
+            on_step(start_batch + i + 1)
 
         total_loss += loss.item()
+        num_steps += 1
 
         preds = logits_per_image.argmax(dim=1)
         correct = (preds == targets).sum().item()
         total_correct += correct
-        total_samples += images.size(0)
+        total_samples += targets.size(0)
 
         acc = total_correct / total_samples
-        pbar.set_postfix(loss=total_loss / (i + 1), acc=acc)
+        samples_per_sec = total_samples / (time.time() - start_time)
+        pbar.set_postfix(loss=total_loss / num_steps, acc=acc, sps=f"{samples_per_sec:.1f}")
 
-    avg_loss = total_loss / len(dataloader)
+    if num_steps == 0:
+        return float("nan"), float("nan")
+    avg_loss = total_loss / num_steps
     avg_acc = total_correct / total_samples
+    print(f"Epoch {epoch}: {total_samples / (time.time() - start_time):.1f} samples/sec")
     return avg_loss, avg_acc
 
-def save_checkpoint(model, optimizer, epoch, path):
-    state = {
+CHECKPOINT_PATTERN = re.compile(r"^clip_epoch_(\d+)(?:_step_(\d+))?\.pt$")
+
+def get_rng_state():
+    # Trạng thái numpy đổi sang list để checkpoint vẫn nạp được với torch.load(weights_only=True)
+    np_state = np.random.get_state()
+    return {
+        'python': random.getstate(),
+        'numpy': (np_state[0], np_state[1].tolist(), *np_state[2:]),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, keys, *rest = state['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), *rest))
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def make_checkpoint_state(model, optimizer, epoch, batches_done, epoch_finished, best_loss, seed):
+    return {
         'epoch': epoch,
+        'batches_done': batches_done,
+        'epoch_finished': epoch_finished,
+        'best_loss': best_loss,
+        'seed': seed,
         'model_state_dict': model.state_dict(),
-        'optimizer_state_dict': optimizer.state_dict()
+        'optimizer_state_dict': optimizer.state_dict(),
+        'rng_state': get_rng_state(),
     }
-    torch.save(state, path)
+
+def _cpu_snapshot(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _cpu_snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cpu_snapshot(v) for v in obj)
+    return obj
+
+def _atomic_save(obj, path):
+    tmp_path = path + ".tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+def export_inference_weights(artifact, source_path, path):
+    """
+    Ghi file trọng số suy luận (make_inference_artifact) kèm sha1 của checkpoint nguồn, để
+    image_index.py và server.py nhận ra hai file là cùng một trọng số. Chạy trên luồng nền của
+    AsyncCheckpointer sau khi source_path đã được ghi.
+    """
+    artifact['source'] = {'checkpoint': os.path.abspath(source_path), 'sha1': _file_sha1(source_path)}
+    _atomic_save(artifact, path)
+
+def list_checkpoints(output_dir):
+    """
+    Các checkpoint huấn luyện clip_epoch_<n>[_step_<s>].pt, sắp theo vị trí huấn luyện tăng dần
+    (checkpoint cuối epoch đứng sau mọi checkpoint giữa epoch đó).
+    """
+    found = []
+    for name in os.listdir(output_dir) if os.path.isdir(output_dir) else []:
+        match = CHECKPOINT_PATTERN.match(name)
+        if match:
+            step = int(match.group(2)) if match.group(2) else float("inf")
+            found.append(((int(match.group(1)), step), os.path.join(output_dir, name)))
+    return [path for _, path in sorted(found)]
+
+class AsyncCheckpointer:
+    """
+    Lưu checkpoint trên một luồng nền duy nhất: trạng thái được chép sang CPU ngay (để vòng huấn
+    luyện tiếp tục cập nhật trọng số) rồi xếp vào hàng đợi, luồng nền ghi lần lượt từng việc. Mỗi
+    snapshot chỉ serialize một lần; các đường dẫn còn lại (vd. clip_best.pt) là hard link tới file
+    đó (hoặc bản sao nếu hệ thống file không hỗ trợ link). run() xếp thêm một việc bất kỳ, chạy sau
+    các lần ghi đã xếp trước nó. Hàng đợi giới hạn `max_pending` việc để không giữ quá nhiều bản sao
+    trạng thái trong RAM; chỉ khi đầy save()/run() mới phải chờ. Sau mỗi việc chỉ giữ lại `keep_last` checkpoint
+    huấn luyện mới nhất (0 = giữ tất cả).
+    """
+    def __init__(self, output_dir, keep_last=3, max_pending=2):
+        self.output_dir = output_dir
+        self.keep_last = keep_last
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def save(self, state, paths):
+        self.run(partial(self._write, _cpu_snapshot(state), list(paths)))
+
+    def run(self, job):
+        self._raise_error()
+        self._queue.put(job)
+
+    def wait(self):
+        self._queue.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f"Lưu checkpoint thất bại: {error}") from error
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job()
+            except Exception as e:
+                self._error = e
+            finally:
+                del job
+                self._queue.task_done()
+
+    def _write(self, snapshot, paths):
+        first = paths[0]
+        _atomic_save(snapshot, first)
+        for path in paths[1:]:
+            tmp_path = path + ".tmp"
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            try:
+                os.link(first, tmp_path)
+            except OSError:
+                shutil.copyfile(first, tmp_path)
+            os.replace(tmp_path, path)
+        self._prune()
+
+    def _prune(self):
+        if self.keep_last <= 0:
+            return
+        for path in list_checkpoints(self.output_dir)[:-self.keep_last]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def resume_training(path, model, optimizer):
+    """
+    Nạp checkpoint huấn luyện; trả về (epoch bắt đầu, số batch đã xong của epoch đó, best_loss, seed).
+    Checkpoint cũ (chỉ có epoch/model/optimizer) được coi là đã xong trọn epoch.
+    """
+    checkpoint = torch.load(path, map_location="cpu")
+    model.load_state_dict(checkpoint['model_state_dict'])
+    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    if 'rng_state' in checkpoint:
+        set_rng_state(checkpoint['rng_state'])
+    epoch = checkpoint['epoch']
+    best_loss = checkpoint.get('best_loss', float("inf"))
+    if checkpoint.get('epoch_finished', True):
+        return epoch + 1, 0, best_loss, checkpoint.get('seed')
+    return epoch, checkpoint['batches_done'], best_loss, checkpoint.get('seed')
 
 def main(args):
     device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -140,37 +500,85 @@ def main(args):
     model, _ = clip.load(args.model, device=device, jit=False)
     tokenizer = clip.tokenize
     image_size = model.visual.input_resolution
-    transform = build_transforms(image_size)
 
-    dataset = ImageTextDataset(args.images_dir, args.metadata,
-                               transform=transform,
-                               filename_col=args.filename_col,
-                               caption_col=args.caption_col)
+    if args.image_cache:
+        dataset = CachedImageTextDataset(args.images_dir, args.metadata, args.image_cache,
+                                         transform=build_cached_transforms(),
+                                         filename_col=args.filename_col,
+                                         caption_col=args.caption_col)
+        build_image_cache(dataset, args.metadata, image_size, args.image_cache,
+                          num_workers=args.num_workers)
+    else:
+        transform = build_transforms(image_size)
+        dataset = ImageTextDataset(args.images_dir, args.metadata,
+                                   transform=transform,
+                                   filename_col=args.filename_col,
+                                   caption_col=args.caption_col)
+
+    caption_tokens_path = args.caption_tokens or os.path.join(args.output_dir, "caption_tokens.pt")
+    caption_tokens = build_caption_tokens(dataset, args.metadata, tokenizer, caption_tokens_path,
+                                          caption_col=args.caption_col)
+    collate = make_collate_fn(caption_tokens)
 
-    collate = make_collate_fn(tokenizer, device)
+    optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
 
+    start_epoch, start_batch, best_loss, seed = 1, 0, float("inf"), args.seed
+    resume_path = args.resume
+    if resume_path == "auto":
+        checkpoints = list_checkpoints(args.output_dir)
+        resume_path = checkpoints[-1] if checkpoints else None
+    if resume_path:
+        start_epoch, start_batch, best_loss, saved_seed = resume_training(resume_path, model, optimizer)
+        seed = saved_seed if saved_seed is not None else seed
+        print(f"Tiếp tục từ {resume_path}: epoch {start_epoch}, batch {start_batch}")
+    if seed is None:
+        seed = random.randrange(2 ** 31)
+
+    sampler = EpochShuffleSampler(len(dataset), seed)
     dataloader = DataLoader(dataset,
                             batch_size=args.batch_size,
-                            shuffle=True,
+                            sampler=sampler,
+                            # Generator riêng để việc tạo iterator không tiêu thụ RNG toàn cục (đã lưu trong checkpoint)
+                            generator=torch.Generator().manual_seed(seed),
                             num_workers=args.num_workers,
                             collate_fn=collate,
+                            pin_memory=(device == "cuda"),
                             drop_last=True)
 
-    optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    print(f"Batch hiệu dụng (số cặp mỗi bước contrastive): {args.batch_size * args.accum_steps}, "
+          f"precision: {args.precision}")
 
-    best_loss = float("inf")
-    for epoch in range(1, args.epochs + 1):
-        avg_loss, avg_acc = train_epoch(model, dataloader, optimizer, device, epoch)
-        print(f"Epoch {epoch} avg_loss={avg_loss:.4f}, avg_acc={avg_acc:.4f}")
+    checkpointer = AsyncCheckpointer(args.output_dir, keep_last=args.keep_last)
+    for epoch in range(start_epoch, args.epochs + 1):
+        epoch_start = start_batch if epoch == start_epoch else 0
+        sampler.set_epoch(epoch, epoch_start * args.batch_size)
 
-        ckpt_path = os.path.join(args.output_dir, f"clip_epoch_{epoch}.pt")
-        save_checkpoint(model, optimizer, epoch, ckpt_path)
+        def on_step(batches_done):
+            if args.save_every_steps and (batches_done // args.accum_steps) % args.save_every_steps == 0:
+                path = os.path.join(args.output_dir, f"clip_epoch_{epoch}_step_{batches_done}.pt")
+                checkpointer.save(make_checkpoint_state(model, optimizer, epoch, batches_done, False,
+                                                        best_loss, seed), [path])
+
+        avg_loss, avg_acc = train_epoch(model, dataloader, optimizer, device, epoch,
+                                        accum_steps=args.accum_steps, precision=args.precision,
+                                        start_batch=epoch_start, on_step=on_step)
+        print(f"Epoch {epoch} avg_loss={avg_loss:.4f}, avg_acc={avg_acc:.4f}")
 
-        if avg_loss < best_loss:
+        is_best = avg_loss < best_loss
+        if is_best:
             best_loss = avg_loss
-            best_path = os.path.join(args.output_dir, "clip_best.pt")
-            save_checkpoint(model, optimizer, epoch, best_path)
-            print(f"Saved best model to {best_path}")
+        paths = [os.path.join(args.output_dir, f"clip_epoch_{epoch}.pt")]
+        if is_best:
+            paths.append(os.path.join(args.output_dir, "clip_best.pt"))
+        checkpointer.save(make_checkpoint_state(model, optimizer, epoch, epoch_start + len(dataloader), True,
+                                                best_loss, seed), paths)
+        if is_best:
+            best_export = os.path.join(args.output_dir, "clip_best_fp16.pt")
+            checkpointer.run(partial(export_inference_weights, make_inference_artifact(model, args.model),
+                                     paths[-1], best_export))
+            print(f"Saved best model to {paths[-1]} (inference weights: {best_export})")
+
+    checkpointer.wait()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -184,7 +592,23 @@ if __name__ == "__main__":
     parser.add_argument('--lr', type=float, default=5e-6)
     parser.add_argument('--weight_decay', type=float, default=0.01)
     parser.add_argument('--num_workers', type=int, default=0)  
+    parser.add_argument('--accum_steps', type=int, default=1,
+                        help="Số micro-batch gom thành một bước contrastive (negative pool = batch_size * accum_steps)")
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                        help="bf16 dùng autocast bfloat16 (cả trên CPU)")
     parser.add_argument('--output_dir', type=str, default='./checkpoints')
+    parser.add_argument('--caption_tokens', type=str, default=None,
+                        help="File cache caption đã tokenize (mặc định: <output_dir>/caption_tokens.pt)")
+    parser.add_argument('--image_cache', type=str, default=None,
+                        help="File .npy chứa ảnh đã resize/crop sẵn (tạo tự động nếu chưa có hoặc đã cũ)")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="Seed xáo trộn dữ liệu (mặc định ngẫu nhiên, được lưu trong checkpoint để resume)")
+    parser.add_argument('--resume', type=str, default=None,
+                        help="Checkpoint huấn luyện để tiếp tục, hoặc 'auto' để lấy checkpoint mới nhất trong output_dir")
+    parser.add_argument('--save_every_steps', type=int, default=0,
+                        help="Lưu checkpoint giữa epoch sau mỗi N bước tối ưu (0 = chỉ lưu cuối epoch)")
+    parser.add_argument('--keep_last', type=int, default=3,
+                        help="Số checkpoint clip_epoch_* mới nhất được giữ lại (0 = giữ tất cả)")
     args = parser.parse_args()
 
     os.makedirs(args.output_dir, exist_ok=True)
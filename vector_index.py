@@ -0,0 +1,214 @@
+# Tên file: vector_index.py
+# Lớp trừu tượng chỉ mục vector cho bước tìm kiếm: "exact" (duyệt toàn bộ, như cũ) và
+# "ivf"/"hnsw" (tìm kiếm xấp xỉ bằng faiss, tuỳ chọn) với cùng giao diện search().
+# Các backend lưu embedding dạng nén "fp16"/"int8"/"pq" nằm trong quantization.py.
+
+import os
+import math
+
+import numpy as np
+import torch
+
+from latency import maybe_stage, accumulate_stage
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+BACKENDS = ("exact", "ivf", "hnsw", "fp16", "int8", "pq")
+# Cách tính điểm trả về cho mỗi kết quả:
+# - "topk":    chọn top-k trên cosine, rồi softmax(100 * cosine) chỉ trên k kết quả trả về (mặc định)
+# - "softmax": softmax(100 * cosine) trên toàn bộ kho ảnh như trước đây (chỉ backend "exact")
+# - "cosine":  cosine thô
+SCORE_MODES = ("topk", "softmax", "cosine")
+DEFAULT_SCORE_MODE = "topk"
+DEFAULT_CHUNK_SIZE = 65536
+
+
+def _scores_from_similarity(similarity, score_mode):
+    if score_mode == "cosine":
+        return similarity
+    return (100.0 * similarity).softmax(dim=-1)
+
+
+class ExactIndex:
+    """
+    Duyệt toàn bộ kho ảnh. Ở chế độ "topk", kho ảnh được nhân theo từng khối `chunk_size` ảnh
+    và chỉ giữ top-k của mỗi khối, nên bộ nhớ đỉnh là (Q x chunk_size) thay vì (Q x N) và không
+    phải tính exp trên toàn bộ kho ảnh. Với `timer` (latency.StageTimer), mỗi lần tìm kiếm ghi
+    thời gian hai bước "similarity" (nhân ma trận) và "topk".
+    """
+    backend = "exact"
+    supports_candidates = True
+
+    def __init__(self, image_features, chunk_size=DEFAULT_CHUNK_SIZE, timer=None):
+        self.image_features = image_features
+        self.chunk_size = chunk_size
+        self.timer = timer
+
+    def __len__(self):
+        return self.image_features.shape[0]
+
+    def _topk_similarity(self, text_features, top_k):
+        best_values, best_indices = None, None
+        # Thời gian của mọi khối được cộng dồn thành một mẫu cho mỗi lần tìm kiếm
+        seconds = {"similarity": 0.0, "topk": 0.0}
+        for start in range(0, len(self), self.chunk_size):
+            with accumulate_stage(self.timer, seconds, "similarity"):
+                similarity = text_features @ self.image_features[start:start + self.chunk_size].T
+            with accumulate_stage(self.timer, seconds, "topk"):
+                values, indices = similarity.topk(min(top_k, similarity.shape[1]), dim=-1)
+                indices += start
+                if best_values is not None:
+                    values = torch.cat([best_values, values], dim=-1)
+                    indices = torch.cat([best_indices, indices], dim=-1)
+                    values, order = values.topk(min(top_k, values.shape[-1]), dim=-1)
+                    indices = indices.gather(-1, order)
+            best_values, best_indices = values, indices
+        if self.timer is not None:
+            for name, value in seconds.items():
+                self.timer.record(name, value)
+        return best_values, best_indices
+
+    def search(self, text_features, top_k, score_mode=DEFAULT_SCORE_MODE, candidates=None):
+        """
+        text_features: tensor (Q, D) đã chuẩn hoá. Trả về (values, indices) dạng tensor (Q, k).
+        `candidates` (LongTensor chỉ số ảnh, ví dụ từ attribute_index) giới hạn việc tính tương đồng
+        vào tập ảnh đó; điểm "softmax" khi đó là softmax trên tập ứng viên.
+        """
+        if candidates is not None:
+            return self._search_candidates(text_features, top_k, score_mode, candidates)
+        top_k = min(top_k, len(self))
+        with torch.no_grad():
+            if score_mode == "softmax":
+                with maybe_stage(self.timer, "similarity"):
+                    similarity = (100.0 * text_features @ self.image_features.T).softmax(dim=-1)
+                with maybe_stage(self.timer, "topk"):
+                    values, indices = similarity.topk(top_k, dim=-1)
+            else:
+                similarity, indices = self._topk_similarity(text_features, top_k)
+                values = _scores_from_similarity(similarity.float(), score_mode)
+        return values.float().cpu(), indices.cpu()
+
+    def _search_candidates(self, text_features, top_k, score_mode, candidates):
+        candidates = candidates.cpu()
+        if len(candidates) == 0:
+            empty = torch.empty((text_features.shape[0], 0))
+            return empty, empty.long()
+        subset = ExactIndex(self.image_features[candidates.to(self.image_features.device)], self.chunk_size, self.timer)
+        values, indices = subset.search(text_features, top_k, score_mode)
+        return values, candidates[indices]
+
+
+class FaissIndex:
+    """
+    Tìm kiếm xấp xỉ (ANN) bằng faiss trên inner product (= cosine vì embedding đã chuẩn hoá).
+    - "ivf":  IndexIVFFlat, tham số nlist (số cụm) và nprobe (số cụm duyệt mỗi truy vấn).
+    - "hnsw": IndexHNSWFlat, tham số M, ef_construction và ef_search.
+    nprobe / ef_search càng lớn thì recall càng cao nhưng độ trễ càng lớn.
+    Với score_mode "topk"/"softmax", điểm là softmax của 100 * cosine trên các ứng viên tìm được
+    (faiss không duyệt cả kho nên không có mẫu số softmax trên toàn bộ ảnh).
+    """
+
+    def __init__(self, image_features, backend="hnsw", nlist=None, nprobe=8, M=32,
+                 ef_construction=200, ef_search=64, index_path=None):
+        if faiss is None:
+            raise RuntimeError("Backend ANN cần thư viện faiss (pip install faiss-cpu).")
+        if backend not in ("ivf", "hnsw"):
+            raise ValueError(f"Backend faiss không hợp lệ: {backend}")
+
+        self.backend = backend
+        vectors = _as_float32_numpy(image_features)
+        self.num_images, dim = vectors.shape
+
+        if index_path and os.path.exists(index_path):
+            self.index = faiss.read_index(index_path)
+        else:
+            if backend == "ivf":
+                if nlist is None:
+                    # faiss cần khoảng 39 điểm huấn luyện cho mỗi cụm
+                    nlist = max(1, min(int(4 * math.sqrt(self.num_images)), self.num_images // 39))
+                quantizer = faiss.IndexFlatIP(dim)
+                self.index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+                self.index.train(vectors)
+            else:
+                self.index = faiss.IndexHNSWFlat(dim, M, faiss.METRIC_INNER_PRODUCT)
+                self.index.hnsw.efConstruction = ef_construction
+            self.index.add(vectors)
+            if index_path:
+                tmp_path = index_path + ".tmp"
+                faiss.write_index(self.index, tmp_path)
+                os.replace(tmp_path, index_path)
+
+        self.set_search_params(nprobe=nprobe, ef_search=ef_search)
+
+    def __len__(self):
+        return self.num_images
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        if self.backend == "ivf" and nprobe is not None:
+            self.index.nprobe = nprobe
+        if self.backend == "hnsw" and ef_search is not None:
+            self.index.hnsw.efSearch = ef_search
+
+    def search(self, text_features, top_k, score_mode=DEFAULT_SCORE_MODE):
+        top_k = min(top_k, len(self))
+        similarity, indices = self.index.search(_as_float32_numpy(text_features), top_k)
+        similarity = torch.from_numpy(similarity)
+        indices = torch.from_numpy(indices)
+        # faiss trả về -1 khi không đủ ứng viên; loại chúng khỏi softmax
+        similarity[indices < 0] = float("-inf")
+        return _scores_from_similarity(similarity, score_mode), indices
+
+
+def _as_float32_numpy(features):
+    if isinstance(features, torch.Tensor):
+        features = features.detach().float().cpu().numpy()
+    return np.ascontiguousarray(features, dtype=np.float32)
+
+
+def _remove_stale_index_files(index_dir, prefix, index_tag, extension):
+    # File của generation cũ không bao giờ được nạp lại; lỗi xoá (vd. file đang mở trên Windows) bỏ qua
+    for name in os.listdir(index_dir):
+        if not (name.startswith(prefix) and name.endswith("." + extension)):
+            continue
+        rest = name[len(prefix):-len(extension) - 1]
+        if rest == str(index_tag) or rest.startswith(f"{index_tag}-"):
+            continue
+        try:
+            os.remove(os.path.join(index_dir, name))
+        except OSError:
+            pass
+
+
+def build_vector_index(image_features, backend="exact", index_dir=None, index_tag=None, timer=None, **params):
+    """
+    Tạo chỉ mục vector theo tên backend. Với backend faiss, nếu có `index_dir` và `index_tag`
+    (ví dụ generation của chỉ mục embedding) thì cấu trúc ANN được lưu lại để lần sau nạp ngay;
+    file của cùng backend nhưng tag khác (generation cũ) bị xoá.
+    `timer` (latency.StageTimer) chỉ backend "exact" dùng để đo riêng "similarity" và "topk".
+    """
+    if backend == "exact":
+        return ExactIndex(image_features, timer=timer, **params)
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend tìm kiếm không hợp lệ: {backend}. Chọn một trong {BACKENDS}")
+
+    index_path = None
+    if index_dir and index_tag is not None:
+        # Chỉ tham số ảnh hưởng tới cấu trúc đã xây mới đi vào tên file
+        build_params = {k: v for k, v in sorted(params.items())
+                        if k not in ("nprobe", "ef_search", "rerank", "rerank_factor", "chunk_size")}
+        suffix = "".join(f"-{k}{v}" for k, v in build_params.items())
+        extension = "index" if backend in ("ivf", "hnsw") else "pt"
+        prefix = f"{'faiss' if extension == 'index' else 'quant'}-{backend}-"
+        index_path = os.path.join(index_dir, f"{prefix}{index_tag}{suffix}.{extension}")
+
+    if backend in ("ivf", "hnsw"):
+        index = FaissIndex(image_features, backend=backend, index_path=index_path, **params)
+    else:
+        from quantization import build_quantized_index
+        index = build_quantized_index(image_features, backend, index_path=index_path, **params)
+    if index_path is not None and os.path.isdir(index_dir):
+        _remove_stale_index_files(index_dir, prefix, index_tag, extension)
+    return index